@@ -0,0 +1,129 @@
+import logging
+import sqlite3
+import threading
+import time
+
+SCHEMA_VERSION = 2
+
+
+class AnswerCache:
+    """
+    Persistent semantic cache of chat answers keyed on the embedding of the question.
+
+    Entries live in a small SQLite file; the embeddings are mirrored in memory as
+    a normalised matrix so a lookup is a single matrix-vector product. The matrix
+    (and numpy) are loaded on the first lookup or store, so showing stats stays cheap. A lookup
+    hits when the best cosine similarity reaches the threshold and the entry is
+    younger than the TTL. Least recently used entries are evicted past max_entries.
+    """
+
+    def __init__(self, path, similarity_threshold=0.95, ttl_seconds=7 * 24 * 3600, max_entries=500):
+        self.path = path
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, question TEXT, answer TEXT, embedding BLOB, "
+            "created_at REAL, last_used_at REAL)"
+        )
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            # Version 1 also stored answers to follow-up messages, which depend on their conversation
+            self._conn.execute("DELETE FROM answers")
+            self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._conn.commit()
+        self._ids = None
+        self._matrix = None
+
+    def _load(self):
+        import numpy as np
+        rows = self._conn.execute("SELECT id, embedding FROM answers").fetchall()
+        self._ids = [row[0] for row in rows]
+        if rows:
+            self._matrix = np.vstack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+        else:
+            self._matrix = None
+
+    @staticmethod
+    def _normalise(embedding):
+        import numpy as np
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, embedding):
+        """Return the cached answer for a semantically matching question, or None."""
+        import numpy as np
+        vector = self._normalise(embedding)
+        with self._lock:
+            if self._ids is None:
+                self._load()
+            if self._matrix is None or self._matrix.shape[1] != vector.shape[0]:
+                self.misses += 1
+                return None
+            scores = self._matrix @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.similarity_threshold:
+                self.misses += 1
+                return None
+            entry_id = self._ids[best]
+            row = self._conn.execute("SELECT answer, created_at FROM answers WHERE id = ?", (entry_id,)).fetchone()
+            now = time.time()
+            if row is None or now - row[1] > self.ttl_seconds:
+                self._delete([entry_id])
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE answers SET last_used_at = ? WHERE id = ?", (now, entry_id))
+            self._conn.commit()
+            self.hits += 1
+            logging.info(f"Answer cache hit (similarity {scores[best]:.3f})")
+            return row[0]
+
+    def store(self, question, embedding, answer):
+        vector = self._normalise(embedding)
+        now = time.time()
+        with self._lock:
+            if self._ids is None:
+                self._load()
+            self._conn.execute(
+                "INSERT INTO answers (question, answer, embedding, created_at, last_used_at) VALUES (?, ?, ?, ?, ?)",
+                (question, answer, vector.tobytes(), now, now),
+            )
+            self._conn.execute("DELETE FROM answers WHERE created_at < ?", (now - self.ttl_seconds,))
+            overflow = len(self._ids) + 1 - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY last_used_at LIMIT ?)",
+                    (overflow,),
+                )
+            self._conn.commit()
+            self._load()
+
+    def _delete(self, ids):
+        self._conn.executemany("DELETE FROM answers WHERE id = ?", [(entry_id,) for entry_id in ids])
+        self._conn.commit()
+        self._load()
+
+    def clear(self):
+        """Drop every entry; called whenever the knowledge base changes."""
+        with self._lock:
+            self._conn.execute("DELETE FROM answers")
+            self._conn.commit()
+            self._ids = []
+            self._matrix = None
+        logging.info("Answer cache cleared")
+
+    def stats(self):
+        total = self.hits + self.misses
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,434 @@
+"""
+Headless HTTP/JSON API for the St Jamie commands, for the school portal and LMS
+integrations.
+
+    python api_server.py --port 8600 --workers 4
+
+Starts one writer process and --workers reader processes. The readers share the
+public port (SO_REUSEPORT, so Linux only) and answer chat messages, /help,
+/list, /stats, /db stats and /imagine from the persisted Chroma store without
+ever modifying it. /add and the other /db commands are forwarded to the writer,
+which applies them one at a time on an internal port and also runs the
+background index maintenance. After each change the writer touches
+kb_generation, and readers reopen the store before their next query.
+
+    POST /v1/command  {"prompt": "...", "session_id": "..."}
+                      -> {"session_id": "...", "reply": "...", "images": [base64, ...]}
+    GET  /v1/health
+    GET  /v1/stats
+
+Omit session_id to start a conversation and send the returned one back to
+continue it; turns are kept in the same session store as the Streamlit app.
+OPENAI_API_KEY is read from the environment. Set STJAMIE_API_KEY to require
+"Authorization: Bearer <key>" on every request; it must be set to listen on
+anything but a loopback address.
+"""
+import sys
+
+# Chroma needs a newer SQLite than some hosts ship; swap it in before anything imports sqlite3
+try:
+    sys.modules['sqlite3'] = __import__('pysqlite3')
+    sys.modules.pop('pysqlite3')
+except ImportError:
+    pass
+
+import argparse
+import asyncio
+import hmac
+import ipaddress
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http import HTTPStatus
+
+import commands
+from commands import (
+    SESSION_STORE_DEFAULTS, answer_query, generate_images, get_help_message, get_imagine_help_message,
+    get_request_scheduler, get_session_store, get_source_list, parse_add_command, parse_imagine_command,
+)
+from metrics import metrics, format_stats, start_exporter
+from request_scheduler import SchedulerBusyError
+
+API_DEFAULTS = {
+    "host": "127.0.0.1",  # listening elsewhere needs STJAMIE_API_KEY
+    "port": 8600,  # public port shared by the reader workers
+    "writer_port": 8601,  # internal port of the writer process, bound to localhost
+    "workers": 4,  # reader processes
+    "max_body_bytes": 64 * 1024,  # larger request bodies are refused
+    "request_timeout": 300,  # seconds before a request is answered with 504
+    "session_caches": 256,  # conversations whose context cache a worker keeps
+}
+
+METRICS_EXPORT_INTERVAL = 60
+
+# Commands that change the knowledge base; only the writer runs them
+WRITE_COMMANDS = ("/add", "/db")
+READ_COMMANDS = ("/db stats",)
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+@commands.process_resource
+def get_openai_client():
+    from openai import OpenAI
+    return OpenAI()
+
+
+async def read_request(reader, max_body_bytes):
+    """(method, path, headers, body) of the next request on the connection, or None when it is closed."""
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    try:
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise HttpError(HTTPStatus.BAD_REQUEST, "Malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        raise HttpError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length")
+    if length < 0:
+        raise HttpError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length")
+    if length > max_body_bytes:
+        raise HttpError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target.split("?", 1)[0], headers, body
+
+
+def encode_response(status, body, keep_alive):
+    status = HTTPStatus(status)
+    head = (
+        f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+        f"Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    return head.encode("latin-1") + body
+
+
+class ApiWorker:
+    """
+    One API process. Readers forward knowledge base changes to the writer; the
+    writer applies them on a single thread so there is never more than one process
+    writing to Chroma.
+
+    Readers are read-only at the command layer only: commands.read_only makes every
+    mutating command refuse, but they open the store through the same
+    App.from_config as the writer and Chroma would accept writes from them. Opening
+    itself creates the collection if it does not exist yet, so start the API on a
+    store the writer (or /db init) has already created.
+    """
+
+    def __init__(self, role, options, api_key=None):
+        self.role = role
+        self.options = options
+        self.api_key = api_key
+        self.app = None
+        self.generation = None
+        self._app_lock = threading.Lock()
+        self._app_users = {}  # id(app): commands currently using that app
+        self._retired = {}  # id(app): stops the Chroma system of an app replaced while in use
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="api-writer")
+        self._session_caches = OrderedDict()
+        self._caches_lock = threading.Lock()
+
+    def _current_app(self):
+        # Called with _app_lock held
+        generation = commands.knowledge_base_generation()
+        if self.app is None:
+            if self.role == "writer":
+                commands.ensure_chroma_storage()
+                self.app = commands.create_app()
+                if not self.app.db.count():
+                    commands.restore_knowledge_base(self.app)
+            else:
+                self.app = commands.create_app()
+        elif self.role == "reader" and generation != self.generation:
+            logging.info("Knowledge base changed by the writer; reopening the store")
+            previous = self.app
+            self.app, stop_previous = commands.reopen_app(previous)
+            if id(previous) in self._app_users:
+                # Queries still running on the old index; the last one to finish stops it
+                self._retired[id(previous)] = stop_previous
+            else:
+                stop_previous()
+        self.generation = generation
+        return self.app
+
+    @contextmanager
+    def using_app(self):
+        """The current app, kept alive (its Chroma system not stopped) until the block ends."""
+        with self._app_lock:
+            app = self._current_app()
+            self._app_users[id(app)] = self._app_users.get(id(app), 0) + 1
+        try:
+            yield app
+        finally:
+            stop_previous = None
+            with self._app_lock:
+                self._app_users[id(app)] -= 1
+                if not self._app_users[id(app)]:
+                    del self._app_users[id(app)]
+                    stop_previous = self._retired.pop(id(app), None)
+            if stop_previous is not None:
+                stop_previous()
+
+    def set_app(self, app):
+        with self._app_lock:
+            self.app = app
+
+    def context_cache(self, session_id):
+        with self._caches_lock:
+            cache = self._session_caches.pop(session_id, None)
+            if cache is None:
+                cache = {}
+            self._session_caches[session_id] = cache
+            while len(self._session_caches) > self.options["session_caches"]:
+                self._session_caches.popitem(last=False)
+            return cache
+
+    def run_command(self, prompt, session_id):
+        """Reply to one prompt as the chat input would: {"reply": text} plus "images" for /imagine."""
+        if prompt.startswith("/help"):
+            return {"reply": get_help_message()}
+        if prompt.startswith("/stats"):
+            return {"reply": format_stats(metrics.snapshot())}
+        if prompt.startswith("/imagine"):
+            image_prompt, options = parse_imagine_command(prompt)
+            if not image_prompt:
+                return {"reply": get_imagine_help_message()}
+            images = generate_images(get_openai_client(), image_prompt, options, get_request_scheduler(), session_id)
+            if not images:
+                return {"reply": "Sorry, I couldn't generate the image. Please try again.", "images": []}
+            return {"reply": f"Here are your {len(images)} generated images:" if len(images) > 1 else "Here's your generated image:", "images": images}
+        with self.using_app() as app:
+            return self.run_app_command(app, prompt, session_id)
+
+    def run_app_command(self, app, prompt, session_id):
+        if prompt.startswith("/list"):
+            return {"reply": get_source_list(app)}
+        if prompt.startswith("/add"):
+            source, crawl_options = parse_add_command(prompt)
+            if not source:
+                return {"reply": "Usage: /add <source> [--crawl] (e.g., /add https://example.com)"}
+            if crawl_options is not None:
+                return {"reply": commands.add_site(app, source, crawl_options, on_new_app=self.set_app)}
+            return {"reply": commands.add_source(app, source, on_new_app=self.set_app)}
+        if prompt.startswith("/db"):
+            param = prompt.replace("/db", "").strip().lower()
+            if param == "reset":
+                return {"reply": commands.reset_database(app)}
+            if param == "init":
+                return {"reply": commands.init_database(app, on_new_app=self.set_app)}
+            if param == "snapshot":
+                return {"reply": commands.create_snapshot(app)}
+            if param == "stats":
+                return {"reply": commands.index_stats_message(app)}
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Invalid command. Use '/db reset', '/db init', '/db snapshot' or '/db stats'.")
+
+        # Regular chat; the conversation so far comes from the shared session store
+        store = get_session_store()
+        history = store.load_recent(session_id, SESSION_STORE_DEFAULTS["memory_messages"])
+        response = answer_query(app, prompt, history, self.context_cache(session_id), session_id)
+        store.append(session_id, {"role": "user", "content": prompt})
+        store.append(session_id, {"role": "assistant", "content": response})
+        return {"reply": response}
+
+    async def forward_to_writer(self, headers, body):
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", self.options["writer_port"])
+        except OSError as e:
+            logging.error(f"Writer process unreachable: {str(e)}")
+            raise HttpError(HTTPStatus.SERVICE_UNAVAILABLE, "The knowledge base writer is not running; try again shortly")
+        try:
+            forwarded = {"Content-Type": "application/json", "Content-Length": str(len(body)), "Connection": "close"}
+            if "authorization" in headers:
+                forwarded["Authorization"] = headers["authorization"]
+            head = "POST /v1/command HTTP/1.1\r\nHost: 127.0.0.1\r\n" + "".join(f"{k}: {v}\r\n" for k, v in forwarded.items())
+            writer.write(head.encode("latin-1") + b"\r\n" + body)
+            await writer.drain()
+            status_line = await reader.readline()
+            status = int(status_line.split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value.strip())
+            return status, await reader.readexactly(length)
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError) as e:
+            logging.error(f"Bad response from the writer process: {str(e)}")
+            raise HttpError(HTTPStatus.BAD_GATEWAY, "The knowledge base writer failed to answer")
+        finally:
+            writer.close()
+
+    async def handle_command(self, headers, body):
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            raise HttpError(HTTPStatus.BAD_REQUEST, "Body must be JSON")
+        prompt = request.get("prompt") if isinstance(request, dict) else None
+        if not isinstance(prompt, str) or not prompt.strip():
+            raise HttpError(HTTPStatus.BAD_REQUEST, "'prompt' is required")
+        prompt = prompt.strip()
+        try:
+            session_id = uuid.UUID(hex=str(request.get("session_id") or "")).hex
+        except ValueError:
+            session_id = uuid.uuid4().hex
+
+        is_write = prompt.startswith(WRITE_COMMANDS) and not prompt.lower().startswith(READ_COMMANDS)
+        if is_write and self.role == "reader":
+            metrics.increment("api.forwarded")
+            status, payload = await self.forward_to_writer(headers, json.dumps({"prompt": prompt, "session_id": session_id}).encode())
+            return status, payload
+
+        loop = asyncio.get_running_loop()
+        executor = self._write_executor if is_write else None
+        result = await asyncio.wait_for(
+            loop.run_in_executor(executor, self.run_command, prompt, session_id),
+            self.options["request_timeout"],
+        )
+        return HTTPStatus.OK, json.dumps({"session_id": session_id, **result}).encode()
+
+    async def dispatch(self, method, path, headers, body):
+        if self.api_key and not hmac.compare_digest(headers.get("authorization", ""), f"Bearer {self.api_key}"):
+            raise HttpError(HTTPStatus.UNAUTHORIZED, "Missing or invalid API key")
+        if path == "/v1/health" and method == "GET":
+            payload = {"status": "ok", "role": self.role, "pid": os.getpid(), "generation": self.generation}
+            return HTTPStatus.OK, json.dumps(payload).encode()
+        if path == "/v1/stats" and method == "GET":
+            payload = {"role": self.role, "pid": os.getpid(), "scheduler": get_request_scheduler().stats(), **metrics.snapshot()}
+            return HTTPStatus.OK, json.dumps(payload).encode()
+        if path == "/v1/command":
+            if method != "POST":
+                raise HttpError(HTTPStatus.METHOD_NOT_ALLOWED, "Use POST")
+            with metrics.timer(f"api.{self.role}.command"):
+                return await self.handle_command(headers, body)
+        raise HttpError(HTTPStatus.NOT_FOUND, f"No route for {method} {path}")
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                keep_alive = False
+                try:
+                    try:
+                        request = await read_request(reader, self.options["max_body_bytes"])
+                    except (asyncio.IncompleteReadError, ConnectionError):
+                        break  # the client went away
+                    if request is None:
+                        break
+                    method, path, headers, body = request
+                    keep_alive = headers.get("connection", "").lower() != "close"
+                    status, payload = await self.dispatch(method, path, headers, body)
+                except HttpError as e:
+                    status, payload = e.status, json.dumps({"error": str(e)}).encode()
+                except SchedulerBusyError as e:
+                    status, payload = HTTPStatus.SERVICE_UNAVAILABLE, json.dumps({"error": str(e)}).encode()
+                except asyncio.TimeoutError:
+                    status, payload = HTTPStatus.GATEWAY_TIMEOUT, json.dumps({"error": "The request took too long"}).encode()
+                except Exception as e:
+                    logging.error(f"Error handling API request: {str(e)}", exc_info=True)
+                    metrics.increment("api.errors")
+                    status, payload = HTTPStatus.INTERNAL_SERVER_ERROR, json.dumps({"error": str(e)}).encode()
+                try:
+                    writer.write(encode_response(status, payload, keep_alive))
+                    await writer.drain()
+                except ConnectionError:
+                    break
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+    async def serve(self):
+        if self.role == "writer":
+            server = await asyncio.start_server(self.handle_connection, "127.0.0.1", self.options["writer_port"])
+        else:
+            server = await asyncio.start_server(
+                self.handle_connection, self.options["host"], self.options["port"], reuse_port=True
+            )
+        logging.info(f"API {self.role} {os.getpid()} listening on {', '.join(str(s.getsockname()) for s in server.sockets)}")
+        async with server:
+            await server.serve_forever()
+
+
+def run_worker(role, index, options):
+    logging.basicConfig(level=logging.INFO)
+    commands.read_only = role == "reader"
+    export_path = os.environ.get("STJAMIE_METRICS_EXPORT")
+    if export_path:
+        # One file per process so the workers do not overwrite each other
+        root, ext = os.path.splitext(export_path)
+        start_exporter(metrics, f"{root}.{role}{index}{ext}", METRICS_EXPORT_INTERVAL)
+    if role == "writer":
+        commands.get_index_maintenance().start()
+    worker = ApiWorker(role, options, api_key=os.environ.get("STJAMIE_API_KEY"))
+    try:
+        asyncio.run(worker.serve())
+    except KeyboardInterrupt:
+        pass
+
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless St Jamie API")
+    parser.add_argument("--host", default=API_DEFAULTS["host"])
+    parser.add_argument("--port", type=int, default=API_DEFAULTS["port"])
+    parser.add_argument("--writer-port", type=int, default=API_DEFAULTS["writer_port"])
+    parser.add_argument("--workers", type=int, default=API_DEFAULTS["workers"])
+    args = parser.parse_args()
+    if not is_loopback(args.host) and not os.environ.get("STJAMIE_API_KEY"):
+        # /add and /db would otherwise let anyone on the network crawl URLs or wipe the knowledge base
+        parser.error(f"set STJAMIE_API_KEY before listening on {args.host}")
+    logging.basicConfig(level=logging.INFO)
+    options = dict(API_DEFAULTS, host=args.host, port=args.port, writer_port=args.writer_port, workers=args.workers)
+
+    # Spawned rather than forked: embedchain and Chroma start threads that do not survive a fork
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=run_worker, args=("writer", 0, options), name="api-writer")]
+    processes += [
+        context.Process(target=run_worker, args=("reader", index, options), name=f"api-reader-{index}")
+        for index in range(max(1, args.workers))
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,42 @@
 import sys
 import time
-from chromadb.errors import ChromaError  # Change this line
 import logging
 import base64
-import shutil
-import sqlite3
-from openai import OpenAI
+import uuid
 
-logging.basicConfig(level=logging.INFO)
+import startup_profile
+
+startup_profile.start_run()
 
-# Define the version number as a constant
-VERSION = "1.5"
+logging.basicConfig(level=logging.INFO)
 
 # WARNING: The following two lines are ONLY for Streamlit.
 # Remove them from local install!!
-try:
-    sys.modules['sqlite3'] = __import__('pysqlite3')
-    sys.modules.pop('pysqlite3')
-except ImportError:
-    # pysqlite3 is not available, do nothing or handle the situation
-    pass
-
-import streamlit as st
+with startup_profile.phase("pysqlite3 swap"):
+    try:
+        sys.modules['sqlite3'] = __import__('pysqlite3')
+        sys.modules.pop('pysqlite3')
+    except ImportError:
+        # pysqlite3 is not available, do nothing or handle the situation
+        pass
+
+with startup_profile.phase("import streamlit"):
+    import streamlit as st
 import os
-from chromadb.config import Settings
-from streamlit.components.v1 import html  # Add this import
 
-# from embedchain import App
-from embedchain.pipeline import Pipeline as App
+# Heavy dependencies (openai, chromadb, embedchain, langchain, tiktoken, numpy, requests)
+# are imported inside the functions that use them so the sidebar paints without waiting
+# for them. check_startup.py fails if one of them becomes a top-level import again.
+with startup_profile.phase("import local modules"):
+    from image_store import ImageStore
+    from image_jobs import ImageJobQueue, QueueFullError
+    from metrics import metrics, format_stats, start_exporter
+    import commands
+    from commands import (
+        VERSION, KAPLAY_SOURCES, SESSION_STORE_DEFAULTS, get_session_store, get_request_scheduler, get_answer_cache,
+        create_app, ensure_chroma_storage, reset_chroma_storage, create_snapshot, parse_add_command, get_source_list,
+        get_index_maintenance, index_stats_message, get_help_message, get_imagine_help_message, parse_imagine_command, generate_images, answer_query,
+    )
 
 # from embedchain.loaders.github import GithubLoader
 
@@ -41,32 +50,109 @@ if 'app' not in st.session_state:
 if 'conversation_history' not in st.session_state:
     st.session_state.conversation_history = []
 
+if 'context_cache' not in st.session_state:
+    st.session_state.context_cache = {}
+
+if 'session_id' not in st.session_state:
+    # The id is kept in the URL so a reload, or a restarted container, resumes the conversation
+    session_param = st.experimental_get_query_params().get("session", [""])[0]
+    try:
+        st.session_state.session_id = uuid.UUID(hex=session_param).hex
+    except ValueError:
+        st.session_state.session_id = uuid.uuid4().hex
+        st.experimental_set_query_params(session=st.session_state.session_id)
+
+if 'pending_images' not in st.session_state:
+    st.session_state.pending_images = []
+
+if 'history_pages' not in st.session_state:
+    st.session_state.history_pages = 0
+
+if 'message_previews' not in st.session_state:
+    st.session_state.message_previews = {}
+
 # Add at the top of your file with other constants
-IMAGE_DEFAULTS = {
-    "size": "1024x1024",  # 1024x1024, 1536x1024, 1024x1536, or auto
-    "quality": "auto",  # auto, high, medium, or low
-    "output_format": "png",  # png, jpeg, or webp
-    "background": "auto",  # auto, transparent, or opaque
+IMAGE_QUEUE_DEFAULTS = {
+    "max_concurrency": 4,  # image requests in flight across all sessions
+    "per_user_limit": 2,  # queued or running jobs allowed per session
+    "max_queued": 100,  # jobs waiting across all sessions before /imagine is refused
+}
+
+HISTORY_DEFAULTS = {
+    "visible_messages": 20,  # most recent messages rendered in full on every rerun
+    "page_size": 25,  # older messages revealed per "Show earlier messages" click
+    "preview_chars": 300,  # characters shown for each older message
+    "cached_previews": 500,  # previews kept per session; the first computed are dropped first
+}
+
+# Seconds between reruns while a session waits for an image job
+IMAGE_POLL_INTERVAL = 1.5
+
+IMAGE_STORE_DEFAULTS = {
+    "thumbnail_size": 512,  # longest side in pixels of history thumbnails
+    "cache_bytes": 64 * 1024 * 1024,  # decoded image bytes kept in memory across sessions
 }
 
+# Minimum seconds between redraws of a streaming answer
+STREAM_FLUSH_INTERVAL = 0.1
+
+# Set STJAMIE_METRICS_EXPORT to a .prom file (Prometheus text) or any other path (JSON lines)
+# to write the /stats metrics there every METRICS_EXPORT_INTERVAL seconds
+METRICS_EXPORT_INTERVAL = 60
+
+@st.cache_resource
+def start_metrics_export():
+    path = os.environ.get("STJAMIE_METRICS_EXPORT")
+    if path:
+        start_exporter(metrics, path, METRICS_EXPORT_INTERVAL)
+        logging.info(f"Exporting metrics to {path} every {METRICS_EXPORT_INTERVAL}s")
+    return path
+
+start_metrics_export()
+
+@st.cache_resource
+def start_index_maintenance():
+    # One maintenance thread per process, shared by every session
+    return get_index_maintenance().start()
+
+start_index_maintenance()
+
+@st.cache_resource
+def get_image_store():
+    return ImageStore(os.path.join(os.getcwd(), "images"), **IMAGE_STORE_DEFAULTS)
+
+@st.cache_resource
+def get_image_queue():
+    # One client (and connection pool) for every session in this process
+    api_key = st.secrets["OPENAI_API_KEY"]
+
+    def create_client():
+        from openai import OpenAI
+        return OpenAI(api_key=api_key)
+
+    return ImageJobQueue(create_client, **IMAGE_QUEUE_DEFAULTS)
+
 @st.cache_resource
 def embedchain_bot():
     if st.session_state.app is None:
+        from chromadb.errors import ChromaError
         try:
             ensure_chroma_storage()
-            app = App.from_config(config_path="config.yaml")
+            app = create_app()
             # Try to access the database to check if it's properly initialized
             app.db.get(where={}, limit=1)
             st.session_state.app = app
-            st.session_state.db_initialized = True
+            # An empty collection (e.g. a fresh container) is filled from the snapshot, or crawled later
+            st.session_state.db_initialized = app.db.count() > 0 or restore_knowledge_base(app)
         except (ChromaError, StopIteration) as e:
             error_text = str(e)
             if "no such column: collections.config_json_str" in error_text:
                 st.warning("Database schema mismatch detected. Resetting database...")
                 reset_chroma_storage()
             st.warning(f"Database not properly initialized: {error_text}. Initializing...")
-            app = App.from_config(config_path="config.yaml")
-            init_database(app)
+            app = create_app()
+            if not restore_knowledge_base(app):
+                init_database(app)
             st.session_state.app = app
             st.session_state.db_initialized = True
         except Exception as e:
@@ -76,8 +162,9 @@ def embedchain_bot():
                 reset_chroma_storage()
                 try:
                     ensure_chroma_storage()
-                    app = App.from_config(config_path="config.yaml")
-                    init_database(app)
+                    app = create_app()
+                    if not restore_knowledge_base(app):
+                        init_database(app)
                     st.session_state.app = app
                     st.session_state.db_initialized = True
                     return st.session_state.app
@@ -88,207 +175,59 @@ def embedchain_bot():
             st.session_state.db_initialized = False
     return st.session_state.app
 
-def reset_chroma_storage():
-    db_path = os.path.join(os.getcwd(), "db")
-    if os.path.exists(db_path):
-        shutil.rmtree(db_path)
-    os.makedirs(db_path, exist_ok=True)
-
-def ensure_chroma_storage():
-    db_path = os.path.join(os.getcwd(), "db")
-    sqlite_path = os.path.join(db_path, "chroma.sqlite3")
-    if not os.path.exists(sqlite_path):
-        return
-    try:
-        with sqlite3.connect(sqlite_path) as conn:
-            cursor = conn.execute("PRAGMA table_info(collections);")
-            columns = {row[1] for row in cursor.fetchall()}
-        if "config_json_str" not in columns:
-            reset_chroma_storage()
-    except Exception:
-        # If we cannot inspect the schema, rebuild storage defensively.
-        reset_chroma_storage()
+def use_recovered_app(new_app):
+    # The ingestion pipeline recreated the app while recovering from a lost collection
+    st.session_state.app = new_app
+
+def restore_knowledge_base(app):
+    return commands.restore_knowledge_base(app, notify=st.info, spinner=st.spinner)
 
 def reset_database(app):
-    try:
-        client = app.db.client
-        collections = client.list_collections()
-        for collection in collections:
-            client.delete_collection(collection.name)
-        st.session_state.db_initialized = False  # Reset the initialization flag
-        return "Database reset successfully. All collections have been deleted."
-    except Exception as e:
-        error_text = str(e)
-        if "no such column: collections.config_json_str" in error_text:
-            reset_chroma_storage()
-            st.session_state.db_initialized = False
-            return "Database reset successfully by rebuilding storage."
-        return f"Error resetting database: {error_text}"
+    reset_message = commands.reset_database(app)
+    st.session_state.db_initialized = False  # Reset the initialization flag
+    return reset_message
 
 def init_database(app):
-    logging.info("Starting init_database function")
-    # Add the KaPlay sources to the knowledge base
-    sources = [
-        "https://kaplayjs.com/guides/creating_your_first_game/",
-        "https://kaplayjs.com/guides/starting/",
-        "https://kaplayjs.com/guides/components/",
-        "https://kaplayjs.com/guides/sprites/",
-        "https://kaplayjs.com/guides/audio/",
-        "https://kaplayjs.com/guides/input/",
-        "https://kaplayjs.com/guides/debug_mode/",
-        "https://kaplayjs.com/guides/optimization/",
-        "https://kaplayjs.com/guides/pathfinding/",
-        "https://kaplayjs.com/guides/physics/",
-        "https://kaplayjs.com/guides/shaders/",
-        "https://kaplayjs.com/doc/kaplay/",
-        "https://kaplayjs.com/doc.json"
-    ]
-    
-    total_sources = len(sources)
+    total_sources = len(KAPLAY_SOURCES)
     progress_bar = st.progress(0)
     status_text = st.empty()
-    
-    successful_sources = 0
-    failed_sources = []
-    skipped_sources = []
-    
-    for i, source in enumerate(sources):
-        status_text.text(f"Initializing database: processing source {i+1} of {total_sources}")
-        try:
-            logging.info(f"Processing source: {source}")
-            app.add(source, data_type="web_page")
-            successful_sources += 1
-            st.success(f"Successfully added: {source}")
-            logging.info(f"Successfully added: {source}")
-        except Exception as e:
-            error_text = str(e)
-            # Chroma can lose collections on hosted environments; recreate and retry once.
-            if "does not exist" in error_text and "Collection" in error_text:
-                logging.warning(f"Collection missing. Recreating app and retrying: {source}")
-                try:
-                    app = App.from_config(config_path="config.yaml")
-                    st.session_state.app = app
-                    st.session_state.db_initialized = False
-                    app.add(source, data_type="web_page")
-                    successful_sources += 1
-                    st.success(f"Successfully added after retry: {source}")
-                    logging.info(f"Successfully added after retry: {source}")
-                    progress_bar.progress((i + 1) / total_sources)
-                    time.sleep(0.1)
-                    continue
-                except Exception as retry_error:
-                    error_text = str(retry_error)
-            # Schema mismatch can happen after Chroma upgrades; reset and retry once.
-            if "no such column: collections.config_json_str" in error_text:
-                logging.warning(f"Schema mismatch. Resetting database and retrying: {source}")
-                try:
-                    reset_database(app)
-                    app = App.from_config(config_path="config.yaml")
-                    st.session_state.app = app
-                    st.session_state.db_initialized = False
-                    app.add(source, data_type="web_page")
-                    successful_sources += 1
-                    st.success(f"Successfully added after reset: {source}")
-                    logging.info(f"Successfully added after reset: {source}")
-                    progress_bar.progress((i + 1) / total_sources)
-                    time.sleep(0.1)
-                    continue
-                except Exception as retry_error:
-                    error_text = str(retry_error)
-            failed_sources.append((source, error_text))
-            st.error(f"Error adding source {source}: {error_text}")
-            logging.error(f"Error adding source {source}: {error_text}", exc_info=True)
-        progress_bar.progress((i + 1) / total_sources)
-        time.sleep(0.1)  # Small delay to make the progress visible
-    
+    status_text.text(f"Initializing database: processing {total_sources} sources")
+    completed = 0
+    failed = 0
+
+    def on_result(result):
+        nonlocal completed, failed
+        completed += 1
+        if result["status"] == "added":
+            st.success(f"Successfully added: {result['source']}")
+        elif result["status"] == "failed":
+            failed += 1
+            st.error(f"Error adding source {result['source']}: {result['error']}")
+        progress_bar.progress(completed / total_sources)
+        status_text.text(f"Initializing database: {completed} of {total_sources} sources processed")
+
+    def on_new_app(new_app):
+        use_recovered_app(new_app)
+        st.session_state.db_initialized = False
+
+    summary = commands.init_database(app, on_result=on_result, on_new_app=on_new_app)
+
     progress_bar.empty()
     status_text.empty()
-    
-    summary = f"Database initialization completed.\n"
-    summary += f"Successfully added: {successful_sources}\n"
-    summary += f"Failed to add: {len(failed_sources)}\n"
-    summary += f"Total sources processed: {total_sources}"
-    
-    if failed_sources:
+
+    if failed:
         st.warning("Some sources failed to add. Check the errors above for details.")
-    
-    logging.info(f"init_database completed. Summary: {summary}")
     return summary
 
-def get_source_list(app):
-    logging.info("Starting get_source_list function")
-    try:
-        all_sources = set()  # Use a set to avoid duplicates
-        
-        # Get all documents from the database
-        try:
-            logging.info("Attempting to get documents from the database")
-            documents = app.db.get(limit=1000000)  # Set a high limit to get all documents
-            logging.info(f"Retrieved documents from the database: {documents}")
-        except StopIteration:
-            logging.warning("No documents found in the database (StopIteration)")
-            return "The database is currently empty. You may need to initialize the database using '/db init'."
-        except Exception as e:
-            logging.error(f"Error retrieving documents: {str(e)}", exc_info=True)
-            return f"An error occurred while retrieving documents: {str(e)}"
-        
-        if not documents or 'metadatas' not in documents or not documents['metadatas']:
-            logging.warning("No documents or metadata found in the database")
-            return "The database is currently empty. You may need to initialize the database using '/db init'."
-        
-        # Extract unique URLs from the metadata
-        for metadata in documents['metadatas']:
-            url = metadata.get('url')
-            if url:
-                all_sources.add(url)
-        
-        logging.info(f"Found {len(all_sources)} unique sources")
-        
-        if all_sources:
-            source_list = "\n".join([f"- {source}" for source in sorted(all_sources)])
-            response = f"Here's the list of sources currently in the database:\n\n{source_list}"
-        else:
-            response = "No sources found in the database. You may need to initialize the database using '/db init'."
-        
-        logging.info(f"Returning response: {response[:100]}...")  # Log first 100 characters of response
-        return response
-    except Exception as e:
-        logging.error(f"Error in get_source_list: {str(e)}", exc_info=True)
-        return f"An error occurred while retrieving the sources: {str(e)}"
-
-# Add this function to handle the help command
-def get_help_message():
-    return """
-    Available commands:
-    /help - Show this help message
-    /add <source> - Add a new source to the knowledge base (e.g., /add https://example.com)
-    /list - List all sources currently in the database
-    /db reset - Reset the database (delete all data)
-    /db init - Initialize the database with default KaPlay sources
-    /imagine <prompt> - Generate an image using GPT Image (latest)
-        Options (add with --option=value):
-        --size=1024x1024, 1536x1024, 1024x1536, or auto
-        --quality=auto, high, medium, or low
-        --output_format=png, jpeg, or webp
-        --background=auto, transparent, or opaque
-        Example: /imagine a cute robot --size=1024x1536 --quality=high
-    
-    You can also ask me anything about AI, game development, or related topics!
-    """
+def add_source(app, source):
+    return commands.add_source(app, source, on_new_app=use_recovered_app)
 
-def get_imagine_help_message():
-    return """
-    Usage: /imagine <prompt>
-    
-    Options (add with --option=value):
-    --size=1024x1024, 1536x1024, 1024x1536, or auto
-    --quality=auto, high, medium, or low
-    --output_format=png, jpeg, or webp
-    --background=auto, transparent, or opaque
-    
-    Example:
-    /imagine a cute robot --size=1024x1536 --quality=high
-    """
+def add_site(app, root, options):
+    status_text = st.empty()
+    try:
+        return commands.add_site(app, root, options, on_progress=status_text.text, on_new_app=use_recovered_app)
+    finally:
+        status_text.empty()
 
 # Add a sidebar
 st.sidebar.title(f"St Jamie v{VERSION}")
@@ -302,11 +241,42 @@ st.sidebar.markdown(photo_editor_html, unsafe_allow_html=True)
 ai_studio_html = '<a href="https://aistudio.google.com" target="_blank">Google AI Studio</a>'
 st.sidebar.markdown(ai_studio_html, unsafe_allow_html=True)
 
+with startup_profile.phase("answer cache"):
+    cache_stats = get_answer_cache().stats()
+st.sidebar.markdown("---")
+st.sidebar.caption(
+    f"Answer cache: {cache_stats['entries']} entries, "
+    f"{cache_stats['hits']} hits / {cache_stats['misses']} misses ({cache_stats['hit_rate']:.0%} hit rate)"
+)
+
 # Update the title to use the VERSION constant
 st.title(f"St Jamie v{VERSION}")
 st.caption("Your Friendly AI Club Chatbot!")
+
+def append_message(message):
+    """
+    Record a message of this session: it is queued for the session store and
+    added to the in-memory window, which keeps only the latest memory_messages.
+    """
+    message["seq"] = get_session_store().append(st.session_state.session_id, message)
+    st.session_state.messages.append(message)
+    st.session_state.message_total += 1
+    overflow = len(st.session_state.messages) - SESSION_STORE_DEFAULTS["memory_messages"]
+    if overflow > 0:
+        del st.session_state.messages[:overflow]
+        # Cached context entries are keyed by content; let them be rebuilt for the messages still in memory
+        if len(st.session_state.context_cache) > 2 * SESSION_STORE_DEFAULTS["memory_messages"]:
+            st.session_state.context_cache.clear()
+
 if "messages" not in st.session_state:
-    st.session_state.messages = [
+    with startup_profile.phase("load conversation"):
+        session_store = get_session_store()
+        st.session_state.message_total = session_store.count(st.session_state.session_id)
+        st.session_state.messages = session_store.load_recent(
+            st.session_state.session_id, SESSION_STORE_DEFAULTS["memory_messages"]
+        )
+if not st.session_state.message_total:
+    append_message(
         {
             "role": "system",
             "content": """
@@ -335,18 +305,126 @@ if "messages" not in st.session_state:
             Let's start exploring the exciting world of AI together!
             """,
         }
-    ]
+    )
 
-# Display messages
-for message in st.session_state.messages:
+def render_message(message, full_images=False):
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
         if "image_url" in message and message["image_url"]:
             st.image(message["image_url"], use_column_width=True)
+        for image_ref in message.get("image_refs") or []:
+            try:
+                store = get_image_store()
+                st.image(store.get(image_ref) if full_images else store.thumbnail(image_ref), use_column_width=True)
+            except FileNotFoundError:
+                st.caption("This image is no longer available.")
+
+def message_preview(message):
+    # Past messages never change, so each preview is computed once per session and
+    # only the short preview is kept, keyed by the message's sequence number
+    previews = st.session_state.message_previews
+    if message["seq"] not in previews:
+        text = " ".join(message["content"].split())
+        if len(text) > HISTORY_DEFAULTS["preview_chars"]:
+            text = text[:HISTORY_DEFAULTS["preview_chars"]].rsplit(" ", 1)[0] + "…"
+        text = text.replace("`", "")
+        if message.get("image_refs") or message.get("image_url"):
+            text += " 🖼️"
+        previews[message["seq"]] = f"**{message['role']}:** {text}"
+        while len(previews) > HISTORY_DEFAULTS["cached_previews"]:
+            del previews[next(iter(previews))]
+    return previews[message["seq"]]
+
+def show_more_history():
+    st.session_state.history_pages += 1
+
+def hide_history():
+    st.session_state.history_pages = 0
+
+@metrics.timed("render.history")
+def render_history(messages):
+    """
+    Render the last visible_messages messages in full. Older ones stay collapsed
+    behind a button and are revealed a page at a time as cheap one-element previews,
+    read from the session store when the in-memory window no longer holds them,
+    so rerun cost does not grow with the length of the conversation.
+    """
+    for message in messages:
         if "image_b64" in message and message["image_b64"]:
-            st.image(base64.b64decode(message["image_b64"]), use_column_width=True)
+            # Move images from older sessions out of session state on first sight
+            message["image_refs"] = [get_image_store().put(base64.b64decode(message.pop("image_b64")))]
+    visible = HISTORY_DEFAULTS["visible_messages"]
+    page_size = HISTORY_DEFAULTS["page_size"]
+    recent = messages[-visible:]
+    hidden = max(st.session_state.message_total - len(recent), 0)
+    if hidden:
+        pages = min(st.session_state.history_pages, -(-hidden // page_size))
+        start = max(hidden - pages * page_size, 0)
+        if pages:
+            older = messages[:-visible]
+            if len(older) < hidden - start:
+                older = get_session_store().load_before(st.session_state.session_id, recent[0]["seq"], hidden - start)
+            older = older[max(len(older) - (hidden - start), 0):]
+            # The store may return fewer rows than were counted; number the pages by what was loaded
+            start = hidden - len(older)
+        columns = st.columns(2)
+        if start > 0:
+            columns[0].button(f"Show earlier messages ({start} hidden)", on_click=show_more_history)
+        if pages:
+            columns[1].button("Hide earlier messages", on_click=hide_history)
+        for page_start in range(start, hidden, page_size):
+            page_end = min(page_start + page_size, hidden)
+            with st.expander(f"Messages {page_start + 1}–{page_end}"):
+                st.markdown("\n\n".join(
+                    message_preview(message) for message in older[page_start - start:page_end - start]
+                ))
+    for message in recent:
+        render_message(message)
+
+def collect_image_jobs():
+    """Show finished image jobs for this session and a status line for those still running."""
+    queue = get_image_queue()
+    still_pending = []
+    for pending in st.session_state.pending_images:
+        job = queue.get(pending["job_id"])
+        if job is not None and job["status"] in ("queued", "running"):
+            still_pending.append(pending)
+            ahead = queue.position(pending["job_id"])
+            status = f" ({ahead} ahead of you in the queue)" if ahead else ""
+            with st.chat_message("assistant"):
+                st.markdown(f"🎨 Generating your image for *{pending['prompt']}*...{status}")
+            continue
+        queue.pop(pending["job_id"])
+        if job is not None and job["status"] == "done" and job["result"]:
+            image_refs = [get_image_store().put(base64.b64decode(image_b64)) for image_b64 in job["result"]]
+            if len(image_refs) == 1:
+                content = "Here's your generated image:"
+            else:
+                content = f"Here are your {len(image_refs)} generated images:"
+            message = {"role": "assistant", "content": content, "image_refs": image_refs}
+        else:
+            message = {"role": "assistant", "content": "Sorry, I couldn't generate the image. Please try again."}
+        append_message(message)
+        render_message(message, full_images=True)
+    st.session_state.pending_images = still_pending
+
+def wait_for_image_jobs():
+    # Rerun shortly to pick up results; any chat input interrupts the wait
+    if st.session_state.pending_images:
+        time.sleep(IMAGE_POLL_INTERVAL)
+        st.rerun()
+
+def stop_run():
+    wait_for_image_jobs()
+    st.stop()
+
+# Display messages
+with startup_profile.phase("render history"):
+    render_history(st.session_state.messages)
+    collect_image_jobs()
 
-app = embedchain_bot()
+with startup_profile.phase("embedchain_bot"):
+    app = embedchain_bot()
 
 if app is None:
     st.error("Failed to initialize the application. Please check the logs and try again.")
@@ -359,51 +437,29 @@ if not st.session_state.db_initialized:
     st.success(init_message)
     st.session_state.db_initialized = True
 
+if startup_profile.ENABLED:
+    startup_profile.log_report()
+    phases, total = startup_profile.report()
+    with st.sidebar.expander("Startup profile"):
+        st.markdown("\n".join(f"- {name}: {seconds * 1000:.0f} ms" for name, seconds in phases))
+        st.caption(f"{total * 1000:.0f} ms from script start to chat input")
+
 def handle_imagine_command(prompt, **kwargs):
     """
-    Handle the /imagine command with configurable options
+    Handle the /imagine command with configurable options.
+    The request is queued and the job id returned; results are collected on a later run.
     
     Options:
     - size: '1024x1024', '1536x1024', '1024x1536', or 'auto'
     - quality: 'auto', 'high', 'medium', or 'low'
     - output_format: 'png', 'jpeg', or 'webp'
     - background: 'auto', 'transparent', or 'opaque'
+    - n: number of variants, 1 to 4
     """
-    # Extract command options if present
-    parts = prompt.split('--')
-    image_prompt = parts[0].replace("/imagine", "").strip()
-    
-    # Start with default options
-    options = IMAGE_DEFAULTS.copy()
-    
-    # Parse additional options if provided
-    if len(parts) > 1:
-        for part in parts[1:]:
-            if "=" in part:
-                key, value = part.strip().split('=')
-                if key in options:
-                    options[key] = value
-    
-    # Override with any kwargs passed directly to the function
-    options.update(kwargs)
+    image_prompt, options = parse_imagine_command(prompt, **kwargs)
     
-    try:
-        client = OpenAI(api_key=st.secrets["OPENAI_API_KEY"])
-        response = client.images.generate(
-            model="gpt-image-1.5",
-            prompt=image_prompt,
-            size=options["size"],
-            quality=options["quality"],
-            output_format=options["output_format"],
-            background=options["background"],
-            n=1
-        )
-        
-        if response and response.data:
-            return response.data[0].b64_json
-    except Exception as e:
-        logging.error(f"Error generating image: {str(e)}")
-        return None
+    session_id = st.session_state.session_id
+    return get_image_queue().submit(session_id, generate_images, image_prompt, options, get_request_scheduler(), session_id)
 
 # Main chat input handling
 if prompt := st.chat_input("Ask me anything!"):
@@ -421,52 +477,57 @@ if prompt := st.chat_input("Ask me anything!"):
             with st.chat_message("assistant"):
                 imagine_help = get_imagine_help_message()
                 st.markdown(imagine_help)
-                st.session_state.messages.append({"role": "assistant", "content": imagine_help})
-            st.stop()
+                append_message({"role": "assistant", "content": imagine_help})
+            stop_run()
 
-        message = st.chat_message("assistant")
-        placeholder = message.empty()
+        try:
+            job_id = handle_imagine_command(prompt)
+        except QueueFullError as e:
+            with st.chat_message("assistant"):
+                st.markdown(str(e))
+            append_message({"role": "user", "content": prompt})
+            append_message({"role": "assistant", "content": str(e)})
+            stop_run()
         
-        # Show processing message with spinner
-        with placeholder.container():
-            with st.spinner("🎨 Generating your image... This may take up to 30 seconds"):
-                st.markdown("*Processing your request...*")
-                image_b64 = handle_imagine_command(prompt)
-        
-        if image_b64:
-            # Replace placeholder with final content
-            placeholder.markdown("Here's your generated image:")
-            message.image(base64.b64decode(image_b64))
-            
-            # Update session state
-            st.session_state.messages.extend([
-                {"role": "user", "content": prompt},
-                {"role": "assistant", "content": "Here's your generated image:", "image_b64": image_b64}
-            ])
-        else:
-            placeholder.markdown("Sorry, I couldn't generate the image. Please try again.")
-            st.session_state.messages.extend([
-                {"role": "user", "content": prompt},
-                {"role": "assistant", "content": "Sorry, I couldn't generate the image. Please try again."}
-            ])
-        st.stop()
+        # Return straight away; the image is collected when the job finishes
+        append_message({"role": "user", "content": prompt})
+        st.session_state.pending_images.append({"job_id": job_id, "prompt": prompt.replace("/imagine", "", 1).split("--")[0].strip()})
+        st.rerun()
         
     # Handle other commands
     elif prompt.startswith("/help"):
         with st.chat_message("assistant"):
             help_message = get_help_message()
             st.markdown(help_message)
-            st.session_state.messages.append({"role": "assistant", "content": help_message})
-        st.stop()
+            append_message({"role": "assistant", "content": help_message})
+        stop_run()
     
     elif prompt.startswith("/add"):
         with st.chat_message("assistant"):
             message_placeholder = st.empty()
-            message_placeholder.markdown("Adding to knowledge base...")
-            app.add(prompt)
-            message_placeholder.markdown(f"Added {prompt} to knowledge base!")
-            st.session_state.messages.append({"role": "assistant", "content": f"Added {prompt} to knowledge base!"})
-            st.stop()
+            source, crawl_options = parse_add_command(prompt)
+            if not source:
+                add_message = "Usage: /add <source> [--crawl] (e.g., /add https://example.com)"
+            elif crawl_options is not None:
+                message_placeholder.markdown("Crawling site into the knowledge base...")
+                try:
+                    add_message = add_site(app, source, crawl_options)
+                except Exception as e:
+                    logging.error(f"Error crawling {source}: {str(e)}", exc_info=True)
+                    add_message = f"Error crawling {source}: {str(e)}"
+            else:
+                message_placeholder.markdown("Adding to knowledge base...")
+                add_message = add_source(app, source)
+            message_placeholder.markdown(add_message)
+            append_message({"role": "assistant", "content": add_message})
+            stop_run()
+
+    elif prompt.startswith("/stats"):
+        with st.chat_message("assistant"):
+            stats_message = format_stats(metrics.snapshot())
+            st.markdown(stats_message)
+            append_message({"role": "assistant", "content": stats_message})
+        stop_run()
 
     elif prompt.startswith("/list"):
         with st.chat_message("assistant"):
@@ -476,8 +537,8 @@ if prompt := st.chat_input("Ask me anything!"):
             response = get_source_list(app)
             
             message_placeholder.markdown(response)
-            st.session_state.messages.append({"role": "assistant", "content": response})
-        st.stop()
+            append_message({"role": "assistant", "content": response})
+        stop_run()
 
     elif prompt.startswith("/db"):
         # Extract the parameter
@@ -491,7 +552,7 @@ if prompt := st.chat_input("Ask me anything!"):
                 reset_message = reset_database(app)
                 
                 message_placeholder.markdown(reset_message)
-                st.session_state.messages.append({"role": "assistant", "content": reset_message})
+                append_message({"role": "assistant", "content": reset_message})
                 
                 # Reinitialize the app after reset
                 app = embedchain_bot()
@@ -508,43 +569,62 @@ if prompt := st.chat_input("Ask me anything!"):
                 app = embedchain_bot()
                 
                 message_placeholder.markdown(init_message)
-                st.session_state.messages.append({"role": "assistant", "content": init_message})
+                append_message({"role": "assistant", "content": init_message})
+        elif param.lower() == "snapshot":
+            with st.chat_message("assistant"):
+                message_placeholder = st.empty()
+                message_placeholder.markdown("Exporting the knowledge base snapshot...")
+                
+                snapshot_message = create_snapshot(app)
+                
+                message_placeholder.markdown(snapshot_message)
+                append_message({"role": "assistant", "content": snapshot_message})
+        elif param.lower() == "stats":
+            with st.chat_message("assistant"):
+                stats_message = index_stats_message(app)
+                st.markdown(stats_message)
+                append_message({"role": "assistant", "content": stats_message})
         else:
             with st.chat_message("assistant"):
-                error_message = "Invalid command. Use '/db reset' to reset the database or '/db init' to initialize it with KaPlay sources."
+                error_message = "Invalid command. Use '/db reset' to reset the database, '/db init' to initialize it with KaPlay sources, '/db snapshot' to export a snapshot or '/db stats' to show index statistics."
                 st.markdown(error_message)
-                st.session_state.messages.append({"role": "assistant", "content": error_message})
-        st.stop()
+                append_message({"role": "assistant", "content": error_message})
+        stop_run()
 
     else:
         # Regular chat flow
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        chat_started = time.perf_counter()
+        append_message({"role": "user", "content": prompt})
         
         with st.chat_message("assistant"):
             message_placeholder = st.empty()
             message_placeholder.markdown("...")
             
             try:
-                # Build context from conversation history
-                context = "\n".join([
-                    f"{msg['role']}: {msg['content']}" 
-                    for msg in st.session_state.messages[-5:]  # Last 5 messages for context
-                    if msg['role'] != 'system'  # Skip system messages
-                ])
+                from streaming import StreamingRenderer
                 
-                # Get response from embedchain with context
-                response = app.query(f"Maintain conversation context and remember user details. Be friendly and engaging. If the knowledge base provides relevant information, incorporate it naturally into your response.\nPrevious conversation:\n{context}\n\nCurrent message: {prompt}")
+                # Rendering tokens as they arrive; the history excludes the message just added
+                renderer = StreamingRenderer(message_placeholder, STREAM_FLUSH_INTERVAL)
+                response = answer_query(
+                    app, prompt, st.session_state.messages[:-1], st.session_state.context_cache,
+                    st.session_state.session_id, sink=renderer,
+                )
                 
-                # Update placeholder with final response
-                message_placeholder.markdown(response)
+                # Replace the streamed text (and its cursor) with the final response
+                response = renderer.finish(response)
                 
                 # Add assistant's response to message history
-                st.session_state.messages.append({"role": "assistant", "content": response})
+                append_message({"role": "assistant", "content": response})
                 
             except Exception as e:
+                metrics.increment("chat.errors")
                 error_message = f"Sorry, I encountered an error: {str(e)}"
                 message_placeholder.markdown(error_message)
-                st.session_state.messages.append({"role": "assistant", "content": error_message})
+                append_message({"role": "assistant", "content": error_message})
+        metrics.observe("command.chat", time.perf_counter() - chat_started)
+
+# Keep polling while this session has images being generated
+wait_for_image_jobs()
 
 # Display chat history
 # if st.session_state.messages:
@@ -0,0 +1,583 @@
+"""
+Offline benchmarks for ingestion, /list, chat, /imagine and full script reruns.
+
+Every network dependency is replaced by a local stand-in: the /db init sources
+are served from recorded copies (multiplied into synthetic corpora for the larger
+scales), OpenAI chat, embedding and image calls go to a fake endpoint with
+configurable latency, and the app embeds with a deterministic hashing embedder.
+Anything that still tries to reach the internet fails fast through a dead proxy.
+
+Usage:
+    python benchmark.py record                    # save copies of the /db init sources (needs network, once)
+    python benchmark.py run --scales 1,10,100     # corpus of 1x, 10x and 100x the /db init sources
+    python benchmark.py run --save-baseline       # store the results in bench_baseline.json
+    python benchmark.py run --compare             # fail if slower than bench_baseline.json
+"""
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+import commands
+from metrics import metrics, percentile
+
+RECORDINGS_DIR = os.path.join(ROOT, "bench_recordings")
+BASELINE_PATH = os.path.join(ROOT, "bench_baseline.json")
+
+BENCH_DEFAULTS = {
+    "scales": "1,10",  # corpus sizes as multiples of the /db init sources
+    "queries": 50,  # distinct chat questions per scale
+    "concurrency": 4,  # parallel chat and image requests
+    "list_calls": 20,
+    "images": 10,
+    "reruns": 10,  # full script reruns after the first (cold) run
+    "embed_dims": 1536,  # same width as the OpenAI embeddings
+    "llm_latency": 0.3,  # seconds before the fake LLM sends its first token
+    "token_delay": 0.005,  # seconds between streamed tokens
+    "answer_tokens": 120,
+    "image_latency": 1.0,  # seconds per fake image request
+    "tolerance": 0.2,  # fractional slowdown against the baseline that counts as a regression
+}
+
+# 1x1 transparent PNG returned by the fake image endpoint
+FAKE_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+
+QUESTION_TOPICS = ["sprites", "scenes", "collisions", "sounds", "input", "physics", "shaders", "pathfinding", "debug mode", "components"]
+QUESTION_TEMPLATES = [
+    "How do I use {} in KaPlay?",
+    "Can you explain {} with a short example?",
+    "What is the best way to organise {} in a platformer?",
+    "Why would {} slow my game down?",
+    "Show me how to combine {} with tweens.",
+]
+
+SYNTHETIC_WORDS = (
+    "kaplay game sprite scene player enemy jump move speed area body collide tween sound input key mouse "
+    "camera layer shader tile level score timer loop state component plugin debug physics gravity path "
+    "navigate asset load font text color rect circle polygon anchor scale rotate opacity fixed stay"
+).split()
+
+
+# ---------------------------------------------------------------- corpora
+
+def record():
+    """Save the /db init sources under bench_recordings/ so runs never need the network."""
+    from ingestion import http_get
+    os.makedirs(RECORDINGS_DIR, exist_ok=True)
+    manifest = {}
+    for url in commands.KAPLAY_SOURCES:
+        response = http_get(url)
+        response.raise_for_status()
+        content_type = response.headers.get("Content-Type", "text/html")
+        extension = "json" if "json" in content_type else "html"
+        name = f"{hashlib.sha1(url.encode()).hexdigest()[:16]}.{extension}"
+        with open(os.path.join(RECORDINGS_DIR, name), "wb") as f:
+            f.write(response.content)
+        manifest[url] = {"file": name, "content_type": content_type}
+        logging.info(f"Recorded {url} ({len(response.content)} bytes)")
+    with open(os.path.join(RECORDINGS_DIR, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def load_recordings():
+    """{url: (content type, body)} of the recorded sources, or {} if none were recorded."""
+    path = os.path.join(RECORDINGS_DIR, "manifest.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    recordings = {}
+    for url, entry in manifest.items():
+        with open(os.path.join(RECORDINGS_DIR, entry["file"]), "rb") as f:
+            recordings[url] = (entry["content_type"], f.read())
+    return recordings
+
+
+def synthetic_page(index, paragraphs=40):
+    words = SYNTHETIC_WORDS
+    body = []
+    for p in range(paragraphs):
+        sentence = " ".join(words[(index * 7 + p * 3 + i * i) % len(words)] for i in range(60))
+        body.append(f"<h2>Section {p}</h2><p>{sentence}.</p>")
+        if p % 5 == 0:
+            body.append(f"<pre><code>add([sprite(\"bean\"), pos({p}, {index}), area(), body()])</code></pre>")
+    return f"<html><head><title>Synthetic guide {index}</title></head><body>{''.join(body)}</body></html>".encode()
+
+
+def mutate_html(html, variant):
+    """Change every third word of the page text so copies are not caught as near-duplicates."""
+    def mutate(match):
+        words = match.group(1).split(" ")
+        return ">" + " ".join(f"{word}{variant}" if word and (i + variant) % 3 == 0 else word for i, word in enumerate(words)) + "<"
+    return re.sub(r">([^<]+)<", mutate, html.decode("utf-8", "replace")).encode("utf-8")
+
+
+def build_corpus(recordings, scale, base_url):
+    """
+    Pages for the fake server ({path: (content type, body)}) and the local source
+    URLs for ingestion: scale copies of every recorded page. doc.json is served
+    once, under a path that still ends in kaplayjs.com/doc.json.
+    """
+    if not recordings:
+        logging.warning("No recordings in bench_recordings/; using synthetic pages (run 'python benchmark.py record' once)")
+        recordings = {f"https://kaplayjs.com/guides/synthetic-{i}/": ("text/html", synthetic_page(i)) for i in range(12)}
+    pages = {}
+    sources = []
+    for url, (content_type, body) in recordings.items():
+        parsed = urlparse(url)
+        path = f"/{parsed.netloc}{parsed.path}"
+        copies = 1 if "json" in content_type else scale
+        for variant in range(copies):
+            page_path = path if variant == 0 else f"{path.rstrip('/')}/copy-{variant}/"
+            pages[page_path] = (content_type, body if variant == 0 else mutate_html(body, variant))
+            sources.append(f"{base_url}{page_path}")
+    return pages, sources
+
+
+# ---------------------------------------------------------------- local stand-ins
+
+class HashingEmbedder:
+    """Deterministic embedding function: hashed bag of words, so identical text always gets the same vector."""
+
+    def __init__(self, dims):
+        self.dims = dims
+
+    def __call__(self, input):
+        import numpy as np
+        vectors = []
+        for text in input:
+            vector = np.zeros(self.dims, dtype=np.float32)
+            for word in re.findall(r"\w+", text.lower()):
+                digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+                vector[int.from_bytes(digest[:4], "little") % self.dims] += 1.0 if digest[4] & 1 else -1.0
+            norm = np.linalg.norm(vector)
+            vectors.append((vector / norm if norm else vector).tolist())
+        return vectors
+
+
+def install_fake_embedder(app, embedder):
+    app.db.embedder.embedding_fn = embedder
+    # app.search embeds the question through the collection's own embedding function
+    app.db.collection._embedding_function = embedder
+
+
+class FakeServices(ThreadingHTTPServer):
+    """Serves the corpus pages and an OpenAI-compatible chat, embeddings and images API."""
+
+    daemon_threads = True
+
+    def __init__(self, settings, embedder):
+        super().__init__(("127.0.0.1", 0), FakeHandler)
+        self.settings = settings
+        self.embedder = embedder
+        self.pages = {}
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        page = self.server.pages.get(self.path.split("?", 1)[0])
+        if page is None:
+            self._send(404, b"{}")
+            return
+        content_type, body = page
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self._send(200, body, content_type, {"ETag": etag})
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        path = self.path.split("?", 1)[0]
+        if path.endswith("/embeddings"):
+            self._embeddings(request)
+        elif path.endswith("/chat/completions"):
+            self._chat(request)
+        elif path.endswith("/images/generations"):
+            self._images(request)
+        else:
+            self._send(404, b"{}")
+
+    def _embeddings(self, request):
+        texts = request.get("input")
+        texts = [texts] if isinstance(texts, str) else texts
+        data = []
+        for index, vector in enumerate(self.server.embedder(texts)):
+            if request.get("encoding_format") == "base64":
+                import numpy as np
+                vector = base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode()
+            data.append({"object": "embedding", "index": index, "embedding": vector})
+        payload = {"object": "list", "data": data, "model": request.get("model"), "usage": {"prompt_tokens": 0, "total_tokens": 0}}
+        self._send(200, json.dumps(payload).encode())
+
+    def _chat(self, request):
+        settings = self.server.settings
+        time.sleep(settings["llm_latency"])
+        tokens = [f"{SYNTHETIC_WORDS[i % len(SYNTHETIC_WORDS)]} " for i in range(settings["answer_tokens"])]
+        created = int(time.time())
+        if not request.get("stream"):
+            time.sleep(settings["token_delay"] * len(tokens))
+            payload = {
+                "id": "chatcmpl-bench", "object": "chat.completion", "created": created, "model": request.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+            }
+            self._send(200, json.dumps(payload).encode())
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        for index, token in enumerate(tokens + [None]):
+            delta = {"content": token} if token is not None else {}
+            if index == 0:
+                delta["role"] = "assistant"
+            chunk = {
+                "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": created, "model": request.get("model"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": None if token is not None else "stop"}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+            time.sleep(settings["token_delay"])
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def _images(self, request):
+        time.sleep(self.server.settings["image_latency"])
+        image = base64.b64encode(FAKE_PNG).decode()
+        payload = {"created": int(time.time()), "data": [{"b64_json": image} for _ in range(int(request.get("n") or 1))]}
+        self._send(200, json.dumps(payload).encode())
+
+
+# ---------------------------------------------------------------- measurement
+
+def peak_rss_mb():
+    """Peak memory of the whole run; ru_maxrss never goes down, so it is not measured per scenario."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def summarize(latencies, seconds, operations=None, **extra):
+    ordered = sorted(latencies)
+    operations = len(latencies) if operations is None else operations
+    result = {
+        "count": operations,
+        "seconds": seconds,
+        "throughput": operations / seconds if seconds else None,
+        **{f"p{int(q * 100)}_ms": (percentile(ordered, q) * 1000 if ordered else None) for q in (0.5, 0.95, 0.99)},
+    }
+    snapshot = metrics.snapshot()
+    result["phases"] = {name: {"count": stats["count"], "p95_ms": stats["p95"] * 1000} for name, stats in snapshot["timings"].items()}
+    result["counters"] = snapshot["counters"]
+    result.update(extra)
+    return result
+
+
+def timed_calls(func, items, concurrency=1):
+    """Call func(item) for every item; returns (latencies, wall seconds, errors)."""
+    latencies = []
+    errors = []
+
+    def call(item):
+        start = time.perf_counter()
+        try:
+            func(item)
+        except Exception as e:
+            errors.append(str(e))
+            return
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(call, items))
+    else:
+        for item in items:
+            call(item)
+    if errors:
+        logging.warning(f"{len(errors)} of {len(items)} calls failed, e.g. {errors[0]}")
+    return latencies, time.perf_counter() - start, errors
+
+
+def questions(count):
+    return [
+        QUESTION_TEMPLATES[i % len(QUESTION_TEMPLATES)].format(QUESTION_TOPICS[(i // len(QUESTION_TEMPLATES)) % len(QUESTION_TOPICS)])
+        + ("" if i < len(QUESTION_TEMPLATES) * len(QUESTION_TOPICS) else f" (part {i})")
+        for i in range(count)
+    ]
+
+
+# ---------------------------------------------------------------- scenarios
+
+def bench_ingest(app, sources):
+    chunks = 0
+
+    def on_result(result):
+        nonlocal chunks
+        chunks += result.get("chunks") or 0
+
+    start = time.perf_counter()
+    commands.init_database(app, on_result=on_result)
+    seconds = time.perf_counter() - start
+    return summarize([], seconds, operations=len(sources), chunks=chunks, chunks_per_second=chunks / seconds if seconds else None)
+
+
+def bench_list(app, calls):
+    commands.get_source_list(app)  # first call may rebuild the source index
+    latencies, seconds, errors = timed_calls(lambda _: commands.get_source_list(app), range(calls))
+    return summarize(latencies, seconds, errors=len(errors))
+
+
+def bench_chat(app, prompts, concurrency):
+    def ask(item):
+        index, prompt = item
+        session_id = f"bench-{index % concurrency}"
+        commands.answer_query(app, prompt, [], {}, session_id)
+
+    latencies, seconds, errors = timed_calls(ask, list(enumerate(prompts)), concurrency)
+    return summarize(latencies, seconds, errors=len(errors))
+
+
+def bench_imagine(count, concurrency):
+    from openai import OpenAI
+    client = OpenAI()
+    options = dict(commands.IMAGE_DEFAULTS)
+    scheduler = commands.get_request_scheduler()
+    # Distinct prompts, otherwise identical in-flight requests are coalesced
+    prompts = [f"a pixel art {QUESTION_TOPICS[i % len(QUESTION_TOPICS)]} number {i}" for i in range(count)]
+    latencies, seconds, errors = timed_calls(
+        lambda prompt: commands.generate_images(client, prompt, options, scheduler, "bench"), prompts, concurrency
+    )
+    return summarize(latencies, seconds, errors=len(errors))
+
+
+def check_app_run(at):
+    # AppTest records an exception in the script instead of raising it
+    if at.exception:
+        raise RuntimeError(f"app.py raised: {at.exception[0].value}")
+    return at
+
+
+def bench_reruns(reruns, prompt):
+    """Full runs of app.py through Streamlit's AppTest: one cold run, warm reruns, then a chat message."""
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=600)
+    at.secrets["OPENAI_API_KEY"] = os.environ["OPENAI_API_KEY"]
+    start = time.perf_counter()
+    at.run()
+    cold = time.perf_counter() - start
+    check_app_run(at)
+    latencies, seconds, errors = timed_calls(lambda _: check_app_run(at.run()), range(reruns))
+    start = time.perf_counter()
+    at.chat_input[0].set_value(prompt).run()
+    chat_run = time.perf_counter() - start
+    check_app_run(at)
+    return summarize(latencies, seconds, errors=len(errors), cold_run_ms=cold * 1000, chat_run_ms=chat_run * 1000)
+
+
+# ---------------------------------------------------------------- driver
+
+def reset_resources():
+    # Process-wide resources hold paths under the previous working directory
+    for name in dir(commands):
+        resource_getter = getattr(commands, name)
+        if callable(getattr(resource_getter, "clear", None)) and hasattr(resource_getter, "__wrapped__"):
+            resource_getter.clear()
+
+
+def offline_environment(base_url):
+    os.environ["OPENAI_API_KEY"] = "bench"
+    os.environ["OPENAI_BASE_URL"] = f"{base_url}/v1"
+    os.environ["OPENAI_API_BASE"] = f"{base_url}/v1"
+    # Anything not aimed at the local server hits a closed port instead of the internet
+    for name in ("HTTP_PROXY", "HTTPS_PROXY", "http_proxy", "https_proxy"):
+        os.environ[name] = "http://127.0.0.1:9"
+    os.environ["NO_PROXY"] = os.environ["no_proxy"] = "127.0.0.1,localhost"
+
+
+def run_scale(scale, server, recordings, args):
+    workdir = tempfile.mkdtemp(prefix=f"stjamie-bench-{scale}x-")
+    os.chdir(workdir)
+    shutil.copy(os.path.join(ROOT, "config.yaml"), workdir)
+    commands.DATA_DIR = os.path.join(workdir, "data")
+    reset_resources()
+    server.pages, sources = build_corpus(recordings, scale, server.base_url)
+    commands.KAPLAY_SOURCES = sources
+    logging.info(f"Scale {scale}x: {len(sources)} sources in {workdir}")
+
+    results = {}
+    app = commands.create_app()
+
+    def scenario(name, func, *func_args):
+        metrics.reset()
+        try:
+            results[name] = func(*func_args)
+        except Exception as e:
+            logging.error(f"Scenario {name} at {scale}x failed: {str(e)}", exc_info=True)
+            results[name] = {"error": str(e)}
+
+    scenario("ingest", bench_ingest, app, sources)
+    scenario("ingest.unchanged", bench_ingest, app, sources)
+    scenario("list", bench_list, app, args.list_calls)
+    prompts = questions(args.queries)
+    scenario("chat", bench_chat, app, prompts, args.concurrency)
+    scenario("chat.cached", bench_chat, app, prompts[:min(len(prompts), 10)], args.concurrency)
+    scenario("imagine", bench_imagine, args.images, args.concurrency)
+    if args.reruns:
+        scenario("rerun", bench_reruns, args.reruns, prompts[0])
+    os.chdir(ROOT)
+    if not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(report, baseline, tolerance):
+    """Lines describing regressions against the baseline: failed scenarios, new errors, slower p95, lower throughput or higher peak RSS."""
+    regressions = []
+    for key, current in report["results"].items():
+        if "error" in current:
+            regressions.append(f"{key}: failed: {current['error']}")
+            continue
+        previous = baseline["results"].get(key)
+        if not previous or "error" in previous:
+            continue
+        if current.get("errors", 0) > previous.get("errors", 0):
+            regressions.append(f"{key}: {current['errors']} failed calls vs {previous.get('errors', 0)}")
+        if current.get("p95_ms") and previous.get("p95_ms") and current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{key}: p95 {current['p95_ms']:.0f} ms vs {previous['p95_ms']:.0f} ms")
+        if current.get("throughput") and previous.get("throughput") and current["throughput"] < previous["throughput"] * (1 - tolerance):
+            regressions.append(f"{key}: throughput {current['throughput']:.2f}/s vs {previous['throughput']:.2f}/s")
+    if baseline.get("peak_rss_mb") and report["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        regressions.append(f"peak RSS {report['peak_rss_mb']:.0f} MB vs {baseline['peak_rss_mb']:.0f} MB")
+    return regressions
+
+
+def format_report(report):
+    def value(number, pattern):
+        return "-" if number is None else pattern.format(number)
+
+    lines = ["| Scenario | Count | Throughput /s | p50 ms | p95 ms | p99 ms |", "|---|---:|---:|---:|---:|---:|"]
+    for key, result in report["results"].items():
+        if "error" in result:
+            lines.append(f"| {key} | failed: {result['error']} | | | | |")
+            continue
+        lines.append(
+            f"| {key} | {result['count']} | {value(result['throughput'], '{:.2f}')} | {value(result['p50_ms'], '{:.0f}')} "
+            f"| {value(result['p95_ms'], '{:.0f}')} | {value(result['p99_ms'], '{:.0f}')} |"
+        )
+    lines.append(f"\nPeak RSS of the run: {report['peak_rss_mb']:.0f} MB")
+    return "\n".join(lines)
+
+
+def run(args):
+    settings = {name: getattr(args, name) for name in BENCH_DEFAULTS if hasattr(args, name)}
+    embedder = HashingEmbedder(args.embed_dims)
+    server = FakeServices(settings, embedder)
+    threading.Thread(target=server.serve_forever, name="bench-server", daemon=True).start()
+    offline_environment(server.base_url)
+
+    # Every app the code creates (including recovery and reruns) embeds locally
+    create_app = commands.create_app
+
+    def create_bench_app():
+        app = create_app()
+        install_fake_embedder(app, embedder)
+        return app
+
+    commands.create_app = create_bench_app
+    if not args.rate_limits:
+        # Measure the code, not the requests-per-minute budget
+        commands.MODEL_RATE_LIMITS = {}
+
+    recordings = load_recordings()
+    results = {}
+    for scale in [int(scale) for scale in args.scales.split(",")]:
+        for name, result in run_scale(scale, server, recordings, args).items():
+            results[f"{name}@{scale}x"] = result
+    server.shutdown()
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"), "settings": settings, "results": results,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    print(format_report(report))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {os.path.basename(BASELINE_PATH)}")
+    if args.compare:
+        with open(BASELINE_PATH, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print("Regressions against the baseline:")
+            print("\n".join(f"- {line}" for line in regressions))
+            return 1
+        print(f"No regressions beyond {args.tolerance:.0%} against the baseline from {baseline['created_at']}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    subcommands.add_parser("record", help="save copies of the /db init sources")
+    run_parser = subcommands.add_parser("run", help="run the benchmarks")
+    for name, default in BENCH_DEFAULTS.items():
+        run_parser.add_argument(f"--{name.replace('_', '-')}", type=type(default), default=default)
+    run_parser.add_argument("--output", help="write the full results as JSON")
+    run_parser.add_argument("--save-baseline", action="store_true")
+    run_parser.add_argument("--compare", action="store_true", help="exit 1 on a regression against the baseline")
+    run_parser.add_argument("--rate-limits", action="store_true", help="keep the per-model requests-per-minute limits")
+    run_parser.add_argument("--keep", action="store_true", help="keep the temporary working directories")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "record":
+        record()
+        return 0
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""
+Regression check for app start-up cost.
+
+Fails when app.py (or a local module it imports at top level) imports one of the
+heavy dependencies at module level, or when the top-level imports take longer
+than the budget as measured by ``python -X importtime``.
+
+Usage: python check_startup.py [--budget-ms 2500]
+"""
+import argparse
+import ast
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Only ever imported inside the functions that need them
+LAZY_MODULES = ("openai", "chromadb", "embedchain", "langchain", "langchain_core", "tiktoken", "numpy", "requests", "PIL")
+
+
+def top_level_imports(path):
+    """
+    Module names imported unconditionally at module level, including inside top-level
+    with/try blocks. Imports under a top-level if (e.g. the chat handlers) only run
+    when that branch is taken, so they are treated like function-level imports.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read(), filename=path)
+    names = []
+    pending = list(tree.body)
+    while pending:
+        node = pending.pop(0)
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            names.append(node.module)
+        elif isinstance(node, ast.With):
+            pending.extend(node.body)
+        elif isinstance(node, ast.Try):
+            pending.extend(node.body + node.orelse + node.finalbody)
+            for handler in node.handlers:
+                pending.extend(handler.body)
+    return names
+
+
+def collect_imports(entry):
+    """Follow local modules from entry and return {module: importing file}."""
+    seen = {}
+    queue = [os.path.join(ROOT, entry)]
+    visited = set()
+    while queue:
+        path = queue.pop()
+        if path in visited:
+            continue
+        visited.add(path)
+        for name in top_level_imports(path):
+            seen.setdefault(name, os.path.basename(path))
+            local_path = os.path.join(ROOT, f"{name.split('.')[0]}.py")
+            if os.path.exists(local_path):
+                queue.append(local_path)
+    return seen
+
+
+def measure_import_time(modules):
+    """Cumulative import time in ms per top-level module, via python -X importtime."""
+    code = "; ".join(f"import {module}" for module in modules)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, package = line.split("|")
+        if package.startswith("  ") or not cumulative.strip().isdigit():
+            continue  # nested import, already counted by its parent
+        timings[package.strip()] = int(cumulative.strip()) / 1000
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--budget-ms", type=float, default=2500, help="maximum total top-level import time")
+    args = parser.parse_args()
+
+    imports = collect_imports("app.py")
+    failures = []
+    for name, origin in sorted(imports.items()):
+        if name.split(".")[0] in LAZY_MODULES:
+            failures.append(f"{origin} imports {name} at module level; import it where it is used")
+
+    modules = sorted({name.split(".")[0] for name in imports} - set(LAZY_MODULES))
+    try:
+        timings = measure_import_time(modules)
+    except RuntimeError as e:
+        timings = {}
+        failures.append(f"could not measure import time: {e}")
+    total = sum(timings.values())
+    if timings:
+        print(f"Top-level imports: {total:.0f} ms (budget {args.budget_ms:.0f} ms)")
+        for package, ms in sorted(timings.items(), key=lambda item: -item[1])[:10]:
+            print(f"  {ms:8.1f} ms  {package}")
+    if total > args.budget_ms:
+        failures.append(f"top-level imports take {total:.0f} ms, over the {args.budget_ms:.0f} ms budget")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
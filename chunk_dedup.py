@@ -0,0 +1,236 @@
+import hashlib
+import logging
+import random
+
+import numpy as np
+
+from embedding_cache import text_hash
+from sqlite_store import REBUILD_PAGE_SIZE, SQLiteStore
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+def shingles(text, size):
+    """Overlapping word n-grams of the lower-cased text; empty for text shorter than one shingle."""
+    words = text.lower().split()
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class ChunkDeduplicator(SQLiteStore):
+    """
+    Finds chunks that repeat text already in the collection, exactly (hash of the
+    normalised text) or nearly (MinHash over word shingles, with LSH banding so a
+    lookup only compares against a handful of candidates).
+
+    Only the first copy is embedded and stored; every source URL that produced it
+    is kept as a back-reference, so a shared chunk is deleted only once no source
+    refers to it. State lives in SQLite under db/ beside the collection.
+    """
+
+    def __init__(self, path, threshold=0.9, num_perm=64, bands=16, shingle_size=5):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = random.Random(1)
+        self._a = np.array([rng.randrange(1, MERSENNE_PRIME) for _ in range(num_perm)], dtype=np.uint64)
+        self._b = np.array([rng.randrange(0, MERSENNE_PRIME) for _ in range(num_perm)], dtype=np.uint64)
+        # Chunks claimed during the current run but not written yet: id -> (source, hash, signature),
+        # plus the same hash and band lookups the database has
+        self._pending = {}
+        self._pending_hashes = {}
+        self._pending_bands = {}
+        super().__init__(path)
+
+    def _create(self):
+        self._conn.execute("CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, hash TEXT, signature BLOB)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS chunks_hash ON chunks (hash)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS bands (band INTEGER, key TEXT, id TEXT)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS bands_key ON bands (band, key)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS bands_id ON bands (id)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS refs (id TEXT, url TEXT, PRIMARY KEY (id, url)) WITHOUT ROWID")
+
+    def signature(self, text):
+        shingle_set = shingles(text, self.shingle_size)
+        if not shingle_set:
+            return None
+        hashes = np.array(
+            [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little") for s in shingle_set],
+            dtype=np.uint64,
+        )
+        # Universal hashing mod a Mersenne prime; uint64 overflow is harmless for hashing
+        permuted = (np.outer(self._a, hashes) + self._b[:, None]) % np.uint64(MERSENNE_PRIME)
+        return (permuted & np.uint64(MAX_HASH)).min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature):
+        return [
+            (band, signature[band * self.rows:(band + 1) * self.rows].tobytes().hex())
+            for band in range(self.bands)
+        ]
+
+    def find(self, source, text):
+        """
+        Return (canonical chunk id, signature) when text duplicates a known chunk, else
+        (None, signature). Near matches only count against other sources' chunks, so
+        an edited paragraph replaces its previous version instead of being dropped.
+        """
+        key = text_hash(text)
+        signature = self.signature(text)
+        with self._lock:
+            self._ensure_open()
+            if key in self._pending_hashes:
+                return self._pending_hashes[key], signature
+            row = self._conn.execute("SELECT id FROM chunks WHERE hash = ? LIMIT 1", (key,)).fetchone()
+            if row:
+                return row[0], signature
+            if signature is None:
+                return None, None
+            candidates = {}
+            for band_key in self._band_keys(signature):
+                for chunk_id in self._pending_bands.get(band_key, ()):
+                    candidates.setdefault(chunk_id, None)
+                for (chunk_id,) in self._conn.execute("SELECT id FROM bands WHERE band = ? AND key = ?", band_key):
+                    candidates.setdefault(chunk_id, None)
+            for chunk_id in candidates:
+                if chunk_id in self._pending:
+                    if self._pending[chunk_id][0] == source:
+                        continue
+                    candidate = self._pending[chunk_id][2]
+                else:
+                    urls = {url for (url,) in self._conn.execute("SELECT url FROM refs WHERE id = ?", (chunk_id,))}
+                    if urls == {source}:
+                        continue
+                    row = self._conn.execute("SELECT signature FROM chunks WHERE id = ?", (chunk_id,)).fetchone()
+                    if not row or row[0] is None:
+                        continue
+                    candidate = np.frombuffer(row[0], dtype=np.uint32)
+                if self._similarity(signature, candidate) >= self.threshold:
+                    return chunk_id, signature
+        return None, signature
+
+    @staticmethod
+    def _similarity(first, second):
+        # Fraction of agreeing MinHash values estimates the Jaccard similarity of the shingle sets
+        return float(np.mean(first == second))
+
+    def claim(self, source, chunk_id, text, signature):
+        """Mark a chunk as the canonical copy of its text until it is committed or forgotten."""
+        key = text_hash(text)
+        with self._lock:
+            self._pending[chunk_id] = (source, key, signature)
+            self._pending_hashes.setdefault(key, chunk_id)
+            if signature is not None:
+                for band_key in self._band_keys(signature):
+                    self._pending_bands.setdefault(band_key, set()).add(chunk_id)
+
+    def _unclaim(self, chunk_id):
+        source, key, signature = self._pending.pop(chunk_id)
+        if self._pending_hashes.get(key) == chunk_id:
+            del self._pending_hashes[key]
+        if signature is not None:
+            for band_key in self._band_keys(signature):
+                self._pending_bands[band_key].discard(chunk_id)
+                if not self._pending_bands[band_key]:
+                    del self._pending_bands[band_key]
+        return source, key, signature
+
+    def commit(self, chunk_ids):
+        """Record claimed chunks once they are in the collection."""
+        with self._lock:
+            self._ensure_open()
+            for chunk_id in chunk_ids:
+                if chunk_id not in self._pending:
+                    continue
+                source, key, signature = self._unclaim(chunk_id)
+                self._record(chunk_id, key, signature, [source])
+            self._conn.commit()
+
+    def _record(self, chunk_id, key, signature, urls):
+        blob = signature.tobytes() if signature is not None else None
+        self._conn.execute("INSERT OR REPLACE INTO chunks (id, hash, signature) VALUES (?, ?, ?)", (chunk_id, key, blob))
+        if signature is not None:
+            self._conn.executemany(
+                "INSERT INTO bands (band, key, id) VALUES (?, ?, ?)",
+                [(band, band_key, chunk_id) for band, band_key in self._band_keys(signature)],
+            )
+        self._conn.executemany("INSERT OR IGNORE INTO refs (id, url) VALUES (?, ?)", [(chunk_id, url) for url in urls])
+
+    def forget(self, source):
+        """Drop claims of a source that failed before its chunks were written."""
+        with self._lock:
+            for chunk_id in [chunk_id for chunk_id, pending in self._pending.items() if pending[0] == source]:
+                self._unclaim(chunk_id)
+
+    def add_refs(self, source, chunk_ids):
+        with self._lock:
+            self._ensure_open()
+            self._conn.executemany("INSERT OR IGNORE INTO refs (id, url) VALUES (?, ?)", [(chunk_id, source) for chunk_id in chunk_ids])
+            self._conn.commit()
+
+    def release(self, source, chunk_ids):
+        """
+        Remove source's references to chunk_ids and return the ids no source refers
+        to any more, which are the ones safe to delete from the collection.
+        """
+        unreferenced = []
+        with self._lock:
+            self._ensure_open()
+            for chunk_id in chunk_ids:
+                self._conn.execute("DELETE FROM refs WHERE id = ? AND url = ?", (chunk_id, source))
+                if self._conn.execute("SELECT 1 FROM refs WHERE id = ? LIMIT 1", (chunk_id,)).fetchone():
+                    continue
+                self._conn.execute("DELETE FROM chunks WHERE id = ?", (chunk_id,))
+                self._conn.execute("DELETE FROM bands WHERE id = ?", (chunk_id,))
+                unreferenced.append(chunk_id)
+            self._conn.commit()
+        kept = len(chunk_ids) - len(unreferenced)
+        if kept:
+            logging.info(f"Keeping {kept} chunks of {source} that other sources still share")
+        return unreferenced
+
+    def refs(self):
+        """{chunk id: source URLs} for every stored chunk, e.g. to put in a snapshot."""
+        refs = {}
+        with self._lock:
+            self._ensure_open()
+            for chunk_id, url in self._conn.execute("SELECT id, url FROM refs ORDER BY id, url"):
+                refs.setdefault(chunk_id, []).append(url)
+        return refs
+
+    def rebuild(self, collection, refs=None):
+        """
+        Record every chunk of a Chroma collection afresh, e.g. after a snapshot
+        restore. refs maps chunk ids to the sources sharing them; a chunk it does
+        not list is credited to the url in its metadata only.
+        """
+        self.clear()
+        refs = refs or {}
+        offset = 0
+        while True:
+            page = collection.get(include=["documents", "metadatas"], limit=REBUILD_PAGE_SIZE, offset=offset)
+            ids = page.get("ids") or []
+            rows = []
+            for chunk_id, document, metadata in zip(ids, page.get("documents") or [], page.get("metadatas") or []):
+                url = (metadata or {}).get("url")
+                urls = refs.get(chunk_id) or ([url] if url else [])
+                rows.append((chunk_id, text_hash(document or ""), self.signature(document or ""), urls))
+            with self._lock:
+                self._ensure_open()
+                for row in rows:
+                    self._record(*row)
+                self._conn.commit()
+            if len(ids) < REBUILD_PAGE_SIZE:
+                break
+            offset += REBUILD_PAGE_SIZE
+        logging.info(f"Chunk deduplication state rebuilt for {offset + len(ids)} chunks")
+
+    def clear(self):
+        with self._lock:
+            self._ensure_open()
+            self._pending.clear()
+            self._pending_hashes.clear()
+            self._pending_bands.clear()
+            for table in ("chunks", "bands", "refs"):
+                self._conn.execute(f"DELETE FROM {table}")
+            self._conn.commit()
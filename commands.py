@@ -0,0 +1,792 @@
+"""
+Knowledge base and chat commands shared by the Streamlit app (app.py) and the
+headless API (api_server.py). Nothing here imports Streamlit; progress and status
+are reported through the optional callbacks the callers pass in.
+"""
+import functools
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import nullcontext
+
+from source_index import SourceIndex
+from session_store import SessionStore
+from kaplay_symbols import KAPLAY_SYMBOLS_TYPE, SymbolIndex, format_symbol, symbol_chunks
+from metrics import metrics
+from index_maintenance import (
+    IndexMaintenance, MaintenanceGate, StoreLock, apply_hnsw_settings, format_index_stats, index_stats,
+)
+
+# Define the version number as a constant
+VERSION = "1.5"
+
+IMAGE_DEFAULTS = {
+    "size": "1024x1024",  # 1024x1024, 1536x1024, 1024x1536, or auto
+    "quality": "auto",  # auto, high, medium, or low
+    "output_format": "png",  # png, jpeg, or webp
+    "background": "auto",  # auto, transparent, or opaque
+    "n": "1",  # number of variants, 1 to IMAGE_MAX_VARIANTS
+}
+IMAGE_MAX_VARIANTS = 4
+IMAGE_MODEL = "gpt-image-1.5"
+
+SESSION_STORE_DEFAULTS = {
+    "memory_messages": 50,  # most recent messages kept in session state; older ones are read from disk when shown
+    "batch_size": 20,  # pending messages that trigger a write
+    "flush_interval": 2.0,  # seconds before pending messages are written anyway
+}
+
+# Conversations are stored here; point STJAMIE_DATA_DIR at a shared volume when running several replicas
+DATA_DIR = os.environ.get("STJAMIE_DATA_DIR", os.path.join(os.getcwd(), "data"))
+
+ANSWER_CACHE_DEFAULTS = {
+    "similarity_threshold": 0.95,  # cosine similarity needed to reuse an answer
+    "ttl_seconds": 7 * 24 * 3600,  # answers older than this are recomputed
+    "max_entries": 500,  # least recently used answers are evicted beyond this
+}
+
+CONTEXT_DEFAULTS = {
+    "budget_tokens": 1500,  # tokens of recent conversation sent with each query
+    "summary_tokens": 300,  # tokens for the one-line-per-message summary of older turns
+    "max_code_lines": 12,  # longer code blocks in the history are cut to this many lines
+}
+
+RETRIEVAL_DEFAULTS = {
+    "top_k": 4,  # chunks sent to the LLM with each question
+    "candidates": 20,  # chunks taken from each of the vector and BM25 rankings before fusion
+    "rrf_k": 60,  # reciprocal-rank fusion constant; larger flattens the rank weighting
+}
+
+SCHEDULER_DEFAULTS = {
+    "max_concurrency": 8,  # chat and image API calls in flight across all sessions
+    "max_queued": 200,  # calls waiting for a slot before new ones are turned away
+    "queue_timeout": 120,  # seconds a call may wait for a slot
+    "retries": 4,  # extra attempts after a 429 response
+    "backoff": 1.0,  # seconds before the first retry, doubled each time and jittered
+}
+
+MAINTENANCE_DEFAULTS = {
+    "interval": 6 * 3600,  # seconds between background maintenance runs
+    "orphan_grace": 3600,  # segment directories unknown to Chroma for less than this are left alone
+    "vacuum_free_ratio": 0.2,  # VACUUM a SQLite file once this share of its pages is free
+    "wait_timeout": 600,  # seconds a run waits for knowledge base writes to finish before trying again later
+}
+
+# Requests per minute per model; keep these under the OpenAI account's tier limits
+MODEL_RATE_LIMITS = {
+    "chatgpt-4o-latest": 500,
+    IMAGE_MODEL: 50,
+}
+
+# The KaPlay sources /db init adds to the knowledge base
+KAPLAY_SOURCES = [
+    "https://kaplayjs.com/guides/creating_your_first_game/",
+    "https://kaplayjs.com/guides/starting/",
+    "https://kaplayjs.com/guides/components/",
+    "https://kaplayjs.com/guides/sprites/",
+    "https://kaplayjs.com/guides/audio/",
+    "https://kaplayjs.com/guides/input/",
+    "https://kaplayjs.com/guides/debug_mode/",
+    "https://kaplayjs.com/guides/optimization/",
+    "https://kaplayjs.com/guides/pathfinding/",
+    "https://kaplayjs.com/guides/physics/",
+    "https://kaplayjs.com/guides/shaders/",
+    "https://kaplayjs.com/doc/kaplay/",
+    "https://kaplayjs.com/doc.json"
+]
+
+QUERY_INSTRUCTIONS = "Maintain conversation context and remember user details. Be friendly and engaging. If the knowledge base provides relevant information, incorporate it naturally into your response."
+
+
+class ReadOnlyError(Exception):
+    pass
+
+
+# API reader workers set this; they answer queries but never touch the stored knowledge base
+read_only = False
+
+# Index maintenance runs only between knowledge base writes
+maintenance_gate = MaintenanceGate()
+
+
+def process_resource(func):
+    """
+    One value per process, built on first use, like st.cache_resource with
+    underscore arguments: the arguments are used to build it but not as a key.
+    """
+    lock = threading.Lock()
+    cache = []
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with lock:
+            if not cache:
+                cache.append(func(*args, **kwargs))
+            return cache[0]
+
+    wrapper.clear = cache.clear
+    return wrapper
+
+
+@process_resource
+def get_request_scheduler():
+    # Shared by every session so bursts are queued fairly instead of tripping rate limits
+    from request_scheduler import RequestScheduler
+    return RequestScheduler(rate_limits=MODEL_RATE_LIMITS, **SCHEDULER_DEFAULTS)
+
+
+@process_resource
+def get_session_store():
+    store_options = {k: v for k, v in SESSION_STORE_DEFAULTS.items() if k != "memory_messages"}
+    return SessionStore(os.path.join(DATA_DIR, "sessions.sqlite3"), **store_options)
+
+
+@process_resource
+def get_embedding_cache():
+    # Outside db/ so that resets and lost collections never throw embeddings away
+    from embedding_cache import EmbeddingCache
+    return EmbeddingCache(os.path.join(os.getcwd(), "embedding_cache.sqlite3"))
+
+
+@process_resource
+def get_answer_cache():
+    # Shared by every session in this process
+    from answer_cache import AnswerCache
+    return AnswerCache(os.path.join(os.getcwd(), "answer_cache.sqlite3"), **ANSWER_CACHE_DEFAULTS)
+
+
+@process_resource
+def get_lexical_index(app):
+    # BM25 index beside the Chroma store; built once from the collection if it predates the index
+    from lexical_index import LexicalIndex
+    index = LexicalIndex(os.path.join(os.getcwd(), "db", "lexical_index.sqlite3"))
+    try:
+        if not read_only and not index.count() and app.db.count():
+            logging.info(f"Built BM25 index for {index.rebuild(app.db.collection)} chunks")
+    except Exception as e:
+        logging.warning(f"Could not build BM25 index: {str(e)}")
+    return index
+
+
+@process_resource
+def get_chunk_deduplicator():
+    from chunk_dedup import ChunkDeduplicator
+    return ChunkDeduplicator(os.path.join(os.getcwd(), "db", "chunk_dedup.sqlite3"))
+
+
+@process_resource
+def get_symbol_index(app):
+    # Built once per process from the per-symbol chunks' metadata
+    try:
+        index = SymbolIndex.from_collection(app.db.collection)
+        logging.info(f"Loaded {len(index)} KaPlay symbols")
+        return index
+    except Exception as e:
+        logging.warning(f"KaPlay symbol index unavailable: {str(e)}")
+        return SymbolIndex()
+
+
+def get_generation_path():
+    return os.path.join(os.getcwd(), "kb_generation")
+
+
+def knowledge_base_generation():
+    """Changes whenever any process modifies the knowledge base; readers reopen the store when it does."""
+    try:
+        return os.stat(get_generation_path()).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def knowledge_base_changed():
+    # Anything derived from the collection is stale now, here and in every other process
+    get_answer_cache().clear()
+    get_symbol_index.clear()
+    with open(get_generation_path(), "w", encoding="utf-8") as f:
+        f.write(f"{time.time()}\n")
+
+
+def source_data_type(source, default=None):
+    from embedchain.utils.misc import detect_datatype
+    if source.rstrip("/").endswith("kaplayjs.com/doc.json"):
+        return KAPLAY_SYMBOLS_TYPE
+    return default or detect_datatype(source).value
+
+
+def create_app():
+    # from embedchain import App
+    from embedchain.pipeline import Pipeline as App
+    import yaml
+    with open("config.yaml", encoding="utf-8") as f:
+        config = yaml.safe_load(f)
+    # Our own section; embedchain rejects keys it does not know
+    hnsw_settings = config.pop("hnsw", None)
+    # Held for the life of the process so other processes' maintenance leaves the store alone
+    get_store_lock()
+    app = App.from_config(config=config)
+    if hnsw_settings and not read_only:
+        try:
+            apply_hnsw_settings(app, hnsw_settings)
+        except Exception as e:
+            logging.warning(f"Could not apply HNSW settings: {str(e)}")
+    return app
+
+
+def reopen_app(previous=None):
+    """
+    A fresh app whose Chroma client reloads the store from disk, picking up another
+    process's writes. Returns it with a function that stops the Chroma system behind
+    previous (its loaded index, connections and threads); call that once nothing
+    uses previous any more.
+    """
+    try:
+        # Read before the cache is cleared; afterwards the old client resolves to the new system
+        system = previous.db.client._system if previous is not None else None
+    except (AttributeError, KeyError):
+        system = None
+    try:
+        from chromadb.api.client import SharedSystemClient
+        # Chroma keeps one system per path per process; drop it so the index is read again
+        SharedSystemClient.clear_system_cache()
+    except (ImportError, AttributeError) as e:
+        logging.warning(f"Could not clear the Chroma client cache: {str(e)}")
+    get_symbol_index.clear()
+    get_answer_cache.clear()
+
+    def stop_previous():
+        if system is None:
+            return
+        try:
+            system.stop()
+        except Exception as e:
+            logging.warning(f"Could not stop the previous Chroma system: {str(e)}")
+
+    return create_app(), stop_previous
+
+
+def get_manifest():
+    # Kept beside db/ rather than inside it; every reset path clears it explicitly
+    from ingestion import SourceManifest
+    return SourceManifest(os.path.join(os.getcwd(), "ingest_manifest.json"))
+
+
+def get_source_index():
+    return SourceIndex(os.path.join(os.getcwd(), "db", "source_index.json"))
+
+
+def check_writable():
+    if read_only:
+        raise ReadOnlyError("This worker serves queries only; knowledge base changes go to the writer process.")
+
+
+def writes_knowledge_base(func):
+    """Marks a command that modifies the stored knowledge base."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        check_writable()
+        with maintenance_gate.write():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def get_db_path():
+    return os.path.join(os.getcwd(), "db")
+
+
+@process_resource
+def get_store_lock():
+    # Next to db/ rather than in it, since resets delete db/ with everything in it
+    return StoreLock(os.path.join(os.getcwd(), "db.lock"))
+
+
+@process_resource
+def get_index_maintenance():
+    return IndexMaintenance(get_db_path(), maintenance_gate, store_lock=get_store_lock(), **MAINTENANCE_DEFAULTS)
+
+
+def index_stats_message(app):
+    try:
+        cache = get_embedding_cache().stats()
+        return (
+            format_index_stats(index_stats(app, get_db_path()), get_index_maintenance().last_run)
+            + f"\n- Embedding cache: {cache['entries']} vectors, {cache['hits']} hits / {cache['misses']} misses since start"
+        )
+    except Exception as e:
+        logging.error(f"Error reading index stats: {str(e)}", exc_info=True)
+        return f"An error occurred while reading the index stats: {str(e)}"
+
+
+@writes_knowledge_base
+def reset_chroma_storage():
+    db_path = get_db_path()
+    if os.path.exists(db_path):
+        shutil.rmtree(db_path)
+    os.makedirs(db_path, exist_ok=True)
+    get_manifest().clear()
+
+
+def ensure_chroma_storage():
+    sqlite_path = os.path.join(get_db_path(), "chroma.sqlite3")
+    if not os.path.exists(sqlite_path):
+        return
+    try:
+        with sqlite3.connect(sqlite_path) as conn:
+            cursor = conn.execute("PRAGMA table_info(collections);")
+            columns = {row[1] for row in cursor.fetchall()}
+        if "config_json_str" not in columns:
+            reset_chroma_storage()
+    except Exception as e:
+        # Leave the storage alone; if Chroma cannot open it either, embedchain_bot
+        # rebuilds it from the validated snapshot rather than wiping it blindly.
+        logging.warning(f"Could not inspect Chroma schema: {str(e)}")
+
+
+def get_snapshot_path():
+    return os.path.join(os.getcwd(), "kb_snapshot.jsonl.gz")
+
+
+@metrics.timed("db.restore")
+@writes_knowledge_base
+def restore_knowledge_base(app, notify=None, spinner=None):
+    """
+    Fill an empty collection from kb_snapshot.jsonl.gz, if one has been committed
+    (none ships with the repository). Returns True if it was restored.
+    notify(text) is told why a snapshot was not used; spinner(text) wraps the restore.
+    """
+    from kb_snapshot import read_manifest, restore_snapshot, validate_manifest
+    path = get_snapshot_path()
+    if not os.path.exists(path):
+        return False
+    try:
+        manifest = read_manifest(path)
+        ok, reason = validate_manifest(manifest, app)
+        if not ok:
+            logging.warning(f"Not restoring knowledge base snapshot: {reason}")
+            if notify is not None:
+                notify(f"Bundled knowledge base snapshot not used ({reason}). Crawling sources instead.")
+            return False
+        with (spinner or nullcontext)(f"Restoring knowledge base snapshot ({manifest['count']} chunks)..."):
+            restore_snapshot(app, path)
+        if manifest.get("sources"):
+            get_source_index().save(manifest["sources"])
+        else:
+            get_source_index().rebuild(app.db.collection)
+        if manifest.get("ingest_manifest"):
+            ingest_manifest = get_manifest()
+            ingest_manifest.entries = manifest["ingest_manifest"]
+            ingest_manifest.save()
+        lexical_index = get_lexical_index(app)
+        if lexical_index.count() != app.db.count():
+            lexical_index.rebuild(app.db.collection)
+        # Without the shared-chunk references, re-adding one source would delete chunks others still use
+        get_chunk_deduplicator().rebuild(app.db.collection, manifest.get("chunk_refs"))
+        knowledge_base_changed()
+        return True
+    except Exception as e:
+        logging.error(f"Error restoring knowledge base snapshot: {str(e)}", exc_info=True)
+        return False
+
+
+@metrics.timed("db.snapshot")
+def create_snapshot(app):
+    from kb_snapshot import export_snapshot
+    try:
+        manifest = export_snapshot(app, get_snapshot_path(), extra={
+            "app_version": VERSION,
+            "sources": get_source_index().load(),
+            "ingest_manifest": get_manifest().entries,
+            "chunk_refs": get_chunk_deduplicator().refs(),
+        })
+        return f"Snapshot saved to {os.path.basename(get_snapshot_path())} ({manifest['count']} chunks, {manifest['embedder']})."
+    except Exception as e:
+        logging.error(f"Error creating snapshot: {str(e)}", exc_info=True)
+        return f"Error creating snapshot: {str(e)}"
+
+
+@metrics.timed("db.reset")
+@writes_knowledge_base
+def reset_database(app):
+    from ingestion import forget_data_sources
+    try:
+        client = app.db.client
+        collections = client.list_collections()
+        for collection in collections:
+            client.delete_collection(collection.name)
+        get_manifest().clear()
+        get_source_index().clear()
+        get_lexical_index(app).clear()
+        get_chunk_deduplicator().clear()
+        forget_data_sources(app)
+        knowledge_base_changed()
+        return "Database reset successfully. All collections have been deleted."
+    except Exception as e:
+        error_text = str(e)
+        if "no such column: collections.config_json_str" in error_text:
+            reset_chroma_storage()
+            knowledge_base_changed()
+            return "Database reset successfully by rebuilding storage."
+        return f"Error resetting database: {error_text}"
+
+
+def ingestion_pipeline(app, manifest=None):
+    from ingestion import IngestionPipeline
+    check_writable()
+    return IngestionPipeline(
+        app, create_app, reset_database, manifest=manifest, embedding_cache=get_embedding_cache(),
+        loaders={KAPLAY_SYMBOLS_TYPE: symbol_chunks}, lexical_index=get_lexical_index(app),
+        deduplicator=get_chunk_deduplicator(),
+    )
+
+
+@metrics.timed("db.init")
+@writes_knowledge_base
+def init_database(app, on_result=None, on_new_app=None):
+    """
+    Add the KaPlay sources to the knowledge base and return a summary.
+    on_result(result) is called as each source finishes; on_new_app(app) if the
+    app had to be recreated while recovering from a lost collection.
+    """
+    logging.info("Starting init_database function")
+    successful_sources = 0
+    failed_sources = []
+    skipped_sources = []
+
+    def record(result):
+        nonlocal successful_sources
+        source = result["source"]
+        if result["status"] == "unchanged":
+            skipped_sources.append(source)
+            logging.info(f"Unchanged since last init, skipped: {source}")
+        elif result["status"] == "added":
+            successful_sources += 1
+            logging.info(f"Successfully added: {source} ({result['chunks']} new chunks)")
+        else:
+            failed_sources.append((source, result["error"]))
+        if on_result is not None:
+            on_result(result)
+
+    pipeline = ingestion_pipeline(app, manifest=get_manifest())
+    # doc.json is split into one compact chunk per API symbol instead of generic web page text
+    results = pipeline.run([(source, source_data_type(source, "web_page")) for source in KAPLAY_SOURCES], on_result=record)
+    get_source_index().record(results)
+    if any(result["status"] == "added" and result["chunks"] for result in results):
+        knowledge_base_changed()
+    if pipeline.app is not app and on_new_app is not None:
+        on_new_app(pipeline.app)
+
+    summary = f"Database initialization completed.\n"
+    summary += f"Successfully added: {successful_sources}\n"
+    summary += f"Unchanged (skipped): {len(skipped_sources)}\n"
+    summary += f"Failed to add: {len(failed_sources)}\n"
+    summary += f"Total sources processed: {len(KAPLAY_SOURCES)}"
+    duplicates = sum(result.get("duplicates", 0) for result in results)
+    if duplicates:
+        saved_kb = sum(result.get("saved_bytes", 0) for result in results) / 1024
+        summary += f"\nDuplicate chunks skipped: {duplicates} ({saved_kb:.1f} KB and {duplicates} embeddings saved)"
+
+    logging.info(f"init_database completed. Summary: {summary}")
+    return summary
+
+
+@metrics.timed("command.add")
+@writes_knowledge_base
+def add_source(app, source, on_new_app=None):
+    logging.info(f"Adding source: {source}")
+    data_type = source_data_type(source)
+    pipeline = ingestion_pipeline(app)
+    results = pipeline.run([(source, data_type)])
+    if pipeline.app is not app and on_new_app is not None:
+        on_new_app(pipeline.app)
+    get_source_index().record(results)
+    result = results[0]
+    if result["status"] == "failed":
+        return f"Error adding {source}: {result['error']}"
+    knowledge_base_changed()
+    if result.get("duplicates"):
+        return f"Added {source} to knowledge base! Skipped {result['duplicates']} chunks already stored from other sources."
+    return f"Added {source} to knowledge base!"
+
+
+@metrics.timed("command.add_site")
+@writes_knowledge_base
+def add_site(app, root, options, on_progress=None, on_new_app=None):
+    """Crawl a sitemap or site root and ingest every page found, as the pages arrive."""
+    from site_crawler import SiteCrawler
+    logging.info(f"Crawling site: {root} with options {options}")
+    crawler = SiteCrawler(root, **options)
+    counts = {"added": 0, "unchanged": 0, "failed": 0}
+
+    def on_result(result):
+        counts[result["status"]] += 1
+        if result["status"] == "failed":
+            logging.error(f"Error adding crawled page {result['source']}: {result['error']}")
+        if on_progress is not None:
+            on_progress(
+                f"Crawling {root}: {sum(counts.values())} pages processed "
+                f"({counts['added']} added, {counts['unchanged']} unchanged, {counts['failed']} failed)"
+            )
+
+    pipeline = ingestion_pipeline(app, manifest=get_manifest())
+    results = pipeline.run(crawler.sources(), on_result=on_result)
+    if pipeline.app is not app and on_new_app is not None:
+        on_new_app(pipeline.app)
+    get_source_index().record(results)
+    if counts["added"]:
+        knowledge_base_changed()
+    if not results:
+        return f"No pages found to add under {root}" + (f" ({pipeline.feed_error})" if pipeline.feed_error else ".")
+
+    summary = f"Crawled {root}: {len(results)} pages.\n"
+    summary += f"Added: {counts['added']}\n"
+    summary += f"Unchanged (skipped): {counts['unchanged']}\n"
+    summary += f"Failed: {counts['failed']}"
+    if crawler.disallowed:
+        summary += f"\nSkipped by robots.txt: {crawler.disallowed}"
+    duplicates = sum(result.get("duplicates", 0) for result in results)
+    if duplicates:
+        summary += f"\nDuplicate chunks skipped: {duplicates}"
+    return summary
+
+
+def parse_add_command(prompt):
+    """Split '/add <source> --crawl --depth=2' into the source and crawl options (None for a single source)."""
+    from site_crawler import CRAWL_DEFAULTS, is_sitemap
+    parts = prompt.replace("/add", "", 1).split("--")
+    source = parts[0].strip()
+    options = CRAWL_DEFAULTS.copy()
+    crawl = is_sitemap(source)
+    for part in parts[1:]:
+        part = part.strip()
+        if part == "crawl":
+            crawl = True
+        elif "=" in part:
+            key, value = part.split("=", 1)
+            if key in options:
+                options[key] = value
+                crawl = True
+    return source, options if crawl else None
+
+
+@metrics.timed("command.list")
+def get_source_list(app):
+    logging.info("Starting get_source_list function")
+    try:
+        index = get_source_index()
+        if index.exists():
+            sources = index.load()
+        elif read_only:
+            # Only the writer rebuilds the index
+            sources = {}
+        else:
+            # Index missing (e.g. a database created before it existed); rebuild it once
+            try:
+                sources = index.rebuild(app.db.collection)
+            except StopIteration:
+                logging.warning("No documents found in the database (StopIteration)")
+                return "The database is currently empty. You may need to initialize the database using '/db init'."
+            except Exception as e:
+                logging.error(f"Error rebuilding source index: {str(e)}", exc_info=True)
+                return f"An error occurred while retrieving documents: {str(e)}"
+
+        logging.info(f"Found {len(sources)} unique sources")
+
+        if sources:
+            lines = []
+            for source in sorted(sources):
+                entry = sources[source]
+                details = f"{entry['chunks']} chunks"
+                if entry.get("ingested_at"):
+                    details += f", added {time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['ingested_at']))}"
+                lines.append(f"- {source} ({details})")
+            source_list = "\n".join(lines)
+            response = f"Here's the list of sources currently in the database:\n\n{source_list}"
+        else:
+            response = "No sources found in the database. You may need to initialize the database using '/db init'."
+
+        logging.info(f"Returning response: {response[:100]}...")  # Log first 100 characters of response
+        return response
+    except Exception as e:
+        logging.error(f"Error in get_source_list: {str(e)}", exc_info=True)
+        return f"An error occurred while retrieving the sources: {str(e)}"
+
+
+def get_help_message():
+    return """
+    Available commands:
+    /help - Show this help message
+    /add <source> - Add a new source to the knowledge base (e.g., /add https://example.com)
+        Add --crawl to ingest a whole site (sitemap URLs are always crawled):
+        --depth=2 (link hops when there is no sitemap), --max_pages=200, --scope=/guides/
+        Example: /add https://kaplayjs.com/guides/ --crawl --max_pages=50
+    /list - List all sources currently in the database
+    /stats - Show latency percentiles and counters for retrieval, LLM calls, ingestion and images
+    /db reset - Reset the database (delete all data)
+    /db init - Initialize the database with default KaPlay sources
+    /db snapshot - Export the knowledge base to kb_snapshot.jsonl.gz for fast cold starts
+    /db stats - Show collection sizes, segments, disk usage and orphaned index files
+    /imagine <prompt> - Generate an image using GPT Image (latest)
+        Options (add with --option=value):
+        --size=1024x1024, 1536x1024, 1024x1536, or auto
+        --quality=auto, high, medium, or low
+        --output_format=png, jpeg, or webp
+        --background=auto, transparent, or opaque
+        --n=1 to 4 (number of variants)
+        Example: /imagine a cute robot --size=1024x1536 --quality=high
+
+    You can also ask me anything about AI, game development, or related topics!
+    """
+
+
+def get_imagine_help_message():
+    return """
+    Usage: /imagine <prompt>
+
+    Options (add with --option=value):
+    --size=1024x1024, 1536x1024, 1024x1536, or auto
+    --quality=auto, high, medium, or low
+    --output_format=png, jpeg, or webp
+    --background=auto, transparent, or opaque
+    --n=1 to 4 (number of variants)
+
+    Example:
+    /imagine a cute robot --size=1024x1536 --quality=high
+    """
+
+
+def parse_imagine_command(prompt, **kwargs):
+    """Split '/imagine <prompt> --size=...' into the image prompt and the image options."""
+    # Extract command options if present
+    parts = prompt.split('--')
+    image_prompt = parts[0].replace("/imagine", "").strip()
+
+    # Start with default options
+    options = IMAGE_DEFAULTS.copy()
+
+    # Parse additional options if provided
+    if len(parts) > 1:
+        for part in parts[1:]:
+            if "=" in part:
+                key, value = part.strip().split('=')
+                if key in options:
+                    options[key] = value
+
+    # Override with any kwargs passed directly to the function
+    options.update(kwargs)
+    return image_prompt, options
+
+
+@metrics.timed("image.generate")
+def generate_images(client, image_prompt, options, scheduler, session_id):
+    from request_scheduler import request_key
+    try:
+        n = max(1, min(int(options["n"]), IMAGE_MAX_VARIANTS))
+    except ValueError:
+        n = 1
+
+    def request(stream):
+        return client.images.generate(
+            model=IMAGE_MODEL,
+            prompt=image_prompt,
+            size=options["size"],
+            quality=options["quality"],
+            output_format=options["output_format"],
+            background=options["background"],
+            n=n
+        )
+
+    # Identical requests already being generated share that result
+    response = scheduler.call(session_id, IMAGE_MODEL, request, key=request_key(IMAGE_MODEL, image_prompt, sorted(options.items())))
+    if response and response.data:
+        return [item.b64_json for item in response.data]
+    return []
+
+
+def answer_query(app, prompt, history, context_cache, session_id, sink=None):
+    """
+    Answer a chat message: from the semantic answer cache when a near-identical
+    question opened another conversation, otherwise by the LLM over hybrid
+    retrieval results, with history (the conversation before prompt) as context.
+    Streamed tokens go to sink when given.
+    """
+    from context_builder import ContextBuilder
+    from embedding_cache import embedder_signature
+    from lexical_index import hybrid_contexts
+    from request_scheduler import request_key
+    from streaming import streaming_llm
+
+    # The cache is shared by every session and keyed on the message alone, so it only
+    # serves opening questions: a follow-up's answer depends on that conversation
+    cacheable = not any(message["role"] == "user" for message in history)
+    answer_cache = get_answer_cache()
+    response = None
+    try:
+        with metrics.timer("chat.embed_query"):
+            prompt_embedding = get_embedding_cache().embed(
+                embedder_signature(app), [prompt], app.db.embedder.embedding_fn
+            )[0]
+    except Exception as e:
+        logging.warning(f"Could not embed the message: {str(e)}")
+        prompt_embedding = None
+    if cacheable and prompt_embedding is not None:
+        try:
+            response = answer_cache.lookup(prompt_embedding)
+            metrics.increment("chat.answer_cache.hit" if response is not None else "chat.answer_cache.miss")
+        except Exception as e:
+            logging.warning(f"Answer cache unavailable: {str(e)}")
+    if response is not None:
+        return response
+
+    context = ContextBuilder(**CONTEXT_DEFAULTS).build(history, context_cache)
+
+    # Exact API entries for any KaPlay symbols the user mentioned
+    symbols = get_symbol_index(app).find_in_text(prompt)
+    reference = ""
+    if symbols:
+        logging.info(f"Injecting KaPlay symbols: {', '.join(record['name'] for record in symbols)}")
+        reference = "KaPlay API reference:\n" + "\n\n".join(format_symbol(record) for record in symbols) + "\n\n"
+
+    query_text = f"{QUERY_INSTRUCTIONS}\n{reference}Previous conversation:\n{context}\n\nCurrent message: {prompt}"
+    contexts = None
+    if prompt_embedding is not None:
+        # Retrieve on the message itself, fusing vector and BM25 rankings
+        try:
+            with metrics.timer("chat.retrieval"):
+                contexts = hybrid_contexts(
+                    app, get_lexical_index(app), prompt, prompt_embedding, **RETRIEVAL_DEFAULTS
+                )
+        except Exception as e:
+            logging.warning(f"Hybrid retrieval failed, using vector search only: {str(e)}")
+
+    if contexts is None:
+        try:
+            with metrics.timer("chat.retrieval"):
+                contexts = [result["context"] for result in app.search(prompt, num_documents=RETRIEVAL_DEFAULTS["top_k"])]
+        except Exception as e:
+            logging.warning(f"Vector search failed, answering without the knowledge base: {str(e)}")
+            contexts = []
+
+    def ask_llm(stream):
+        # Whichever provider config.yaml names, streamed through a per-call copy of it
+        answer = streaming_llm(app, stream).query(input_query=query_text, contexts=contexts)
+        if not isinstance(answer, str):
+            # Providers that do not call back return a token generator instead
+            answer = stream.consume(answer)
+        return answer
+
+    # Queued fairly with other sessions; an identical question already in flight is shared
+    model = app.llm.config.model
+    with metrics.timer("chat.llm"):
+        response = get_request_scheduler().call(
+            session_id, model, ask_llm, key=request_key(model, query_text, contexts), sink=sink,
+        )
+    time_to_first_token = getattr(sink, "time_to_first_token", None)
+    if time_to_first_token is not None:
+        metrics.observe("chat.time_to_first_token", time_to_first_token)
+        logging.info(f"Time to first token: {time_to_first_token:.2f}s")
+
+    if cacheable and prompt_embedding is not None:
+        answer_cache.store(prompt, prompt_embedding, response)
+    return response
@@ -0,0 +1,111 @@
+import hashlib
+import re
+
+CODE_BLOCK_PATTERN = re.compile(r"```([^\n`]*)\n(.*?)```", re.DOTALL)
+
+_encoding = None
+
+
+def _get_encoding():
+    # Loading the BPE tables is slow, so wait until the first count
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            # tiktoken is optional; fall back to the usual ~4 characters per token estimate
+            _encoding = False
+    return _encoding
+
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def elide_code_blocks(text, max_lines):
+    """Shorten fenced code blocks to their first max_lines lines."""
+    def replace(match):
+        language, body = match.group(1), match.group(2)
+        lines = body.splitlines()
+        if len(lines) <= max_lines:
+            return match.group(0)
+        kept = "\n".join(lines[:max_lines])
+        return f"```{language}\n{kept}\n... ({len(lines) - max_lines} more lines omitted)\n```"
+    return CODE_BLOCK_PATTERN.sub(replace, text)
+
+
+def summarize_message(role, content, max_chars=160):
+    """One-line extractive summary of a message: code blocks replaced by a marker, text cut to max_chars."""
+    text = CODE_BLOCK_PATTERN.sub(lambda match: f"[{match.group(1).strip() or 'code'} block]", content)
+    text = " ".join(text.split())
+    if len(text) > max_chars:
+        text = text[:max_chars].rsplit(" ", 1)[0] + "..."
+    return f"- {role}: {text}"
+
+
+class ContextBuilder:
+    """
+    Builds the conversation context sent with each query within a token budget.
+
+    Recent messages are added newest first, with large code blocks elided, until
+    the budget is spent. Everything older is represented by one summary line per
+    message, capped at summary_tokens and keeping the most recent lines. Per
+    message work (eliding, counting, summarising) is cached in the dict passed
+    to build, so each message is processed once for the whole session.
+    """
+
+    def __init__(self, budget_tokens=1500, summary_tokens=300, max_code_lines=12):
+        self.budget_tokens = budget_tokens
+        self.summary_tokens = summary_tokens
+        self.max_code_lines = max_code_lines
+
+    def _entry(self, message, cache):
+        key = hashlib.sha1(f"{message['role']}\n{message['content']}".encode()).hexdigest()
+        entry = cache.get(key)
+        if entry is None:
+            text = f"{message['role']}: {elide_code_blocks(message['content'], self.max_code_lines)}"
+            entry = {"text": text, "tokens": count_tokens(text)}
+            cache[key] = entry
+        return entry
+
+    def _summary_line(self, message, entry):
+        if "summary" not in entry:
+            summary = summarize_message(message["role"], message["content"])
+            entry["summary"] = summary
+            entry["summary_tokens"] = count_tokens(summary)
+        return entry["summary"], entry["summary_tokens"]
+
+    def build(self, messages, cache):
+        history = [message for message in messages if message["role"] != "system"]
+        recent = []
+        used = 0
+        cutoff = len(history)
+        for message in reversed(history):
+            entry = self._entry(message, cache)
+            if used + entry["tokens"] > self.budget_tokens:
+                break
+            recent.append(entry["text"])
+            used += entry["tokens"]
+            cutoff -= 1
+        recent.reverse()
+
+        summary_lines = []
+        summary_used = 0
+        for message in reversed(history[:cutoff]):
+            line, tokens = self._summary_line(message, self._entry(message, cache))
+            if summary_used + tokens > self.summary_tokens:
+                break
+            summary_lines.append(line)
+            summary_used += tokens
+        summary_lines.reverse()
+
+        parts = []
+        if summary_lines:
+            parts.append("Summary of earlier conversation:\n" + "\n".join(summary_lines))
+        if recent:
+            parts.append("\n".join(recent))
+        return "\n\n".join(parts)
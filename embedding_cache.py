@@ -0,0 +1,97 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+
+from sqlite_store import LOOKUP_BATCH_SIZE
+
+
+def embedder_signature(app):
+    """Identify the embedding model so vectors from different models are never mixed."""
+    embedder = app.db.embedder
+    model = getattr(getattr(embedder, "config", None), "model", None)
+    return f"{type(embedder).__name__}:{model or 'default'}"
+
+
+def normalize_text(text):
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def text_hash(text):
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of embeddings keyed by (embedder model, hash of normalised text).
+
+    It lives outside db/ so it survives collection deletion and storage resets:
+    re-ingesting the same text after a reset costs a local lookup instead of an
+    embedding API call.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT, hash TEXT, vector BLOB, created_at REAL, PRIMARY KEY (model, hash))"
+        )
+        self._conn.commit()
+
+    def get_many(self, model, hashes):
+        """Return {hash: vector} for the hashes that are cached, looked up in batches."""
+        found = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            for start in range(0, len(unique), LOOKUP_BATCH_SIZE):
+                batch = unique[start:start + LOOKUP_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({placeholders})",
+                    [model, *batch],
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+        return found
+
+    def put_many(self, model, items):
+        """Store (hash, vector) pairs."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, vector, created_at) VALUES (?, ?, ?, ?)",
+                [(model, key, array("f", vector).tobytes(), now) for key, vector in items],
+            )
+            self._conn.commit()
+
+    def embed(self, model, texts, embed_fn):
+        """Embed texts, calling embed_fn only for texts that are not cached yet."""
+        hashes = [text_hash(text) for text in texts]
+        cached = self.get_many(model, hashes)
+        missing = {}
+        for key, text in zip(hashes, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            vectors = embed_fn(list(missing.values()))
+            computed = list(zip(missing.keys(), vectors))
+            self.put_many(model, computed)
+            cached.update(computed)
+        if cached and len(missing) < len(texts):
+            logging.info(f"Embedding cache: {len(texts) - len(missing)} of {len(texts)} chunks served locally")
+        return [cached[key] for key in hashes]
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return {"entries": entries, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,122 @@
+import itertools
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class ImageJobQueue:
+    """
+    Process-wide queue for image generation jobs.
+
+    Jobs run on a fixed number of worker threads that share one API client, so
+    connections are pooled across every session. Each user has their own FIFO
+    and workers take jobs from users in round-robin order, so one user queueing
+    several images cannot hold up everyone else. submit returns immediately
+    with a job id; callers poll with get and collect the result on a later run.
+    """
+
+    def __init__(self, client_factory, max_concurrency=4, per_user_limit=2, max_queued=100, result_ttl=3600):
+        self.client_factory = client_factory
+        self.max_concurrency = max_concurrency
+        self.per_user_limit = per_user_limit
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self._client = None
+        self._jobs = {}
+        self._queues = OrderedDict()  # user -> deque of job ids, in round-robin order
+        self._condition = threading.Condition()
+        for i in range(max_concurrency):
+            threading.Thread(target=self._worker, name=f"image-job-{i}", daemon=True).start()
+
+    @property
+    def client(self):
+        with self._condition:
+            if self._client is None:
+                self._client = self.client_factory()
+            return self._client
+
+    def submit(self, user, func, *args):
+        """Queue func(client, *args) for user and return the job id."""
+        with self._condition:
+            self._expire()
+            queued = sum(len(queue) for queue in self._queues.values())
+            active = sum(1 for job in self._jobs.values() if job["user"] == user and job["status"] in ("queued", "running"))
+            if active >= self.per_user_limit:
+                raise QueueFullError(f"You already have {active} images in progress. Please wait for them to finish.")
+            if queued >= self.max_queued:
+                raise QueueFullError("The image queue is full right now. Please try again in a minute.")
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                "id": job_id,
+                "user": user,
+                "status": "queued",
+                "func": func,
+                "args": args,
+                "result": None,
+                "error": None,
+                "submitted_at": time.time(),
+                "finished_at": None,
+            }
+            self._queues.setdefault(user, deque()).append(job_id)
+            self._condition.notify()
+            return job_id
+
+    def get(self, job_id):
+        with self._condition:
+            job = self._jobs.get(job_id)
+            return None if job is None else {k: v for k, v in job.items() if k not in ("func", "args")}
+
+    def pop(self, job_id):
+        """Forget a finished job once its result has been collected."""
+        with self._condition:
+            self._jobs.pop(job_id, None)
+
+    def position(self, job_id):
+        """How many jobs will be dispatched before this one (0 when running or done)."""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] != "queued":
+                return 0
+            queues = [list(queue) for queue in self._queues.values()]
+            order = [jid for round_ in itertools.zip_longest(*queues) for jid in round_ if jid is not None]
+            return order.index(job_id) if job_id in order else 0
+
+    def _next_job(self):
+        # Rotate through users: take one job from the first user, then move them to the back
+        while self._queues:
+            user, queue = next(iter(self._queues.items()))
+            self._queues.move_to_end(user)
+            job_id = queue.popleft() if queue else None
+            if not queue:
+                del self._queues[user]
+            if job_id in self._jobs:
+                return self._jobs[job_id]
+        return None
+
+    def _expire(self):
+        cutoff = time.time() - self.result_ttl
+        for job_id in [jid for jid, job in self._jobs.items() if job["finished_at"] and job["finished_at"] < cutoff]:
+            del self._jobs[job_id]
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None:
+                    self._condition.wait()
+                    job = self._next_job()
+                job["status"] = "running"
+            try:
+                result = job["func"](self.client, *job["args"])
+                status, error = "done", None
+            except Exception as e:
+                logging.error(f"Image job {job['id']} failed: {str(e)}")
+                result, status, error = None, "failed", str(e)
+            with self._condition:
+                job.update(status=status, result=result, error=error, finished_at=time.time())
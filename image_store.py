@@ -0,0 +1,98 @@
+import hashlib
+import io
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+
+def guess_extension(data):
+    if data.startswith(b"\xff\xd8"):
+        return "jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return "png"
+
+
+class ImageStore:
+    """
+    Content-addressed image store on disk.
+
+    Images are saved once under their SHA-256 and referenced by a short
+    "<hash>.<ext>" string, so chat messages never carry image bytes. Thumbnails
+    are generated on first use and stored beside the originals. Recently read
+    bytes are kept in an LRU cache bounded by total size.
+    """
+
+    def __init__(self, root, thumbnail_size=512, cache_bytes=64 * 1024 * 1024):
+        self.root = root
+        self.thumbnail_size = thumbnail_size
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, "thumbnails"), exist_ok=True)
+
+    def _path(self, ref, thumbnail=False):
+        name = os.path.basename(ref)  # refs never contain directories
+        if thumbnail:
+            return os.path.join(self.root, "thumbnails", f"{os.path.splitext(name)[0]}.png")
+        return os.path.join(self.root, name)
+
+    def put(self, data):
+        ref = f"{hashlib.sha256(data).hexdigest()}.{guess_extension(data)}"
+        path = self._path(ref)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        self._remember((ref, False), data)
+        return ref
+
+    def get(self, ref):
+        return self._read((ref, False))
+
+    def thumbnail(self, ref):
+        key = (ref, True)
+        path = self._path(ref, thumbnail=True)
+        if not os.path.exists(path):
+            self._make_thumbnail(ref, path)
+        return self._read(key)
+
+    def _make_thumbnail(self, ref, path):
+        from PIL import Image
+
+        with Image.open(io.BytesIO(self.get(ref))) as image:
+            image.thumbnail((self.thumbnail_size, self.thumbnail_size))
+            buffer = io.BytesIO()
+            image.save(buffer, format="PNG", optimize=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(buffer.getvalue())
+        os.replace(tmp_path, path)
+        logging.info(f"Created thumbnail for {ref}")
+
+    def _read(self, key):
+        with self._lock:
+            data = self._cache.get(key)
+            if data is not None:
+                self._cache.move_to_end(key)
+                return data
+        with open(self._path(key[0], thumbnail=key[1]), "rb") as f:
+            data = f.read()
+        self._remember(key, data)
+        return data
+
+    def _remember(self, key, data):
+        if len(data) > self.cache_bytes:
+            return
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return
+            self._cache[key] = data
+            self._cached_bytes += len(data)
+            while self._cached_bytes > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted)
@@ -0,0 +1,343 @@
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from metrics import metrics
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no flock, so other processes using the store cannot be detected
+    fcntl = None
+
+# Chroma names each vector segment's directory after the segment id
+SEGMENT_DIR_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+# config.yaml keys (under hnsw:) and the collection metadata Chroma reads them from
+HNSW_KEYS = {
+    "M": "hnsw:M",
+    "construction_ef": "hnsw:construction_ef",
+    "search_ef": "hnsw:search_ef",
+}
+
+
+class MaintenanceGate:
+    """
+    Keeps index maintenance away from knowledge base writes. Any number of writes
+    may run together; maintenance starts only once none is running and holds new
+    writes back until it is done.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._writers = 0
+        self._maintaining = False
+
+    @contextmanager
+    def write(self):
+        with self._condition:
+            while self._maintaining:
+                self._condition.wait()
+            self._writers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writers -= 1
+                self._condition.notify_all()
+
+    @contextmanager
+    def maintenance(self, timeout):
+        """Yields True once no write is running, or False if that did not happen within timeout seconds."""
+        with self._condition:
+            idle = self._condition.wait_for(lambda: not self._writers and not self._maintaining, timeout)
+            if idle:
+                self._maintaining = True
+        try:
+            yield idle
+        finally:
+            if idle:
+                with self._condition:
+                    self._maintaining = False
+                    self._condition.notify_all()
+
+
+class StoreLock:
+    """
+    Tells maintenance whether other processes have the Chroma store open. Every
+    process that opens it holds a shared flock on path (kept outside db/, which
+    resets delete); exclusive() succeeds only when no other process holds one.
+    A second lock file lets one process at a time try, because upgrading a flock
+    briefly drops the shared lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._attempt_fd = None
+        if fcntl is None:
+            logging.warning("flock is not available; index maintenance cannot see other processes using the store")
+            return
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._attempt_fd = os.open(f"{path}.maintenance", os.O_RDWR | os.O_CREAT, 0o644)
+        # Blocks only while another process is running maintenance
+        fcntl.flock(self._fd, fcntl.LOCK_SH)
+
+    @contextmanager
+    def exclusive(self):
+        """Yields True while no other process has the store open, else False without waiting."""
+        if self._fd is None:
+            yield True
+            return
+        try:
+            fcntl.flock(self._attempt_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                alone = True
+            except BlockingIOError:
+                alone = False
+            try:
+                yield alone
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_SH)
+        finally:
+            fcntl.flock(self._attempt_fd, fcntl.LOCK_UN)
+
+
+def hnsw_metadata(settings):
+    """Collection metadata for the hnsw: section of config.yaml."""
+    return {HNSW_KEYS[key]: int(value) for key, value in (settings or {}).items() if key in HNSW_KEYS}
+
+
+def apply_hnsw_settings(app, settings):
+    """
+    Give the app's collection the configured HNSW parameters. M and construction_ef
+    shape the graph as it is built, so they can only be set on an empty collection,
+    which is recreated with them; search_ef can be changed at any time.
+    """
+    wanted = hnsw_metadata(settings)
+    collection = app.db.collection
+    current = collection.metadata or {}
+    if not wanted or all(current.get(key) == value for key, value in wanted.items()):
+        return
+    if collection.count() == 0:
+        client = app.db.client
+        client.delete_collection(collection.name)
+        app.db.collection = client.get_or_create_collection(
+            name=collection.name, embedding_function=app.db.embedder.embedding_fn, metadata={**current, **wanted},
+        )
+        logging.info(f"Recreated empty collection {collection.name} with {wanted}")
+        return
+    if "hnsw:search_ef" in wanted and current.get("hnsw:search_ef") != wanted["hnsw:search_ef"]:
+        # Chroma refuses any metadata update that mentions the distance function
+        metadata = {key: value for key, value in current.items() if key != "hnsw:space"}
+        collection.modify(metadata={**metadata, "hnsw:search_ef": wanted["hnsw:search_ef"]})
+        logging.info(f"Set hnsw:search_ef={wanted['hnsw:search_ef']} on {collection.name}")
+    fixed = {key: value for key, value in wanted.items() if key != "hnsw:search_ef" and current.get(key) != value}
+    if fixed:
+        logging.info(f"{collection.name} keeps its HNSW graph parameters; {fixed} apply once it is next created empty, e.g. after /db reset")
+
+
+def directory_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def sqlite_bytes(path):
+    return sum(os.path.getsize(path + suffix) for suffix in ("", "-wal", "-shm") if os.path.exists(path + suffix))
+
+
+def known_segments(sqlite_path):
+    """{segment id: scope} from Chroma's metadata store, opened read-only."""
+    with sqlite3.connect(f"file:{sqlite_path}?mode=ro", uri=True, timeout=30) as conn:
+        return dict(conn.execute("SELECT id, scope FROM segments").fetchall())
+
+
+def segment_dirs(db_path):
+    return [name for name in os.listdir(db_path) if SEGMENT_DIR_PATTERN.match(name) and os.path.isdir(os.path.join(db_path, name))]
+
+
+def orphaned_segment_dirs(db_path):
+    """Segment directories no segment in chroma.sqlite3 refers to; None when there is no metadata store to check."""
+    sqlite_path = os.path.join(db_path, "chroma.sqlite3")
+    if not os.path.exists(sqlite_path):
+        return None
+    segments = known_segments(sqlite_path)
+    return [name for name in segment_dirs(db_path) if name not in segments]
+
+
+def index_stats(app, db_path):
+    sqlite_path = os.path.join(db_path, "chroma.sqlite3")
+    stats = {
+        "collections": [],
+        "segments": 0,
+        "vector_segments": 0,
+        "segment_dirs": 0,
+        "orphaned": [],
+        "orphaned_bytes": 0,
+        "sqlite_bytes": 0,
+        "free_bytes": 0,
+        "queue_rows": 0,
+        "disk_bytes": directory_bytes(db_path) if os.path.exists(db_path) else 0,
+    }
+    for collection in app.db.client.list_collections():
+        metadata = collection.metadata or {}
+        stats["collections"].append({
+            "name": collection.name,
+            "count": collection.count(),
+            "hnsw": {key: metadata[name] for key, name in HNSW_KEYS.items() if name in metadata},
+        })
+    if not os.path.exists(sqlite_path):
+        return stats
+    segments = known_segments(sqlite_path)
+    stats["segments"] = len(segments)
+    stats["vector_segments"] = sum(1 for scope in segments.values() if scope == "VECTOR")
+    stats["segment_dirs"] = len(segment_dirs(db_path))
+    stats["orphaned"] = orphaned_segment_dirs(db_path)
+    stats["orphaned_bytes"] = sum(directory_bytes(os.path.join(db_path, name)) for name in stats["orphaned"])
+    stats["sqlite_bytes"] = sqlite_bytes(sqlite_path)
+    with sqlite3.connect(f"file:{sqlite_path}?mode=ro", uri=True, timeout=30) as conn:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        stats["free_bytes"] = conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size
+        try:
+            stats["queue_rows"] = conn.execute("SELECT COUNT(*) FROM embeddings_queue").fetchone()[0]
+        except sqlite3.OperationalError:
+            pass
+    return stats
+
+
+def format_index_stats(stats, last_run=None):
+    """Markdown for /db stats."""
+    def mb(value):
+        return f"{value / (1024 * 1024):.1f} MB"
+
+    lines = []
+    if stats["collections"]:
+        lines += ["| Collection | Chunks | HNSW |", "|---|---:|---|"]
+        for collection in stats["collections"]:
+            hnsw = ", ".join(f"{key}={value}" for key, value in collection["hnsw"].items()) or "defaults"
+            lines.append(f"| {collection['name']} | {collection['count']} | {hnsw} |")
+    else:
+        lines.append("No collections.")
+    lines += [
+        "",
+        f"- Segments: {stats['segments']} ({stats['vector_segments']} vector, {stats['segment_dirs']} directories on disk)",
+        f"- Orphaned segment directories: {len(stats['orphaned'])} ({mb(stats['orphaned_bytes'])})",
+        f"- On disk: {mb(stats['disk_bytes'])}, of which metadata store {mb(stats['sqlite_bytes'])} ({mb(stats['free_bytes'])} reclaimable by VACUUM)",
+        f"- Embedding log rows: {stats['queue_rows']}",
+    ]
+    if last_run:
+        lines.append(
+            f"- Last maintenance {time.strftime('%Y-%m-%d %H:%M', time.localtime(last_run['finished_at']))}: "
+            f"removed {last_run['removed_segments']} orphaned segments, freed {mb(last_run['freed_bytes'])}"
+        )
+    return "\n".join(lines)
+
+
+def compact_sqlite(path, vacuum_free_ratio):
+    """Checkpoint the WAL and VACUUM when enough of the file is free pages. Returns the bytes freed."""
+    before = sqlite_bytes(path)
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if page_count and free_pages / page_count >= vacuum_free_ratio:
+            conn.execute("VACUUM")
+            logging.info(f"Vacuumed {os.path.basename(path)}: {free_pages} of {page_count} pages were free")
+        conn.execute("PRAGMA optimize")
+    finally:
+        conn.close()
+    return max(before - sqlite_bytes(path), 0)
+
+
+class IndexMaintenance:
+    """
+    Periodic housekeeping for the Chroma store under db/: deletes segment
+    directories no collection uses any more and compacts the SQLite files.
+    Runs on a daemon thread every interval seconds, only while no knowledge base
+    write is in progress in this process (see MaintenanceGate) and, with a
+    store_lock, no other process has the store open (see StoreLock).
+    """
+
+    def __init__(self, db_path, gate, interval=6 * 3600, orphan_grace=3600, vacuum_free_ratio=0.2, wait_timeout=600,
+                 store_lock=None):
+        self.db_path = db_path
+        self.gate = gate
+        self.store_lock = store_lock
+        self.interval = interval
+        self.orphan_grace = orphan_grace
+        self.vacuum_free_ratio = vacuum_free_ratio
+        self.wait_timeout = wait_timeout
+        self.last_run = None
+        self._thread = None
+
+    def remove_orphaned_segments(self):
+        orphaned = orphaned_segment_dirs(self.db_path)
+        removed = 0
+        freed = 0
+        for name in orphaned or []:
+            path = os.path.join(self.db_path, name)
+            # A segment being created right now may not be in the metadata store yet
+            if time.time() - os.path.getmtime(path) < self.orphan_grace:
+                continue
+            size = directory_bytes(path)
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+            freed += size
+            logging.info(f"Removed orphaned segment directory {name} ({size} bytes)")
+        return removed, freed
+
+    def run_once(self):
+        """Run maintenance now unless writes keep it waiting; returns the summary, or None if it did not run."""
+        if not os.path.exists(self.db_path):
+            return None
+        with self.gate.maintenance(self.wait_timeout) as idle:
+            if not idle:
+                logging.info("Index maintenance postponed: knowledge base writes in progress")
+                return None
+            with (self.store_lock.exclusive() if self.store_lock is not None else nullcontext(True)) as alone:
+                if not alone:
+                    # Their Chroma clients have the segment files and SQLite databases open
+                    logging.info("Index maintenance postponed: other processes have the store open")
+                    return None
+                with metrics.timer("db.maintenance"):
+                    removed, freed = self.remove_orphaned_segments()
+                    for name in sorted(os.listdir(self.db_path)):
+                        if name.endswith(".sqlite3"):
+                            try:
+                                freed += compact_sqlite(os.path.join(self.db_path, name), self.vacuum_free_ratio)
+                            except sqlite3.Error as e:
+                                logging.warning(f"Could not compact {name}: {str(e)}")
+        metrics.increment("db.maintenance.orphaned_segments", removed)
+        self.last_run = {"finished_at": time.time(), "removed_segments": removed, "freed_bytes": freed}
+        logging.info(f"Index maintenance done: removed {removed} orphaned segments, freed {freed} bytes")
+        return self.last_run
+
+    def start(self):
+        def run():
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.run_once()
+                except Exception as e:
+                    logging.warning(f"Index maintenance failed: {str(e)}")
+
+        self._thread = threading.Thread(target=run, name="index-maintenance", daemon=True)
+        self._thread.start()
+        return self
@@ -0,0 +1,570 @@
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlparse
+
+import requests
+
+from embedding_cache import embedder_signature
+from metrics import metrics
+
+# Tuning knobs for the ingestion pipeline
+INGEST_DEFAULTS = {
+    "workers": 6,  # parallel fetch/chunk/embed workers
+    "embed_batch_size": 64,  # chunks per embedding call
+    "retries": 2,  # extra attempts per source fetch and per embedding batch
+    "retry_backoff": 1.0,  # seconds, doubled after each failed attempt
+    "per_host_limit": 4,  # concurrent requests to any one host, shared by every fetch in the process
+    "dedup_types": ("web_page",),  # data types whose chunks are checked for duplicates across sources
+}
+
+SCHEMA_MISMATCH_ERROR = "no such column: collections.config_json_str"
+
+HTTP_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (compatible; StJamieBot/1.0; +https://github.com/goldzulu/stjamie)",
+}
+
+_http_session = requests.Session()
+_http_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=INGEST_DEFAULTS["workers"]))
+_http_session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=INGEST_DEFAULTS["workers"]))
+
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+# Seconds the pipeline waits on running jobs before checking for newly discovered sources
+FEED_POLL_INTERVAL = 0.1
+_END_OF_SOURCES = object()
+
+
+def is_missing_collection_error(error_text):
+    return "does not exist" in error_text and "Collection" in error_text
+
+
+def is_schema_mismatch_error(error_text):
+    return SCHEMA_MISMATCH_ERROR in error_text
+
+
+def with_retries(func, retries, backoff, label):
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= retries:
+                raise
+            delay = backoff * (2 ** attempt)
+            attempt += 1
+            logging.warning(f"{label} failed ({str(e)}). Retrying in {delay:.1f}s (attempt {attempt} of {retries})")
+            time.sleep(delay)
+
+
+class SourceManifest:
+    """
+    Per-source ingest record persisted as JSON next to the db/ directory:
+    HTTP validators, a hash of the fetched body and the chunk IDs it produced.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f).get("sources", {})
+            except Exception as e:
+                logging.warning(f"Ignoring unreadable manifest {path}: {str(e)}")
+
+    def get(self, source):
+        return self.entries.get(source)
+
+    def update(self, source, entry):
+        self.entries[source] = {**entry, "updated_at": time.time()}
+
+    def clear(self):
+        self.entries = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"sources": self.entries}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def is_url(source):
+    return isinstance(source, str) and source.startswith(("http://", "https://"))
+
+
+def _host_slot(url):
+    host = urlparse(url).netloc
+    with _host_slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = threading.BoundedSemaphore(INGEST_DEFAULTS["per_host_limit"])
+        return _host_slots[host]
+
+
+def http_get(url, headers=None, timeout=30, **kwargs):
+    """GET through the shared keep-alive session, with at most per_host_limit requests per host in flight."""
+    with _host_slot(url):
+        return _http_session.get(url, headers={**HTTP_HEADERS, **(headers or {})}, timeout=timeout, **kwargs)
+
+
+def response_fingerprint(response):
+    body = response.content
+    return {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "content_hash": hashlib.sha256(body).hexdigest(),
+        "body": body,
+    }
+
+
+def fetch_if_changed(url, entry):
+    """
+    Conditionally GET a URL using the validators stored in its manifest entry.
+    Returns a fingerprint dict; "body" is only set when the content changed.
+    """
+    headers = {}
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    response = http_get(url, headers=headers)
+    if response.status_code == 304 and entry:
+        return {"etag": entry.get("etag"), "last_modified": entry.get("last_modified"), "content_hash": entry.get("content_hash"), "body": None}
+    response.raise_for_status()
+    fingerprint = response_fingerprint(response)
+    if entry and entry.get("content_hash") == fingerprint["content_hash"]:
+        fingerprint["body"] = None
+    return fingerprint
+
+
+class PrefetchedLoader:
+    """Wrap an embedchain web page loader so it cleans an already-downloaded body instead of fetching again."""
+
+    def __init__(self, loader, body):
+        self.loader = loader
+        self.body = body
+
+    def load_data(self, url):
+        content = self.loader._get_clean_content(self.body, url)
+        return {
+            "doc_id": hashlib.sha256((content + url).encode()).hexdigest(),
+            "data": [{"content": content, "meta_data": {"url": url}}],
+        }
+
+
+def source_hash(source):
+    """embedchain's id for a source: the md5 of its value, kept on every chunk as metadata "hash"."""
+    return hashlib.md5(str(source).encode("utf-8")).hexdigest()
+
+
+def record_data_source(app, source, data_type):
+    """
+    Add a source to embedchain's data source table as App.add would, so
+    app.get_data_sources() and app.delete(source_hash(source)) know about it.
+    """
+    try:
+        from embedchain.core.db.models import DataSource
+        session = app.db_session
+    except (ImportError, AttributeError) as e:
+        logging.warning(f"Could not record data source {source}: {str(e)}")
+        return
+    try:
+        # App.add adds a row every time; a re-ingested source keeps a single one here
+        session.query(DataSource).filter_by(hash=source_hash(source), app_id=app.config.id).delete()
+        session.add(DataSource(hash=source_hash(source), app_id=app.config.id, type=data_type, value=str(source)))
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error recording data source {source}: {str(e)}")
+
+
+def forget_data_sources(app):
+    """Empty the app's rows in embedchain's data source table, as App.reset does."""
+    try:
+        from embedchain.core.db.models import DataSource
+        session = app.db_session
+    except (ImportError, AttributeError):
+        return
+    try:
+        session.query(DataSource).filter_by(app_id=app.config.id).delete()
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error clearing data sources: {str(e)}")
+
+
+def load_chunks(app, source, data_type, body=None):
+    """Fetch and chunk a source the same way embedchain's App.add does, without embedding it."""
+    from embedchain.config import AddConfig
+    from embedchain.data_formatter import DataFormatter
+    from embedchain.models.data_type import DataType
+
+    add_config = AddConfig()
+    formatter = DataFormatter(DataType(data_type), add_config)
+    loader = formatter.loader
+    if body is not None and hasattr(loader, "_get_clean_content"):
+        loader = PrefetchedLoader(loader, body)
+    app_id = app.config.id if app.config is not None else None
+    chunks = formatter.chunker.create_chunks(loader, source, app_id=app_id, config=add_config.chunker)
+    metadatas = chunks["metadatas"]
+    # embedchain filters queries on app_id, so chunks must carry it to be retrievable
+    if app_id is not None:
+        metadatas = [{**metadata, "app_id": app_id} for metadata in metadatas]
+    return {"ids": chunks["ids"], "documents": chunks["documents"], "metadatas": metadatas}
+
+
+class IngestionPipeline:
+    """
+    Ingest many sources with a bounded worker pool.
+
+    Fetching and chunking run in parallel per source, embeddings are computed in
+    batches that may span several sources, and every read or write against the
+    Chroma collection happens on the calling thread so the collection has a
+    single writer. A failing source never stops the others.
+    """
+
+    def __init__(self, app, app_factory, reset_storage, manifest=None, embedding_cache=None, loaders=None,
+                 lexical_index=None, deduplicator=None, **options):
+        self.app = app
+        self.app_factory = app_factory
+        self.reset_storage = reset_storage
+        self.manifest = manifest
+        self.embedding_cache = embedding_cache
+        # data_type -> callable(app, source, body) returning chunks, for types embedchain does not know
+        self.loaders = loaders or {}
+        # BM25 index kept in step with every chunk written to or deleted from the collection
+        self.lexical_index = lexical_index
+        # Drops chunks that repeat other sources' text (navigation, footers) before they are embedded
+        self.deduplicator = deduplicator
+        self.options = {**INGEST_DEFAULTS, **options}
+
+    def run(self, sources, on_result=None):
+        """
+        Ingest (source, data_type) pairs and return one result dict per source.
+        on_result is called on the calling thread as soon as a source finishes.
+
+        sources may be a generator, e.g. a crawler discovering pages: each source
+        starts as soon as it is produced. A third element, the fingerprint of an
+        already-downloaded response (see response_fingerprint), saves fetching again.
+
+        With a manifest, URL sources whose content is unchanged are reported as
+        "unchanged" without being chunked or embedded, and chunks left over from
+        a previous version of a changed page are deleted once the new ones are in.
+
+        With a deduplicator, chunks repeating text already stored for another source
+        are not embedded again; the source refers to the existing chunk instead.
+        """
+        results = []
+        jobs = {}
+        buffer = []
+        outstanding = {}  # source -> chunks not yet written
+        added = {}  # source -> chunks written
+        fingerprints = {}  # source -> manifest entry to record once the source is written
+        data_types = {}  # source -> data type, recorded with embedchain once the source is written
+        totals = {}  # source -> chunks the source consists of, new or already stored
+        shared = {}  # source -> (existing chunk ids it duplicates, bytes not stored again)
+
+        def finish(source, status, error=None):
+            if source in outstanding:
+                del outstanding[source]
+            entry = fingerprints.pop(source, None)
+            data_type = data_types.pop(source, None)
+            duplicate_ids, saved_bytes = shared.pop(source, ((), 0))
+            if self.deduplicator is not None:
+                if status == "added":
+                    self.deduplicator.add_refs(source, set(duplicate_ids))
+                else:
+                    self.deduplicator.forget(source)
+            metrics.increment(f"ingest.sources.{status}")
+            if status == "added" and entry is not None:
+                try:
+                    self._replace_stale_chunks(source, entry)
+                except Exception as e:
+                    logging.error(f"Error removing stale chunks for {source}: {str(e)}", exc_info=True)
+                    status, error = "failed", str(e)
+            elif status == "unchanged" and entry is not None:
+                self.manifest.update(source, entry)
+            if status == "added":
+                record_data_source(self.app, source, data_type)
+            result = {
+                "source": source,
+                "status": status,
+                "chunks": added.pop(source, 0),
+                "total_chunks": totals.pop(source, 0),
+                "duplicates": len(duplicate_ids),
+                "saved_bytes": saved_bytes,
+                "error": error,
+            }
+            results.append(result)
+            if on_result:
+                on_result(result)
+
+        def flush(pool):
+            while buffer:
+                batch = buffer[:self.options["embed_batch_size"]]
+                del buffer[:len(batch)]
+                jobs[pool.submit(self._embed, [item[2] for item in batch])] = ("embed", batch)
+
+        # Sources are produced on their own thread so a slow generator never stalls writes;
+        # the bounded queue keeps a fast one from running far ahead of ingestion
+        feed = queue.Queue(maxsize=self.options["workers"] * 4)
+        self.feed_error = None
+
+        def produce():
+            try:
+                for item in sources:
+                    feed.put(item)
+            except Exception as e:
+                logging.error(f"Error producing sources: {str(e)}", exc_info=True)
+                self.feed_error = str(e)
+            finally:
+                feed.put(_END_OF_SOURCES)
+
+        threading.Thread(target=produce, daemon=True).start()
+        feeding = True
+
+        with ThreadPoolExecutor(max_workers=self.options["workers"]) as pool:
+            while feeding or jobs or buffer:
+                # Start every source produced so far, waiting for one only when nothing else is running
+                block = not jobs
+                while feeding:
+                    try:
+                        item = feed.get(block=block)
+                    except queue.Empty:
+                        break
+                    block = False
+                    if item is _END_OF_SOURCES:
+                        feeding = False
+                        break
+                    source, data_type, *prefetched = item
+                    job = (source, data_type, prefetched[0] if prefetched else None)
+                    data_types[source] = data_type
+                    jobs[pool.submit(self._prepare, *job)] = ("prepare", job)
+
+                # Once nothing is left to fetch, embed whatever partial batch remains
+                if buffer and not feeding and not any(stage == "prepare" for stage, _ in jobs.values()):
+                    flush(pool)
+                if not jobs:
+                    continue
+
+                done, _ = wait(jobs, timeout=FEED_POLL_INTERVAL if feeding else None, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, job = jobs.pop(future)
+                    if stage == "prepare":
+                        source, data_type, fetched = job
+                        try:
+                            chunks = future.result()
+                            totals[source] = len(set(chunks["ids"]))
+                            if chunks.get("fingerprint") is not None:
+                                fingerprints[source] = {**chunks["fingerprint"], "chunk_ids": chunks["ids"]}
+                            if chunks.get("unchanged"):
+                                if self._stored(chunks["ids"]):
+                                    finish(source, "unchanged")
+                                else:
+                                    # The manifest is stale (e.g. the collection was lost), so ingest anyway
+                                    fingerprints.pop(source, None)
+                                    jobs[pool.submit(self._prepare, source, data_type, fetched, True)] = ("prepare", job)
+                                continue
+                            new_items = self._new_chunks(source, chunks)
+                            new_items, replaced, saved_bytes = self._deduplicate(source, new_items)
+                            if replaced:
+                                shared[source] = (list(replaced.values()), saved_bytes)
+                                if source in fingerprints:
+                                    # The source now consists of the shared chunks in place of its own copies
+                                    fingerprints[source]["chunk_ids"] = list(dict.fromkeys(
+                                        replaced.get(chunk_id, chunk_id) for chunk_id in fingerprints[source]["chunk_ids"]
+                                    ))
+                        except Exception as e:
+                            logging.error(f"Error preparing source {source}: {str(e)}", exc_info=True)
+                            finish(source, "failed", str(e))
+                            continue
+                        if not new_items:
+                            finish(source, "added")
+                            continue
+                        outstanding[source] = len(new_items)
+                        buffer.extend(new_items)
+                        if len(buffer) >= self.options["embed_batch_size"]:
+                            flush(pool)
+                    else:
+                        batch = job
+                        positions = [i for i, item in enumerate(batch) if item[0] in outstanding]
+                        live = [batch[i] for i in positions]
+                        try:
+                            embeddings = future.result()
+                            self._write(live, [embeddings[i] for i in positions])
+                        except Exception as e:
+                            logging.error(f"Error embedding or writing batch: {str(e)}", exc_info=True)
+                            for source in {item[0] for item in live}:
+                                if source in outstanding:
+                                    finish(source, "failed", str(e))
+                            continue
+                        for item in live:
+                            added[item[0]] = added.get(item[0], 0) + 1
+                            outstanding[item[0]] -= 1
+                        for source in {item[0] for item in live}:
+                            if outstanding.get(source) == 0:
+                                finish(source, "added")
+
+
+        if self.manifest is not None:
+            self.manifest.save()
+        return results
+
+    def _prepare(self, source, data_type, fetched=None, force=False):
+        return with_retries(
+            lambda: self._fetch_and_chunk(source, data_type, fetched, force),
+            self.options["retries"],
+            self.options["retry_backoff"],
+            f"Fetching {source}",
+        )
+
+    def _load(self, source, data_type, body=None):
+        if data_type in self.loaders:
+            chunks = self.loaders[data_type](self.app, source, body)
+        else:
+            chunks = load_chunks(self.app, source, data_type, body=body)
+        # App.add tags chunks with their source's hash; app.delete(source_hash) selects on it
+        chunks["metadatas"] = [{**metadata, "hash": source_hash(source)} for metadata in chunks["metadatas"]]
+        return chunks
+
+    def _fetch_and_chunk(self, source, data_type, fetched, force):
+        if self.manifest is None or not is_url(source):
+            with metrics.timer("ingest.load"):
+                return self._load(source, data_type, body=fetched["body"] if fetched else None)
+        entry = None if force else self.manifest.get(source)
+        if entry and entry.get("data_type", "web_page") != data_type:
+            # Same page, new way of chunking it: treat as changed
+            entry = None
+        if fetched is not None:
+            fingerprint = dict(fetched)
+            if entry and entry.get("content_hash") == fingerprint["content_hash"]:
+                fingerprint["body"] = None
+        else:
+            with metrics.timer("ingest.fetch"):
+                fingerprint = fetch_if_changed(source, entry)
+        fingerprint["data_type"] = data_type
+        body = fingerprint.pop("body")
+        if body is None:
+            return {"unchanged": True, "ids": entry.get("chunk_ids", []), "fingerprint": fingerprint}
+        with metrics.timer("ingest.chunk"):
+            chunks = self._load(source, data_type, body=body)
+        chunks["fingerprint"] = fingerprint
+        return chunks
+
+    def _stored(self, ids):
+        if not ids:
+            return False
+        with metrics.timer("db.get"):
+            existing = self._with_recovery(lambda: self.app.db.get(ids=list(ids)))
+        return len(set(existing.get("ids") or [])) == len(set(ids))
+
+    def _replace_stale_chunks(self, source, entry):
+        previous = self.manifest.get(source) or {}
+        stale_ids = set(previous.get("chunk_ids", [])) - set(entry["chunk_ids"])
+        if stale_ids and self.deduplicator is not None:
+            # Chunks another source shares stay until the last source referring to them lets go
+            stale_ids = set(self.deduplicator.release(source, stale_ids))
+        if stale_ids:
+            logging.info(f"Removing {len(stale_ids)} stale chunks for {source}")
+            with metrics.timer("db.delete"):
+                self._with_recovery(lambda: self.app.db.collection.delete(ids=list(stale_ids)))
+            if self.lexical_index is not None:
+                self.lexical_index.delete(stale_ids)
+        self.manifest.update(source, entry)
+
+    def _embed(self, documents):
+        def embed_fn(texts):
+            return with_retries(
+                lambda: self.app.db.embedder.embedding_fn(texts),
+                self.options["retries"],
+                self.options["retry_backoff"],
+                f"Embedding batch of {len(texts)} chunks",
+            )
+
+        with metrics.timer("ingest.embed"):
+            if self.embedding_cache is None:
+                return embed_fn(documents)
+            return self.embedding_cache.embed(embedder_signature(self.app), documents, embed_fn)
+
+    def _new_chunks(self, source, chunks):
+        # Deduplicate within the source, then drop chunks already stored
+        items = {}
+        for chunk_id, document, metadata in zip(chunks["ids"], chunks["documents"], chunks["metadatas"]):
+            items.setdefault(chunk_id, (source, chunk_id, document, metadata))
+        if not items:
+            return []
+        with metrics.timer("db.get"):
+            existing = self._with_recovery(lambda: self.app.db.get(ids=list(items.keys())))
+        existing_ids = set(existing.get("ids") or []) if existing else set()
+        return [item for chunk_id, item in items.items() if chunk_id not in existing_ids]
+
+    def _deduplicate(self, source, items):
+        """Split new items into the ones to store and {duplicate id: existing chunk id}, plus bytes saved."""
+        if self.deduplicator is None:
+            return items, {}, 0
+        kept = []
+        replaced = {}
+        saved_bytes = 0
+        for item in items:
+            if item[3].get("data_type") not in self.options["dedup_types"]:
+                kept.append(item)
+                continue
+            canonical, signature = self.deduplicator.find(source, item[2])
+            if canonical is None:
+                self.deduplicator.claim(source, item[1], item[2], signature)
+                kept.append(item)
+            else:
+                replaced[item[1]] = canonical
+                saved_bytes += len(item[2].encode("utf-8"))
+        if replaced:
+            metrics.increment("ingest.duplicate_chunks", len(replaced))
+            logging.info(f"Skipping {len(replaced)} chunks of {source} that duplicate stored chunks")
+        return kept, replaced, saved_bytes
+
+    def _write(self, items, embeddings):
+        if not items:
+            return
+        metrics.increment("ingest.chunks_written", len(items))
+        with metrics.timer("ingest.write"):
+            self._write_items(items, embeddings)
+
+    def _write_items(self, items, embeddings):
+        self._with_recovery(lambda: self.app.db.collection.add(
+            ids=[item[1] for item in items],
+            documents=[item[2] for item in items],
+            metadatas=[item[3] for item in items],
+            embeddings=embeddings,
+        ))
+        if self.lexical_index is not None:
+            self.lexical_index.add([item[1] for item in items], [item[2] for item in items])
+        if self.deduplicator is not None:
+            self.deduplicator.commit([item[1] for item in items])
+
+    def _with_recovery(self, operation):
+        try:
+            return operation()
+        except Exception as e:
+            error_text = str(e)
+            # Chroma can lose collections on hosted environments; recreate and retry once.
+            if is_missing_collection_error(error_text):
+                logging.warning("Collection missing. Recreating app and retrying")
+                self.app = self.app_factory()
+                return operation()
+            # Schema mismatch can happen after Chroma upgrades; reset and retry once.
+            if is_schema_mismatch_error(error_text):
+                logging.warning("Schema mismatch. Resetting database and retrying")
+                self.reset_storage(self.app)
+                if self.manifest is not None:
+                    self.manifest.clear()
+                self.app = self.app_factory()
+                return operation()
+            raise
@@ -0,0 +1,343 @@
+import codecs
+import hashlib
+import json
+import logging
+import re
+
+KAPLAY_SYMBOLS_TYPE = "kaplay_symbols"
+
+# Interfaces whose members are the global functions of a kaplay() context
+GLOBAL_INTERFACES = ("KAPLAYCtx", "KaboomCtx")
+
+MAX_DOC_CHARS = 600
+MAX_TYPE_CHARS = 160
+READ_CHUNK_SIZE = 64 * 1024
+
+# Identifiers that look like code: name( with no space (so English "add (" does not count), `name`, obj.name or camelCase
+STRONG_SYMBOL_PATTERN = re.compile(r"`([A-Za-z_$][\w$.]*)`|([A-Za-z_$][\w$]*(?:\.[A-Za-z_$][\w$]*)*)\(|\b([a-z]+[A-Z][\w$]*|[A-Za-z_$][\w$]*\.[A-Za-z_$][\w$]*)\b")
+WORD_PATTERN = re.compile(r"\b[A-Za-z_$][\w$]{2,}\b")
+
+
+class _StreamReader:
+    """Character buffer over an iterable of text chunks with just enough JSON lexing to walk objects."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ""
+        self.pos = 0
+        self.exhausted = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        if self.exhausted:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.exhausted = True
+            return False
+        # Drop what has been consumed so the buffer only holds the current value
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON stream")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} at offset {self.pos}, found {self.buffer[self.pos]!r}")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._grow():
+                    raise
+                continue
+            # A number at the very end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and isinstance(value, (int, float)) and self._grow():
+                continue
+            self.pos = end
+            return value
+
+    def _grow(self):
+        # Read until the pending value's text has at least doubled, so a huge value is
+        # re-parsed O(log n) times rather than once per chunk
+        target = 2 * (len(self.buffer) - self.pos)
+        grew = False
+        while self._fill():
+            grew = True
+            if len(self.buffer) - self.pos >= target:
+                break
+        return grew
+
+
+def iter_json_members(chunks, descend=("types",)):
+    """
+    Stream (key, value) pairs out of a large JSON object without decoding it whole.
+
+    Members of the root object are yielded one at a time; a member whose key is in
+    descend and whose value is an object is itself streamed member by member, so
+    only one declaration is decoded at a time.
+    """
+    reader = _StreamReader(chunks)
+
+    def members(depth_keys):
+        reader.expect("{")
+        if reader.peek() == "}":
+            reader.pos += 1
+            return
+        while True:
+            key = reader.value()
+            reader.expect(":")
+            if key in depth_keys and reader.peek() == "{":
+                yield from members(())
+            else:
+                yield key, reader.value()
+            if reader.peek() == ",":
+                reader.pos += 1
+                continue
+            reader.expect("}")
+            return
+
+    yield from members(set(descend))
+
+
+def decode_chunks(byte_chunks, encoding="utf-8"):
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    for chunk in byte_chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def _clip(text, limit):
+    text = " ".join(str(text).split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def _type_text(node):
+    if node is None:
+        return ""
+    if isinstance(node, str):
+        return node
+    if isinstance(node, list):
+        return " | ".join(filter(None, (_type_text(item) for item in node)))
+    if isinstance(node, dict):
+        for key in ("text", "typeName", "name", "literal"):
+            if isinstance(node.get(key), (str, dict)):
+                return _type_text(node[key])
+        if "types" in node:
+            return _type_text(node["types"])
+        if "elementType" in node:
+            return f"{_type_text(node['elementType'])}[]"
+        return node.get("kind", "")
+    return str(node)
+
+
+def _doc_text(node):
+    for key in ("jsDoc", "jsDocs", "doc", "comment", "description"):
+        value = node.get(key)
+        if isinstance(value, str) and value.strip():
+            return value
+        if isinstance(value, dict):
+            text = _doc_text(value)
+            if text:
+                return text
+        if isinstance(value, list):
+            texts = [_doc_text(item) if isinstance(item, dict) else str(item) for item in value]
+            text = " ".join(t for t in texts if t)
+            if text:
+                return text
+    return ""
+
+
+def _signature(name, node):
+    params = []
+    for param in node.get("parameters") or []:
+        if not isinstance(param, dict):
+            continue
+        optional = "?" if param.get("questionToken") or param.get("optional") else ""
+        rest = "..." if param.get("dotDotDotToken") or param.get("rest") else ""
+        param_type = _type_text(param.get("type"))
+        params.append({
+            "name": param.get("name", ""),
+            "type": _clip(param_type, MAX_TYPE_CHARS),
+            "text": f"{rest}{param.get('name', '')}{optional}" + (f": {_clip(param_type, MAX_TYPE_CHARS)}" if param_type else ""),
+        })
+    return_type = _clip(_type_text(node.get("type")), MAX_TYPE_CHARS)
+    if "parameters" in node:
+        signature = f"{name}({', '.join(p['text'] for p in params)})" + (f": {return_type}" if return_type else "")
+    else:
+        signature = f"{name}" + (f": {return_type}" if return_type else "")
+    return signature, [{"name": p["name"], "type": p["type"]} for p in params]
+
+
+def _nodes(value):
+    if isinstance(value, list):
+        return [node for node in value if isinstance(node, dict)]
+    if isinstance(value, dict):
+        return [value]
+    return []
+
+
+def _members(node):
+    members = node.get("members")
+    if isinstance(members, dict):
+        return members.items()
+    if isinstance(members, list):
+        return [(member.get("name"), member) for member in members if isinstance(member, dict) and member.get("name")]
+    return []
+
+
+def extract_symbols(name, value):
+    """Turn one doc.json declaration (a node or a list of overloads) into symbol records."""
+    records = []
+    nodes = _nodes(value)
+    if not nodes:
+        return records
+    signatures = []
+    params = []
+    docs = []
+    for node in nodes:
+        signature, node_params = _signature(name, node)
+        signatures.append(signature)
+        params = params or node_params
+        doc = _doc_text(node)
+        if doc and doc not in docs:
+            docs.append(doc)
+        for member_name, member_value in _members(node):
+            if not isinstance(member_name, str):
+                continue
+            qualified = member_name if name in GLOBAL_INTERFACES else f"{name}.{member_name}"
+            records.extend(extract_symbols(qualified, member_value))
+    records.insert(0, {
+        "name": name,
+        "kind": nodes[0].get("kind", ""),
+        "signatures": list(dict.fromkeys(signatures))[:5],
+        "params": params,
+        "doc": _clip(" ".join(docs), MAX_DOC_CHARS),
+    })
+    return records
+
+
+def parse_symbols(text_chunks):
+    """Stream doc.json text chunks and return one record per symbol."""
+    records = {}
+    for name, value in iter_json_members(text_chunks):
+        for record in extract_symbols(name, value):
+            # Keep the most informative record when a name is declared twice
+            existing = records.get(record["name"])
+            if existing is None or (not existing["doc"] and record["doc"]):
+                records[record["name"]] = record
+    return list(records.values())
+
+
+def fetch_symbols(url, body=None):
+    """
+    Parse symbols from doc.json, downloading it when no body is given. The body is
+    held whole (the ingest manifest hashes it), but decoded one declaration at a
+    time rather than into a single object tree.
+    """
+    if body is None:
+        from ingestion import http_get
+        response = http_get(url, timeout=60)
+        response.raise_for_status()
+        body = response.content
+    chunks = (body[i:i + READ_CHUNK_SIZE] for i in range(0, len(body), READ_CHUNK_SIZE))
+    return parse_symbols(decode_chunks(chunks))
+
+
+def format_symbol(record):
+    """Compact text for one symbol: what gets embedded and what is injected into prompts."""
+    lines = [f"KaPlay API `{record['name']}` ({record['kind'] or 'symbol'})"]
+    lines.extend(f"Signature: {signature}" for signature in record["signatures"])
+    if record["doc"]:
+        lines.append(record["doc"])
+    return "\n".join(lines)
+
+
+def symbol_chunks(app, source, body=None):
+    """Build one chunk per symbol in the shape IngestionPipeline expects from a loader."""
+    records = fetch_symbols(source, body)
+    app_id = app.config.id if app.config is not None else None
+    ids, documents, metadatas = [], [], []
+    for record in records:
+        document = format_symbol(record)
+        chunk_id = hashlib.sha256((document + source).encode()).hexdigest()
+        ids.append(f"{app_id}--{chunk_id}" if app_id else chunk_id)
+        documents.append(document)
+        metadata = {
+            "url": source,
+            "data_type": KAPLAY_SYMBOLS_TYPE,
+            "symbol": record["name"],
+            "record": json.dumps(record),
+        }
+        if app_id is not None:
+            metadata["app_id"] = app_id
+        metadatas.append(metadata)
+    logging.info(f"Parsed {len(records)} KaPlay symbols from {source}")
+    return {"ids": ids, "documents": documents, "metadatas": metadatas}
+
+
+class SymbolIndex:
+    """In-memory lookup of KaPlay symbol records by name."""
+
+    def __init__(self, records=()):
+        self.records = {}
+        for record in records:
+            self.records.setdefault(record["name"].lower(), record)
+
+    def __len__(self):
+        return len(self.records)
+
+    @classmethod
+    def from_collection(cls, collection, page_size=500):
+        records = []
+        offset = 0
+        while True:
+            page = collection.get(where={"data_type": KAPLAY_SYMBOLS_TYPE}, include=["metadatas"], limit=page_size, offset=offset)
+            metadatas = page.get("metadatas") or []
+            for metadata in metadatas:
+                try:
+                    records.append(json.loads(metadata["record"]))
+                except (KeyError, TypeError, ValueError):
+                    continue
+            if len(metadatas) < page_size:
+                break
+            offset += page_size
+        return cls(records)
+
+    def lookup(self, name):
+        return self.records.get(name.lower())
+
+    def find_in_text(self, text, limit=5):
+        """
+        Symbols mentioned in a chat message. Code-looking identifiers always count;
+        plain words (sprite, area, body...) only when the message is about KaPlay.
+        """
+        found = []
+        for match in STRONG_SYMBOL_PATTERN.finditer(text):
+            name = next(group for group in match.groups() if group)
+            record = self.lookup(name) or self.lookup(name.split(".")[-1])
+            if record and record not in found:
+                found.append(record)
+        if re.search(r"\b(kaplay|kaboom)\b", text, re.IGNORECASE):
+            for word in WORD_PATTERN.findall(text):
+                record = self.lookup(word)
+                if record and record not in found and word.lower() not in ("kaplay", "kaboom"):
+                    found.append(record)
+        return found[:limit]
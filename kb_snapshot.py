@@ -0,0 +1,123 @@
+import base64
+import gzip
+import json
+import logging
+import os
+import shutil
+import time
+
+import numpy as np
+
+from embedding_cache import embedder_signature
+
+SNAPSHOT_FORMAT_VERSION = 1
+EXPORT_PAGE_SIZE = 500
+RESTORE_BATCH_SIZE = 500
+
+
+def chroma_version():
+    try:
+        import chromadb
+        return chromadb.__version__
+    except Exception:
+        return None
+
+
+def export_snapshot(app, path, extra=None):
+    """
+    Write the app's collection to a single gzipped JSON-lines file. The first line
+    is the manifest; every following line is one chunk with its embedding stored
+    as base64 float32. Returns the manifest.
+    """
+    collection = app.db.collection
+    records_path = f"{path}.records.tmp"
+    count = 0
+    dimension = None
+    # Records go to a scratch file first because the manifest line needs the final count
+    with open(records_path, "w", encoding="utf-8") as records:
+        offset = 0
+        while True:
+            page = collection.get(include=["documents", "metadatas", "embeddings"], limit=EXPORT_PAGE_SIZE, offset=offset)
+            ids = page.get("ids") or []
+            embeddings = page.get("embeddings")
+            for i, chunk_id in enumerate(ids):
+                vector = np.asarray(embeddings[i], dtype=np.float32)
+                dimension = dimension or int(vector.shape[0])
+                records.write(json.dumps({
+                    "id": chunk_id,
+                    "document": page["documents"][i],
+                    "metadata": page["metadatas"][i],
+                    "embedding": base64.b64encode(vector.tobytes()).decode("ascii"),
+                }) + "\n")
+            count += len(ids)
+            if len(ids) < EXPORT_PAGE_SIZE:
+                break
+            offset += EXPORT_PAGE_SIZE
+    manifest = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "created_at": time.time(),
+        "chroma_version": chroma_version(),
+        "embedder": embedder_signature(app),
+        "dimension": dimension,
+        "collection": collection.name,
+        "count": count,
+        **(extra or {}),
+    }
+    tmp_path = f"{path}.tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f, open(records_path, "r", encoding="utf-8") as records:
+        f.write(json.dumps(manifest) + "\n")
+        shutil.copyfileobj(records, f)
+    os.remove(records_path)
+    os.replace(tmp_path, path)
+    logging.info(f"Exported {count} chunks to snapshot {path}")
+    return manifest
+
+
+def read_manifest(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.loads(f.readline())
+
+
+def validate_manifest(manifest, app):
+    """Return (ok, reason) for restoring a snapshot with this manifest into app."""
+    if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+        return False, f"unsupported snapshot format {manifest.get('format_version')}"
+    if manifest.get("embedder") != embedder_signature(app):
+        return False, f"snapshot was embedded with {manifest.get('embedder')}, app uses {embedder_signature(app)}"
+    expected_dimension = getattr(app.db.embedder, "vector_dimension", None)
+    if expected_dimension and manifest.get("dimension") and manifest["dimension"] != expected_dimension:
+        return False, f"snapshot vectors have {manifest['dimension']} dimensions, app expects {expected_dimension}"
+    if not manifest.get("count"):
+        return False, "snapshot is empty"
+    if manifest.get("chroma_version") != chroma_version():
+        # Records are restored through the Chroma API, so a different on-disk schema is fine
+        logging.info(f"Snapshot made with Chroma {manifest.get('chroma_version')}, restoring into {chroma_version()}")
+    return True, None
+
+
+def restore_snapshot(app, path):
+    """Add every chunk of the snapshot to the app's collection. Returns the manifest."""
+    collection = app.db.collection
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        manifest = json.loads(f.readline())
+        batch = []
+        restored = 0
+        for line in f:
+            batch.append(json.loads(line))
+            if len(batch) >= RESTORE_BATCH_SIZE:
+                restored += _add_batch(collection, batch)
+                batch = []
+        if batch:
+            restored += _add_batch(collection, batch)
+    logging.info(f"Restored {restored} chunks from snapshot {path}")
+    return manifest
+
+
+def _add_batch(collection, batch):
+    collection.upsert(
+        ids=[record["id"] for record in batch],
+        documents=[record["document"] for record in batch],
+        metadatas=[record["metadata"] for record in batch],
+        embeddings=[np.frombuffer(base64.b64decode(record["embedding"]), dtype=np.float32).tolist() for record in batch],
+    )
+    return len(batch)
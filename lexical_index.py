@@ -0,0 +1,179 @@
+import math
+import re
+from collections import Counter
+
+from sqlite_store import LOOKUP_BATCH_SIZE, REBUILD_PAGE_SIZE, SQLiteStore
+
+# Identifiers keep $ and _ so names like onKeyPress, $scope or SPRITE_SIZE survive as one token
+TOKEN_PATTERN = re.compile(r"[A-Za-z_$][\w$]*|\d+(?:\.\d+)*")
+CAMEL_PATTERN = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from has have how i if in into is it its me my "
+    "no not of on or so that the their then there these this to use was what when where which "
+    "who why will with you your".split()
+)
+
+
+def tokenize(text):
+    """
+    Lower-cased terms for BM25. Compound identifiers are indexed whole and as their
+    parts, so `onKeyPress` matches both the exact name and a question about "key press".
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text):
+        lowered = token.lower()
+        if lowered in STOPWORDS or len(lowered) < 2:
+            continue
+        terms.append(lowered)
+        parts = [part.lower() for piece in token.split("_") for part in CAMEL_PATTERN.findall(piece)]
+        if len(parts) > 1:
+            terms.extend(part for part in parts if len(part) > 1 and part not in STOPWORDS)
+    return terms
+
+
+class LexicalIndex(SQLiteStore):
+    """
+    BM25 inverted index over the chunks in the Chroma collection, kept in SQLite
+    next to it under db/. Chunks are added and removed alongside the collection,
+    and a query only reads the postings of its own terms.
+    """
+
+    def __init__(self, path, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        super().__init__(path)
+
+    def _create(self):
+        self._conn.execute("CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, length INTEGER)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS postings (term TEXT, id TEXT, tf INTEGER, PRIMARY KEY (term, id)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS postings_id ON postings (id)")
+        self._doc_count, total_length = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs").fetchone()
+        self._total_length = total_length
+
+    def count(self):
+        with self._lock:
+            self._ensure_open()
+            return self._doc_count
+
+    def add(self, ids, documents):
+        with self._lock:
+            self._ensure_open()
+            self._delete(ids)
+            postings = []
+            docs = []
+            for chunk_id, document in zip(ids, documents):
+                terms = Counter(tokenize(document or ""))
+                length = sum(terms.values())
+                docs.append((chunk_id, length))
+                postings.extend((term, chunk_id, tf) for term, tf in terms.items())
+                self._doc_count += 1
+                self._total_length += length
+            self._conn.executemany("INSERT INTO docs (id, length) VALUES (?, ?)", docs)
+            self._conn.executemany("INSERT INTO postings (term, id, tf) VALUES (?, ?, ?)", postings)
+            self._conn.commit()
+
+    def delete(self, ids):
+        with self._lock:
+            self._ensure_open()
+            self._delete(ids)
+            self._conn.commit()
+
+    def _delete(self, ids):
+        ids = list(dict.fromkeys(ids))
+        for start in range(0, len(ids), LOOKUP_BATCH_SIZE):
+            batch = ids[start:start + LOOKUP_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            removed, length = self._conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs WHERE id IN ({placeholders})", batch
+            ).fetchone()
+            if not removed:
+                continue
+            self._conn.execute(f"DELETE FROM docs WHERE id IN ({placeholders})", batch)
+            self._conn.execute(f"DELETE FROM postings WHERE id IN ({placeholders})", batch)
+            self._doc_count -= removed
+            self._total_length -= length
+
+    def clear(self):
+        with self._lock:
+            self._ensure_open()
+            self._conn.execute("DELETE FROM docs")
+            self._conn.execute("DELETE FROM postings")
+            self._conn.commit()
+            self._doc_count = 0
+            self._total_length = 0
+
+    def rebuild(self, collection):
+        """Re-index every chunk in a Chroma collection, e.g. after a snapshot restore."""
+        self.clear()
+        offset = 0
+        while True:
+            page = collection.get(include=["documents"], limit=REBUILD_PAGE_SIZE, offset=offset)
+            ids = page.get("ids") or []
+            if ids:
+                self.add(ids, page.get("documents") or [])
+            if len(ids) < REBUILD_PAGE_SIZE:
+                break
+            offset += REBUILD_PAGE_SIZE
+        return self.count()
+
+    def search(self, query, limit=20):
+        """Return up to limit (chunk id, BM25 score) pairs, best first."""
+        terms = set(tokenize(query))
+        with self._lock:
+            self._ensure_open()
+            if not terms or not self._doc_count:
+                return []
+            average_length = self._total_length / self._doc_count
+            scores = {}
+            for term in terms:
+                rows = self._conn.execute(
+                    "SELECT p.id, p.tf, d.length FROM postings p JOIN docs d ON d.id = p.id WHERE p.term = ?",
+                    (term,),
+                ).fetchall()
+                if not rows:
+                    continue
+                idf = math.log(1 + (self._doc_count - len(rows) + 0.5) / (len(rows) + 0.5))
+                for chunk_id, tf, length in rows:
+                    norm = tf + self.k1 * (1 - self.b + self.b * length / average_length)
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return sorted(scores.items(), key=lambda item: -item[1])[:limit]
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Merge several best-first lists of ids into one, scoring each id by sum(1 / (k + rank))."""
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda chunk_id: -scores[chunk_id])
+
+
+def hybrid_contexts(app, lexical_index, query, query_embedding, top_k=4, candidates=20, rrf_k=60):
+    """
+    Retrieve top_k chunk texts for query by fusing Chroma's vector ranking with the
+    BM25 ranking. The vector side reuses the query's cached embedding.
+    """
+    collection = app.db.collection
+    where = {"app_id": app.config.id} if app.config is not None and app.config.id else None
+    available = collection.count()
+    if not available:
+        return []
+    vector = collection.query(
+        query_embeddings=[query_embedding],
+        n_results=min(candidates, available),
+        where=where,
+        include=["documents"],
+    )
+    vector_ids = vector["ids"][0]
+    documents = dict(zip(vector_ids, vector["documents"][0]))
+    lexical_ids = [chunk_id for chunk_id, _ in lexical_index.search(query, limit=candidates)]
+    fused = reciprocal_rank_fusion([vector_ids, lexical_ids], k=rrf_k)[:top_k]
+    missing = [chunk_id for chunk_id in fused if chunk_id not in documents]
+    if missing:
+        page = collection.get(ids=missing, include=["documents"])
+        documents.update(zip(page["ids"], page["documents"]))
+    # Ids only the lexical index knows about (deleted from Chroma since) are dropped
+    return [documents[chunk_id] for chunk_id in fused if chunk_id in documents]
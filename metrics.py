@@ -0,0 +1,168 @@
+import functools
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Samples kept per timing; percentiles are over this rolling window
+DEFAULT_WINDOW = 1000
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(q * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Metrics:
+    """
+    In-process timings and counters shared by every session.
+
+    Timings keep their last window samples for p50/p95/p99 plus a lifetime count
+    and sum; counters only count. Recording is a lock and a deque append, cheap
+    enough for every command, chunk batch and token stream.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        self.started_at = time.time()
+        self._timings = {}
+        self._totals = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        with self._lock:
+            if name not in self._timings:
+                self._timings[name] = deque(maxlen=self.window)
+                self._totals[name] = [0, 0.0]
+            self._timings[name].append(seconds)
+            totals = self._totals[name]
+            totals[0] += 1
+            totals[1] += seconds
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """Decorator recording every call of the function under name."""
+        def decorate(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def snapshot(self):
+        """{"timings": {name: {count, sum, p50, p95, p99, max}}, "counters": {name: value}} in seconds."""
+        with self._lock:
+            samples = {name: sorted(values) for name, values in self._timings.items()}
+            totals = {name: list(values) for name, values in self._totals.items()}
+            counters = dict(self._counters)
+        timings = {}
+        for name, values in samples.items():
+            timings[name] = {
+                "count": totals[name][0],
+                "sum": totals[name][1],
+                **{f"p{int(q * 100)}": percentile(values, q) for q in QUANTILES},
+                "max": values[-1] if values else None,
+            }
+        return {"timestamp": time.time(), "uptime": time.time() - self.started_at, "timings": timings, "counters": counters}
+
+    def reset(self):
+        with self._lock:
+            self._timings.clear()
+            self._totals.clear()
+            self._counters.clear()
+            self.started_at = time.time()
+
+
+def _metric_name(name):
+    return "stjamie_" + "".join(c if c.isalnum() else "_" for c in name)
+
+
+def to_prometheus(snapshot):
+    """Prometheus text exposition format: one summary per timing, one counter per counter."""
+    lines = []
+    for name, stats in sorted(snapshot["timings"].items()):
+        metric = f"{_metric_name(name)}_seconds"
+        lines.append(f"# TYPE {metric} summary")
+        for q in QUANTILES:
+            value = stats[f"p{int(q * 100)}"]
+            if value is not None:
+                lines.append(f'{metric}{{quantile="{q}"}} {value:.6f}')
+        lines.append(f"{metric}_sum {stats['sum']:.6f}")
+        lines.append(f"{metric}_count {stats['count']}")
+    for name, value in sorted(snapshot["counters"].items()):
+        metric = f"{_metric_name(name)}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_export(snapshot, path):
+    """Prometheus text for a .prom path (replaced atomically), otherwise one JSON line appended."""
+    if path.endswith(".prom"):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(to_prometheus(snapshot))
+        os.replace(tmp_path, path)
+    else:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(snapshot) + "\n")
+
+
+def start_exporter(registry, path, interval):
+    """Write registry snapshots to path every interval seconds from a daemon thread."""
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                write_export(registry.snapshot(), path)
+            except Exception as e:
+                logging.warning(f"Could not export metrics to {path}: {str(e)}")
+
+    thread = threading.Thread(target=run, name="metrics-exporter", daemon=True)
+    thread.start()
+    return thread
+
+
+def format_stats(snapshot):
+    """Markdown tables for the /stats command, timings in milliseconds."""
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.0f}"
+
+    lines = [f"Metrics since {time.strftime('%Y-%m-%d %H:%M', time.localtime(snapshot['timestamp'] - snapshot['uptime']))}", ""]
+    if snapshot["timings"]:
+        lines += ["| Phase | Count | p50 ms | p95 ms | p99 ms | Max ms |", "|---|---:|---:|---:|---:|---:|"]
+        for name, stats in sorted(snapshot["timings"].items()):
+            lines.append(
+                f"| {name} | {stats['count']} | {ms(stats['p50'])} | {ms(stats['p95'])} | {ms(stats['p99'])} | {ms(stats['max'])} |"
+            )
+    else:
+        lines.append("No timings recorded yet.")
+    if snapshot["counters"]:
+        lines += ["", "| Counter | Value |", "|---|---:|"]
+        lines += [f"| {name} | {value} |" for name, value in sorted(snapshot["counters"].items())]
+    return "\n".join(lines)
+
+
+# Process-wide registry; Streamlit runs every session in the same process
+metrics = Metrics()
@@ -0,0 +1,245 @@
+import hashlib
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+from metrics import metrics
+
+
+class SchedulerBusyError(Exception):
+    pass
+
+
+def is_rate_limit_error(error):
+    if getattr(error, "status_code", None) == 429 or getattr(error, "http_status", None) == 429:
+        return True
+    text = str(error).lower()
+    return "429" in text or "rate limit" in text or "rate_limit" in text
+
+
+def retry_after(error):
+    """Seconds from a Retry-After header on the error's response, if the API sent one."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def request_key(*parts):
+    return hashlib.sha256("\x00".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+class TokenBucket:
+    """Requests-per-minute limit that allows short bursts up to capacity."""
+
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or max(1, per_minute // 10)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take one token and return how long to sleep before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class Flight:
+    """One upstream call in progress; identical requests follow it instead of calling again."""
+
+    def __init__(self):
+        self.tokens = []
+        self.done = False
+        self.result = None
+        self.error = None
+        self._condition = threading.Condition()
+
+    def publish(self, token):
+        with self._condition:
+            self.tokens.append(token)
+            self._condition.notify_all()
+
+    def finish(self, result=None, error=None):
+        with self._condition:
+            self.result = result
+            self.error = error
+            self.done = True
+            self._condition.notify_all()
+
+    def follow(self, sink=None):
+        """Replay the streamed tokens into sink as they arrive and return the shared result."""
+        sent = 0
+        while True:
+            with self._condition:
+                while len(self.tokens) == sent and not self.done:
+                    self._condition.wait()
+                pending = self.tokens[sent:]
+                done = self.done
+            for token in pending:
+                if sink is not None:
+                    sink.add(token)
+            sent += len(pending)
+            if done and sent == len(self.tokens):
+                if self.error is not None:
+                    raise self.error
+                return self.result
+
+
+class StreamTee:
+    """Renderer stand-in for the leading request: tokens go to its own sink and to every follower."""
+
+    def __init__(self, sink, flight):
+        self.sink = sink
+        self.flight = flight
+
+    def add(self, token):
+        if not token:
+            return
+        if self.sink is not None:
+            self.sink.add(token)
+        self.flight.publish(token)
+
+    def consume(self, tokens):
+        for token in tokens:
+            self.add(token)
+        return "".join(self.flight.tokens)
+
+
+class RequestScheduler:
+    """
+    Process-wide gate in front of the OpenAI chat and image calls.
+
+    Calls run on the caller's thread (so streamed tokens still reach that
+    session's placeholder), but only max_concurrency at a time: waiting callers
+    are granted slots round-robin across sessions, and at most max_queued may
+    wait. Each model has a token-bucket requests-per-minute limit, 429 responses
+    are retried with jittered exponential backoff, and a call whose key matches
+    one already in flight shares that call's stream and result.
+    """
+
+    def __init__(self, rate_limits=None, max_concurrency=8, max_queued=200, queue_timeout=120,
+                 retries=4, backoff=1.0, max_backoff=30.0):
+        self.buckets = {model: TokenBucket(per_minute) for model, per_minute in (rate_limits or {}).items()}
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._active = 0
+        self._waiting = OrderedDict()  # session -> deque of events, in round-robin order
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def call(self, session_id, model, fn, key=None, sink=None):
+        """
+        Run fn(stream) and return its result. stream has add(token) and
+        consume(tokens); whatever fn streams through it also reaches sink and any
+        followers. With a key, an identical call already in flight is joined instead.
+        """
+        if key is not None:
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = Flight()
+            if not leader:
+                metrics.increment("scheduler.coalesced")
+                return flight.follow(sink)
+        else:
+            flight = Flight()
+
+        try:
+            with metrics.timer("scheduler.queue_wait"):
+                self._acquire(session_id)
+            try:
+                result = self._run(model, fn, StreamTee(sink, flight))
+            finally:
+                self._release()
+        except Exception as e:
+            flight.finish(error=e)
+            raise
+        else:
+            flight.finish(result=result)
+            return result
+        finally:
+            if key is not None:
+                with self._lock:
+                    self._flights.pop(key, None)
+
+    def _run(self, model, fn, stream):
+        attempt = 0
+        while True:
+            bucket = self.buckets.get(model)
+            if bucket is not None:
+                delay = bucket.reserve()
+                if delay > 0:
+                    metrics.observe("scheduler.rate_limit_wait", delay)
+                    time.sleep(delay)
+            try:
+                return fn(stream)
+            except Exception as e:
+                # Only retry before anything was streamed, otherwise the user would see the answer twice
+                if not is_rate_limit_error(e) or attempt >= self.retries or stream.flight.tokens:
+                    raise
+                delay = retry_after(e) or min(self.max_backoff, self.backoff * (2 ** attempt))
+                delay *= random.uniform(0.5, 1.5)
+                attempt += 1
+                metrics.increment("scheduler.rate_limited")
+                logging.warning(f"{model} rate limited; retrying in {delay:.1f}s (attempt {attempt} of {self.retries})")
+                time.sleep(delay)
+
+    def _acquire(self, session_id):
+        event = threading.Event()
+        with self._lock:
+            queued = sum(len(events) for events in self._waiting.values())
+            if self._active >= self.max_concurrency and queued >= self.max_queued:
+                metrics.increment("scheduler.rejected")
+                raise SchedulerBusyError("The assistant is very busy right now. Please try again in a minute.")
+            self._waiting.setdefault(session_id, deque()).append(event)
+            self._dispatch()
+        if event.wait(self.queue_timeout):
+            return
+        with self._lock:
+            if event.is_set():
+                return  # granted just as the wait timed out
+            events = self._waiting.get(session_id)
+            if events is not None:
+                events.remove(event)
+                if not events:
+                    del self._waiting[session_id]
+        metrics.increment("scheduler.rejected")
+        raise SchedulerBusyError("The assistant is very busy right now. Please try again in a minute.")
+
+    def _release(self):
+        with self._lock:
+            self._active -= 1
+            self._dispatch()
+
+    def _dispatch(self):
+        # Called with the lock held: grant free slots to sessions in turn
+        while self._active < self.max_concurrency and self._waiting:
+            session_id, events = next(iter(self._waiting.items()))
+            event = events.popleft()
+            if events:
+                self._waiting.move_to_end(session_id)
+            else:
+                del self._waiting[session_id]
+            self._active += 1
+            event.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active": self._active,
+                "waiting": sum(len(events) for events in self._waiting.values()),
+                "in_flight_keys": len(self._flights),
+            }
@@ -0,0 +1,118 @@
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+class SessionStore:
+    """
+    Conversation messages of every session, kept in SQLite.
+
+    The database runs in WAL mode so Streamlit replicas sharing the data
+    directory can read while one of them writes. Appends are buffered and
+    written in one transaction once batch_size messages are pending or
+    flush_interval seconds have passed, from a daemon thread, so a chat turn
+    never waits on the disk. Reads flush first, so they always see every message.
+    """
+
+    def __init__(self, path, batch_size=20, flush_interval=2.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._last_seq = 0
+        self._lock = threading.Lock()  # pending rows and sequence numbers
+        self._db_lock = threading.Lock()  # the connection; taken before _lock when both are needed
+        self._wake = threading.Event()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "session_id TEXT, seq INTEGER, role TEXT, content TEXT, image_refs TEXT, created_at REAL, "
+            "PRIMARY KEY (session_id, seq)) WITHOUT ROWID"
+        )
+        self._conn.commit()
+        threading.Thread(target=self._flush_loop, name="session-store-writer", daemon=True).start()
+        atexit.register(self.flush)
+
+    def _flush_loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.warning(f"Could not save conversation messages: {str(e)}")
+
+    def append(self, session_id, message):
+        """
+        Queue message for writing and return its sequence number, which orders the
+        session's messages. Numbers are nanosecond timestamps rather than counters so
+        that API workers in other processes can append to the same session.
+        """
+        with self._lock:
+            seq = self._last_seq = max(time.time_ns(), self._last_seq + 1)
+            self._pending.append((
+                session_id, seq, message["role"], message["content"],
+                json.dumps(message["image_refs"]) if message.get("image_refs") else None, time.time(),
+            ))
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+        return seq
+
+    def flush(self):
+        with self._db_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO messages (session_id, seq, role, content, image_refs, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self._conn.commit()
+            except Exception:
+                # Keep the batch for the next attempt rather than lose the conversation
+                with self._lock:
+                    self._pending = rows + self._pending
+                raise
+
+    @staticmethod
+    def _message(row):
+        seq, role, content, image_refs = row
+        message = {"role": role, "content": content, "seq": seq}
+        if image_refs:
+            message["image_refs"] = json.loads(image_refs)
+        return message
+
+    def _query(self, sql, params):
+        self.flush()
+        with self._db_lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def count(self, session_id):
+        return self._query("SELECT COUNT(*) FROM messages WHERE session_id = ?", (session_id,))[0][0]
+
+    def load_recent(self, session_id, limit):
+        """The last limit messages of the session, oldest first."""
+        rows = self._query(
+            "SELECT seq, role, content, image_refs FROM messages WHERE session_id = ? ORDER BY seq DESC LIMIT ?",
+            (session_id, limit),
+        )
+        return [self._message(row) for row in reversed(rows)]
+
+    def load_before(self, session_id, before_seq, limit):
+        """Up to limit messages preceding before_seq, oldest first, for paging back through a conversation."""
+        rows = self._query(
+            "SELECT seq, role, content, image_refs FROM messages WHERE session_id = ? AND seq < ? "
+            "ORDER BY seq DESC LIMIT ?",
+            (session_id, before_seq, limit),
+        )
+        return [self._message(row) for row in reversed(rows)]
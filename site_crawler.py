@@ -0,0 +1,192 @@
+import gzip
+import logging
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from html.parser import HTMLParser
+from urllib.parse import urldefrag, urljoin, urlparse
+from urllib.robotparser import RobotFileParser
+
+from ingestion import INGEST_DEFAULTS, http_get, response_fingerprint
+
+CRAWL_DEFAULTS = {
+    "depth": 2,  # link hops from the start page when the site has no sitemap
+    "max_pages": 200,  # pages handed to ingestion per crawl
+    "scope": None,  # path prefix pages must be under; defaults to the start URL's directory
+}
+
+ROBOTS_USER_AGENT = "StJamieBot"
+MAX_SITEMAP_NESTING = 3
+
+
+def is_sitemap(url):
+    return urlparse(url).path.lower().endswith((".xml", ".xml.gz"))
+
+
+class LinkParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            return
+        attrs = dict(attrs)
+        if attrs.get("href") and "nofollow" not in (attrs.get("rel") or ""):
+            self.links.append(attrs["href"])
+
+
+class SiteCrawler:
+    """
+    Discover the pages of a docs site for bulk ingestion.
+
+    A sitemap URL is read directly; for a site root the sitemaps listed in
+    robots.txt (or /sitemap.xml) are used, falling back to following links up to
+    depth hops. Only pages on the same host under the scope path that robots.txt
+    allows are produced. All requests go through the ingestion module's shared
+    keep-alive session and per-host limit.
+    """
+
+    def __init__(self, root, depth=2, max_pages=200, scope=None, workers=None):
+        self.root = root
+        parsed = urlparse(root)
+        self.origin = f"{parsed.scheme}://{parsed.netloc}"
+        self.host = parsed.netloc
+        if scope:
+            self.scope = scope if scope.startswith("/") else f"/{scope}"
+        elif is_sitemap(root):
+            self.scope = "/"
+        else:
+            self.scope = parsed.path[:parsed.path.rfind("/") + 1] or "/"
+        self.depth = int(depth)
+        self.max_pages = int(max_pages)
+        self.workers = workers or INGEST_DEFAULTS["workers"]
+        self.robots = None
+        self.produced = 0
+        self.disallowed = 0
+
+    def in_scope(self, url):
+        parsed = urlparse(url)
+        return parsed.scheme in ("http", "https") and parsed.netloc == self.host and parsed.path.startswith(self.scope)
+
+    def allowed(self, url):
+        if self.robots is not None and not self.robots.can_fetch(ROBOTS_USER_AGENT, url):
+            self.disallowed += 1
+            return False
+        return True
+
+    def _load_robots(self):
+        robots = RobotFileParser()
+        try:
+            response = http_get(f"{self.origin}/robots.txt")
+        except Exception as e:
+            logging.warning(f"Could not read robots.txt for {self.host}: {str(e)}")
+            return []
+        if response.status_code in (401, 403):
+            robots.disallow_all = True
+        elif response.ok:
+            robots.parse(response.text.splitlines())
+        else:
+            robots.allow_all = True
+        self.robots = robots
+        return robots.site_maps() or []
+
+    def _sitemap_urls(self, sitemap_url, nesting=0, guessed=False):
+        try:
+            response = http_get(sitemap_url)
+            response.raise_for_status()
+        except Exception as e:
+            # A guessed /sitemap.xml is often simply missing
+            (logging.info if guessed else logging.warning)(f"Could not read sitemap {sitemap_url}: {str(e)}")
+            return
+        body = response.content
+        if body[:2] == b"\x1f\x8b":
+            body = gzip.decompress(body)
+        try:
+            root = ElementTree.fromstring(body)
+        except ElementTree.ParseError as e:
+            logging.warning(f"Ignoring malformed sitemap {sitemap_url}: {str(e)}")
+            return
+        nested = root.tag.endswith("sitemapindex")
+        for element in root.iter():
+            if not element.tag.endswith("loc") or not element.text:
+                continue
+            url = element.text.strip()
+            if nested:
+                if nesting < MAX_SITEMAP_NESTING:
+                    yield from self._sitemap_urls(url, nesting + 1)
+            else:
+                yield url
+
+    def _fetch_page(self, url):
+        response = http_get(url)
+        response.raise_for_status()
+        if "html" not in response.headers.get("Content-Type", "html"):
+            return None, []
+        parser = LinkParser()
+        parser.feed(response.text)
+        links = []
+        for href in parser.links:
+            link = urldefrag(urljoin(response.url, href))[0]
+            if self.in_scope(link):
+                links.append(link)
+        return response_fingerprint(response), links
+
+    def _crawl_links(self):
+        # Breadth-first over links, yielding each page (with its body) as soon as it is downloaded
+        seen = {self.root}
+        jobs = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            if self.allowed(self.root):
+                jobs[pool.submit(self._fetch_page, self.root)] = (self.root, 0)
+            while jobs:
+                done, _ = wait(jobs, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url, depth = jobs.pop(future)
+                    try:
+                        fetched, links = future.result()
+                    except Exception as e:
+                        logging.warning(f"Skipping {url}: {str(e)}")
+                        continue
+                    if fetched is None or self.produced >= self.max_pages:
+                        continue
+                    self.produced += 1
+                    yield url, "web_page", fetched
+                    if depth >= self.depth:
+                        continue
+                    for link in links:
+                        if link in seen or len(seen) >= self.max_pages * 2:
+                            continue
+                        seen.add(link)
+                        if self.allowed(link):
+                            jobs[pool.submit(self._fetch_page, link)] = (link, depth + 1)
+                if self.produced >= self.max_pages:
+                    for future in jobs:
+                        future.cancel()
+                    break
+
+    def sources(self):
+        """Yield (url, data_type) or (url, data_type, fetched) items for IngestionPipeline.run."""
+        listed = self._load_robots()
+        guessed = False
+        if is_sitemap(self.root):
+            sitemaps = [self.root]
+        else:
+            sitemaps = [url for url in listed if urlparse(url).netloc == self.host]
+            if not sitemaps:
+                sitemaps, guessed = [f"{self.origin}/sitemap.xml"], True
+        seen = set()
+        for sitemap in sitemaps:
+            for url in self._sitemap_urls(sitemap, guessed=guessed):
+                url = urldefrag(url)[0]
+                if url in seen or not self.in_scope(url) or not self.allowed(url):
+                    continue
+                seen.add(url)
+                self.produced += 1
+                # Pages from a sitemap are fetched by the pipeline itself, conditionally against the manifest
+                yield url, "web_page"
+                if self.produced >= self.max_pages:
+                    return
+        if self.produced or is_sitemap(self.root):
+            return
+        logging.info(f"No sitemap pages under {self.origin}{self.scope}; following links from {self.root}")
+        yield from self._crawl_links()
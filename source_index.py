@@ -0,0 +1,73 @@
+import json
+import logging
+import os
+import time
+
+# Page size for the metadata-only scan that rebuilds a missing index
+SCAN_PAGE_SIZE = 500
+
+
+class SourceIndex:
+    """
+    Small JSON index of the sources in the knowledge base, kept inside db/ so it
+    disappears together with the collection it describes. Each entry holds the
+    source's chunk count and when it was last ingested.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f).get("sources", {})
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable source index {self.path}: {str(e)}")
+            return {}
+
+    def save(self, sources):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"sources": sources}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def record(self, results):
+        """Record ingestion results from IngestionPipeline.run."""
+        sources = self.load()
+        now = time.time()
+        for result in results:
+            if result["status"] == "added":
+                sources[result["source"]] = {"chunks": result["total_chunks"], "ingested_at": now}
+            elif result["status"] == "unchanged" and result["source"] not in sources:
+                sources[result["source"]] = {"chunks": result["total_chunks"], "ingested_at": None}
+        self.save(sources)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def rebuild(self, collection, page_size=SCAN_PAGE_SIZE):
+        """Rebuild the index by paging through chunk metadata only (no documents or embeddings)."""
+        logging.info("Rebuilding source index from collection metadata")
+        sources = {}
+        offset = 0
+        while True:
+            page = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+            metadatas = page.get("metadatas") or []
+            for metadata in metadatas:
+                url = (metadata or {}).get("url")
+                if url:
+                    entry = sources.setdefault(url, {"chunks": 0, "ingested_at": None})
+                    entry["chunks"] += 1
+            if len(metadatas) < page_size:
+                break
+            offset += page_size
+        self.save(sources)
+        logging.info(f"Source index rebuilt with {len(sources)} sources")
+        return sources
@@ -0,0 +1,37 @@
+import os
+import sqlite3
+import threading
+
+# SQLite's default limit on bound parameters is 999
+LOOKUP_BATCH_SIZE = 500
+# Chunks read per collection.get call when a store is rebuilt from the collection
+REBUILD_PAGE_SIZE = 500
+
+
+class SQLiteStore:
+    """
+    A SQLite file kept next to the Chroma collection under db/. Subclasses create
+    their tables in _create and call _ensure_open, holding _lock, before every use.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._open()
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._create()
+        self._conn.commit()
+
+    def _create(self):
+        raise NotImplementedError
+
+    def _ensure_open(self):
+        # reset_chroma_storage deletes db/ wholesale; start afresh rather than write to a deleted file
+        if not os.path.exists(self.path):
+            self._conn.close()
+            self._open()
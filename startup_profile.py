@@ -0,0 +1,42 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+# Set STJAMIE_PROFILE_STARTUP=1 to time each import and init phase of a script run
+ENABLED = os.environ.get("STJAMIE_PROFILE_STARTUP") == "1"
+
+_phases = []
+_run_started = time.perf_counter()
+
+
+def start_run():
+    """Called at the top of app.py; Streamlit re-executes the script on every rerun."""
+    global _run_started
+    _phases.clear()
+    _run_started = time.perf_counter()
+
+
+@contextmanager
+def phase(name):
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases.append((name, time.perf_counter() - start))
+
+
+def report():
+    """Phase timings of the current run so far, plus the elapsed total, in seconds."""
+    return list(_phases), time.perf_counter() - _run_started
+
+
+def log_report():
+    if not ENABLED:
+        return
+    phases, total = report()
+    lines = [f"{name}: {seconds * 1000:.1f} ms" for name, seconds in phases]
+    logging.info(f"Startup profile ({total * 1000:.1f} ms so far): " + "; ".join(lines))
@@ -0,0 +1,81 @@
+import copy
+import time
+
+try:
+    from langchain_core.callbacks import BaseCallbackHandler
+except ImportError:
+    # Older embedchain releases ship the pre-split langchain package
+    from langchain.callbacks.base import BaseCallbackHandler
+
+CURSOR = "▌"
+
+
+class StreamingRenderer:
+    """
+    Accumulates streamed tokens and redraws a Streamlit placeholder at most once
+    per flush interval, so fast token rates do not turn into one websocket
+    message per token.
+    """
+
+    def __init__(self, placeholder, flush_interval=0.1):
+        self.placeholder = placeholder
+        self.flush_interval = flush_interval
+        self.parts = []
+        self.first_token_at = None
+        self._started_at = time.monotonic()
+        self._last_flush = 0.0
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    @property
+    def time_to_first_token(self):
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self._started_at
+
+    def add(self, token):
+        if not token:
+            return
+        now = time.monotonic()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self.parts.append(token)
+        if now - self._last_flush >= self.flush_interval:
+            self._last_flush = now
+            self.placeholder.markdown(self.text + CURSOR)
+
+    def consume(self, tokens):
+        """Render an iterable of tokens (e.g. a generator returned by app.query) and return the full text."""
+        for token in tokens:
+            self.add(token)
+        return self.text
+
+    def finish(self, text=None):
+        final_text = self.text if text is None else text
+        self.placeholder.markdown(final_text)
+        return final_text
+
+
+class TokenCallbackHandler(BaseCallbackHandler):
+    """LangChain callback that forwards every new LLM token to a StreamingRenderer."""
+
+    def __init__(self, renderer):
+        self.renderer = renderer
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.renderer.add(token)
+
+
+def streaming_llm(app, renderer):
+    """
+    Copy of the app's configured LLM that streams tokens into the renderer. The
+    shared app.llm is never touched: BaseLlm.query(config=...) assigns the
+    per-call config to the LLM object itself, which every session uses.
+    """
+    llm = copy.copy(app.llm)
+    llm.config = copy.copy(app.llm.config)
+    llm.config.stream = True
+    llm.config.callbacks = [TokenCallbackHandler(renderer)]
+    return llm